@@ -2,10 +2,12 @@
 
 import struct
 import socket
+import bisect
+import csv
 import TorCtl
 import StatsSupport
 
-from TorUtil import plog
+from TorUtil import plog, Callable
 try:
   import GeoIP
   # GeoIP data object: choose database here
@@ -13,7 +15,51 @@ try:
   #geoip = GeoIP.open("./GeoLiteCity.dat", GeoIP.GEOIP_STANDARD)
 except:
   plog("NOTICE", "No GeoIP library. GeoIPSupport.py will not work correctly")
-  # XXX: How do we bail entirely..  
+  plog("NOTICE", "until a database is loaded with use_database()")
+  geoip = None
+
+class GeoIPRanges:
+  """ Pure-Python stand-in for the GeoIP library's country database.
+      Holds sorted, non-overlapping address ranges and finds the one
+      containing an address with a bisect. """
+  def __init__(self, ranges):
+    """ 'ranges' is a list of (first ip, last ip, country code) with the
+        addresses as integers """
+    ranges = sorted(ranges)
+    self.starts = map(lambda r: r[0], ranges)
+    self.ends = map(lambda r: r[1], ranges)
+    self.codes = map(lambda r: r[2], ranges)
+
+  def country_code_by_addr(self, ip):
+    """ Same as GeoIP's: country code of the dotted quad 'ip', or None """
+    try:
+      ip = struct.unpack(">I", socket.inet_aton(ip))[0]
+    except socket.error:
+      return None
+    i = bisect.bisect_right(self.starts, ip)-1
+    if i >= 0 and ip <= self.ends[i]: return self.codes[i]
+    return None
+
+  def load(filename):
+    """ Read a GeoIP country CSV file, with lines like
+        "1.0.0.0","1.0.0.255","16777216","16777471","AU","Australia" """
+    ranges = []
+    f = file(filename, "rb")
+    for row in csv.reader(f):
+      if len(row) < 5: continue
+      ranges.append((long(row[2]), long(row[3]), row[4]))
+    f.close()
+    plog("INFO", "Read "+str(len(ranges))+" GeoIP ranges from "+filename)
+    return GeoIPRanges(ranges)
+  load = Callable(load)
+
+def use_database(db):
+  """ Look countries up in 'db' from now on. This can be a GeoIP object or
+      a GeoIPRanges, or a CSV filename to load a GeoIPRanges from. """
+  global geoip
+  if isinstance(db, str): db = GeoIPRanges.load(db)
+  geoip = db
+  country_cache.clear()
 
 
 class Continent:
@@ -69,17 +115,56 @@ south_america.countries = ["AG","AI","AN","AR","AW","BB","BM","BO","BR","BS",
 # List of continents
 continents = [africa, asia, europe, north_america, oceania, south_america]
 
+# Country code -> Continent. Codes listed under several continents map to
+# the first, as the old linear search did.
+continent_map = {}
+for c in continents:
+  for country_code in c.countries:
+    continent_map.setdefault(country_code, c)
+
+# Address -> country code. Routers are annotated again when they
+# change addresses, and many routers share one.
+country_cache = {}
+COUNTRY_CACHE_MAX = 65536
+
 def get_continent(country_code):
   """ Perform country -- continent mapping """
-  for c in continents:
-    if c.contains(country_code):
-      return c
-  plog("INFO", country_code + " is not on any continent")
-  return None
+  c = continent_map.get(country_code)
+  if c is None:
+    plog("INFO", country_code + " is not on any continent")
+  return c
 
 def get_country(ip):
   """ Get the country via the library """
-  return geoip.country_code_by_addr(ip)
+  try:
+    return country_cache[ip]
+  except KeyError:
+    pass
+  if geoip is None: return None
+  cc = geoip.country_code_by_addr(ip)
+  if len(country_cache) >= COUNTRY_CACHE_MAX: country_cache.clear()
+  country_cache[ip] = cc
+  return cc
+
+def annotate_routers(routers):
+  """ Set the country_code, continent and cont_group of each of 'routers'
+      whose address changed since it was last annotated, looking each
+      distinct address up only once """
+  countries = {}
+  for r in routers:
+    if r.geoip_ip == r.ip: continue
+    r.geoip_ip = r.ip
+    if r.ip not in countries:
+      countries[r.ip] = get_country(socket.inet_ntoa(struct.pack('>I', r.ip)))
+    r.country_code = countries[r.ip]
+    r.continent = r.cont_group = None
+    if r.country_code != None:
+      c = get_continent(r.country_code)
+      if c != None:
+        r.continent = c.code
+        r.cont_group = c.group
+    else:
+      plog("INFO", r.nickname + ": Country code not found")
 
 def get_country_from_record(ip):
   """ Get the country code out of a GeoLiteCity record (not used) """
@@ -90,18 +175,15 @@ def get_country_from_record(ip):
 class GeoIPRouter(TorCtl.Router):
   # TODO: Its really shitty that this has to be a TorCtl.Router
   # and can't be a StatsRouter..
-  """ Router class extended to GeoIP """
+  """ Router class extended to GeoIP. ConsensusTracker fills in the
+      country fields of a whole consensus at once with annotate_routers()
+      """
   def __init__(self, router):
     self.__dict__ = router.__dict__
-    self.country_code = get_country(self.get_ip_dotted())
-    if self.country_code != None: 
-      c = get_continent(self.country_code)
-      if c != None:
-        self.continent = c.code
-        self.cont_group = c.group
-    else: 
-      plog("INFO", self.nickname + ": Country code not found")
-      self.continent = None
+    self.geoip_ip = None
+    self.country_code = self.continent = self.cont_group = None
+
+  annotate_routers = Callable(annotate_routers)
    
   def get_ip_dotted(self):
     """ Convert long int back to dotted quad string """
@@ -111,7 +193,7 @@ class GeoIPConfig:
   """ Class to configure GeoIP-based path building """
   def __init__(self, unique_countries=None, continent_crossings=4,
      ocean_crossings=None, entry_country=None, middle_country=None,
-     exit_country=None, excludes=None):
+     exit_country=None, excludes=None, database=None):
     # TODO: Somehow ensure validity of a configuration:
     #   - continent_crossings >= ocean_crossings
     #   - unique_countries=False --> continent_crossings!=None
@@ -138,3 +220,59 @@ class GeoIPConfig:
     # List of countries not to use in routes 
     # [(empty) list of country codes or None]
     self.excludes = excludes
+
+    # Country database to use instead of the GeoIP library's
+    # [GeoIP object, GeoIPRanges, CSV filename or None --> keep current]
+    if database != None:
+      use_database(database)
+
+def do_unit_checks():
+  """ Check the pure-Python country lookups without a GeoIP library """
+  import os
+  import tempfile
+  (fd, filename) = tempfile.mkstemp(".csv")
+  f = os.fdopen(fd, "w")
+  f.write('"1.0.0.0","1.0.0.255","16777216","16777471","AU","Australia"\n')
+  f.write('"2.0.0.0","2.0.0.255","33554432","33554687","FR","France"\n')
+  f.write('"1.0.1.0","1.0.1.255","16777472","16777727","CN","China"\n')
+  f.close()
+  try:
+    ranges = GeoIPRanges.load(filename)
+  finally:
+    os.unlink(filename)
+  assert ranges.country_code_by_addr("1.0.0.0") == "AU"
+  assert ranges.country_code_by_addr("1.0.0.255") == "AU"
+  assert ranges.country_code_by_addr("1.0.1.7") == "CN"
+  assert ranges.country_code_by_addr("2.0.0.128") == "FR"
+  assert ranges.country_code_by_addr("0.255.255.255") == None
+  assert ranges.country_code_by_addr("1.0.2.0") == None
+  assert ranges.country_code_by_addr("not an address") == None
+  print "GeoIPRanges: OK"
+
+  use_database(ranges)
+  assert get_country("1.0.0.1") == "AU"
+  assert country_cache == {"1.0.0.1" : "AU"}
+  for i in xrange(COUNTRY_CACHE_MAX+1):
+    get_country(socket.inet_ntoa(struct.pack(">I", 16777216+i)))
+  assert 0 < len(country_cache) <= COUNTRY_CACHE_MAX
+  print "country_cache: OK"
+
+  for c in continents:
+    for country_code in c.countries:
+      assert get_continent(country_code).contains(country_code)
+  assert continent_map["AU"] is oceania
+  assert continent_map["FR"] is europe
+  # "AS" is a country in Oceania, not Asia
+  assert continent_map["AS"] is oceania
+  assert get_continent("XX") == None
+  print "continent_map: OK"
+
+  r = GeoIPRouter(TorCtl.Router("%040X" % 1, "geo", 1024, False, [],
+                   ["Valid", "Running"], "1.0.1.5", "0.2.2.13", "Linux", 0,
+                   None, None, False, "%027d" % 1, None))
+  GeoIPRouter.annotate_routers([r])
+  assert (r.country_code, r.continent, r.cont_group) == ("CN", "AS", 1)
+  print "annotate_routers: OK"
+
+if __name__ == '__main__':
+  do_unit_checks()
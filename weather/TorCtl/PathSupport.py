@@ -53,11 +53,13 @@ import struct
 import random
 import socket
 import copy
+import bisect
 import Queue
 import time
 import TorUtil
 import traceback
 import threading
+import math
 from TorUtil import *
 
 import sys
@@ -78,7 +80,7 @@ __all__ = ["NodeRestrictionList", "PathRestrictionList",
 "CountryRestriction", "UniqueCountryRestriction", "SingleCountryRestriction",
 "ContinentRestriction", "ContinentJumperRestriction",
 "UniqueContinentRestriction", "MetaPathRestriction", "RateLimitedRestriction",
-"SmartSocket"]
+"SmartSocket", "r_is_ok_cached", "prune_r_cache"]
 
 #################### Path Support Interfaces #####################
 
@@ -91,11 +93,54 @@ class NoNodesRemain(RestrictionError):
   pass
 
 class NodeRestriction:
-  "Interface for node restriction policies"
+  """Interface for node restriction policies.
+
+  Restrictions are cacheable by default: r_is_ok_cached() remembers their
+  answer until the router's _rstr_gen changes, which happens only when its
+  orhash (so any descriptor field, and the country_code GeoIPSupport derives
+  from the address), nickname, bw, down state or flags change. A restriction
+  that reads anything else about a router (list_rank, refcount, the
+  restriction's own mutable settings, ...) must set cacheable = False.
+  MetaNodeRestrictions are cacheable if all of their members are."""
+  cacheable = True
   def r_is_ok(self, r):
     "Returns true if Router 'r' is acceptable for this restriction"
     return True  
 
+def r_is_ok_cached(rstr, r):
+  """Returns rstr.r_is_ok(r), reusing the previous answer for 'r' if
+     neither the router nor the restriction has changed since."""
+  gen = getattr(r, "_rstr_gen", None)
+  if gen is None or not rstr.cacheable:
+    return rstr.r_is_ok(r)
+  try:
+    cache = rstr._r_cache
+  except AttributeError:
+    cache = rstr._r_cache = {}
+  hit = cache.get(r.idhex)
+  if hit and hit[0] == gen:
+    return hit[1]
+  ret = rstr.r_is_ok(r)
+  cache[r.idhex] = (gen, ret)
+  return ret
+
+def prune_r_cache(rstr, routers):
+  """Drop the answers r_is_ok_cached() remembers in 'rstr' and its members
+     for routers that are not in 'routers', so the caches do not keep every
+     router ever seen. Caches no larger than 'routers' are left alone, which
+     bounds each cache to about the size of the consensus."""
+  live = None
+  todo = [rstr]
+  while todo:
+    rs = todo.pop()
+    todo.extend(getattr(rs, "_r_members", ()))
+    cache = getattr(rs, "_r_cache", None)
+    if cache and len(cache) > len(routers):
+      if live is None:
+        live = set([r.idhex for r in routers])
+      for idhex in cache.keys():
+        if idhex not in live: del cache[idhex]
+
 class PathRestriction:
   "Interface for path restriction policies"
   def path_is_ok(self, path):
@@ -159,7 +204,9 @@ class NodeGenerator:
     the restrictions change. """
     if sorted_r:
       self.sorted_r = sorted_r
-    self.rstr_routers = filter(lambda r: self.rstr_list.r_is_ok(r), self.sorted_r)
+    self.rstr_routers = filter(lambda r: r_is_ok_cached(self.rstr_list, r),
+                               self.sorted_r)
+    prune_r_cache(self.rstr_list, self.sorted_r)
     if not self.rstr_routers:
       plog("NOTICE", "No routers left after restrictions applied: "+str(self.rstr_list))
       raise NoNodesRemain(str(self.rstr_list))
@@ -210,6 +257,7 @@ class Connection(TorCtl.Connection):
 
 class PercentileRestriction(NodeRestriction):
   """Restriction to cut out a percentile slice of the network."""
+  cacheable = False # Depends on list_rank
   def __init__(self, pct_skip, pct_fast, r_list):
     """Constructor. Sets up the restriction such that routers in the 
      'pct_skip' to 'pct_fast' percentile of bandwidth rankings are 
@@ -230,6 +278,7 @@ class PercentileRestriction(NodeRestriction):
 
 class RankRestriction(NodeRestriction):
   """Restriction to cut out a list-rank slice of the network."""
+  cacheable = False # Depends on list_rank
   def __init__(self, rank_skip, rank_stop):
     self.rank_skip = rank_skip
     self.rank_stop = rank_stop
@@ -406,6 +455,14 @@ class ExitPolicyRestriction(NodeRestriction):
 class MetaNodeRestriction(NodeRestriction):
   """Interface for a NodeRestriction that is an expression consisting of 
      multiple other NodeRestrictions"""
+  def _members_changed(self, members):
+    """ Drop cached results and recompute cacheability. Subclasses call
+    this whenever their member restrictions change. """
+    self._r_cache = {}
+    self._r_members = list(members)
+    self.cacheable = True
+    for rs in members:
+      if not rs.cacheable: self.cacheable = False
   def add_restriction(self, rstr): raise NotImplemented()
   # TODO: these should collapse the restriction and return a new
   # instance for re-insertion (or None)
@@ -418,11 +475,12 @@ class OrNodeRestriction(MetaNodeRestriction):
   def __init__(self, rs):
     "Constructor. 'rs' is a list of NodeRestrictions"
     self.rstrs = rs
+    self._members_changed(rs)
 
   def r_is_ok(self, r):
     "Returns true if one of 'rs' is true for this router"
     for rs in self.rstrs:
-      if rs.r_is_ok(r):
+      if r_is_ok_cached(rs, r):
         return True
     return False
 
@@ -433,8 +491,9 @@ class NotNodeRestriction(MetaNodeRestriction):
   """Negates a single restriction"""
   def __init__(self, a):
     self.a = a
+    self._members_changed([a])
 
-  def r_is_ok(self, r): return not self.a.r_is_ok(r)
+  def r_is_ok(self, r): return not r_is_ok_cached(self.a, r)
 
   def __str__(self):
     return self.__class__.__name__+"("+str(self.a)+")"
@@ -445,11 +504,12 @@ class AtLeastNNodeRestriction(MetaNodeRestriction):
   def __init__(self, rstrs, n):
     self.rstrs = rstrs
     self.n = n
+    self._members_changed(rstrs)
 
   def r_is_ok(self, r):
     cnt = 0
     for rs in self.rstrs:
-      if rs.r_is_ok(r):
+      if r_is_ok_cached(rs, r):
         cnt += 1
     if cnt < self.n: return False
     else: return True
@@ -462,16 +522,18 @@ class NodeRestrictionList(MetaNodeRestriction):
   def __init__(self, restrictions):
     "Constructor. 'restrictions' is a list of NodeRestriction instances"
     self.restrictions = restrictions
+    self._members_changed(restrictions)
 
   def r_is_ok(self, r):
     "Returns true of Router 'r' passes all of the contained restrictions"
     for rs in self.restrictions:
-      if not rs.r_is_ok(r): return False
+      if not r_is_ok_cached(rs, r): return False
     return True
 
   def add_restriction(self, restr):
     "Add a NodeRestriction 'restr' to the list of restrictions"
     self.restrictions.append(restr)
+    self._members_changed(self.restrictions)
 
   # TODO: This does not collapse meta restrictions..
   def del_restriction(self, RestrictionClass):
@@ -482,10 +544,12 @@ class NodeRestrictionList(MetaNodeRestriction):
     self.restrictions = filter(
         lambda r: not isinstance(r, RestrictionClass),
           self.restrictions)
+    self._members_changed(self.restrictions)
   
   def clear(self):
     """ Remove all restrictions """
     self.restrictions = []
+    self._members_changed(self.restrictions)
 
   def __str__(self):
     return self.__class__.__name__+"("+str(map(str, self.restrictions))+")"
@@ -755,12 +819,32 @@ class BwWeightedGenerator(NodeGenerator):
     self.total_exit_bw = 0
     self.total_guard_bw = 0
     self.total_weighted_bw = 0
+    # Running sum of weighted bw over rstr_routers, for bisect in generate()
+    self.cum_weights = []
+    self.chosen = set()
     self.pathlen = pathlen
     NodeGenerator.__init__(self, sorted_r, rstr_list)
 
+  def rewind(self):
+    """ The weight table covers all of rstr_routers, so rewinding only
+    forgets which routers were chosen instead of copying the list. """
+    self.routers = self.rstr_routers
+    self.chosen = set()
+    if not self.routers:
+      plog("NOTICE", "No routers left after restrictions applied: "+str(self.rstr_list))
+      raise NoNodesRemain(str(self.rstr_list))
+
+  def mark_chosen(self, r):
+    self.chosen.add(r)
+
+  def all_chosen(self):
+    return len(self.chosen) >= len(self.routers)
+
   def rebuild(self, sorted_r=None):
+    """ Recompute the bandwidth totals and the cumulative weight table.
+    Only needed when the consensus or the restrictions change. """
     NodeGenerator.rebuild(self, sorted_r)
-    NodeGenerator.rewind(self)
+    self.rewind()
     # Set the exit_weight
     # We are choosing a non-exit
     self.total_exit_bw = 0
@@ -812,15 +896,18 @@ class BwWeightedGenerator(NodeGenerator):
           self.guard_weight = ((self.total_guard_bw-bw_per_hop)/self.total_guard_bw)
         else: self.guard_weight = 0
     
+    self.cum_weights = []
+    total_weighted_bw = 0
     for r in self.routers:
       bw = r.bw
       if "Exit" in r.flags:
         bw *= self.exit_weight
       if "Guard" in r.flags:
         bw *= self.guard_weight
-      self.total_weighted_bw += bw
+      total_weighted_bw += bw
+      self.cum_weights.append(total_weighted_bw)
 
-    self.total_weighted_bw = int(self.total_weighted_bw)
+    self.total_weighted_bw = int(total_weighted_bw)
     plog("DEBUG", "Bw: "+str(self.total_weighted_bw)+"/"+str(self.total_bw)
           +". The exit-weight is: "+str(self.exit_weight)
           + ", guard weight is: "+str(self.guard_weight))
@@ -830,20 +917,15 @@ class BwWeightedGenerator(NodeGenerator):
       # Choose a suitable random int
       i = random.randint(0, self.total_weighted_bw)
 
-      # Go through the routers
-      for r in self.routers:
-        # Below zero here means next() -> choose a new random int+router 
-        if i < 0: break
-        bw = r.bw
-        if "Exit" in r.flags:
-          bw *= self.exit_weight
-        if "Guard" in r.flags:
-          bw *= self.guard_weight
-
-        i -= bw
-        if i < 0:
-          plog("DEBUG", "Chosen router with a bandwidth of: " + str(r.bw))
-          yield r
+      # The first router whose running sum exceeds i. This is the
+      # router the old linear walk (subtracting each bw from i) stopped at.
+      idx = bisect.bisect_right(self.cum_weights, i)
+      # Past the end (rounding) or already chosen means choose again
+      if idx == len(self.routers): continue
+      r = self.routers[idx]
+      if r in self.chosen: continue
+      plog("DEBUG", "Chosen router with a bandwidth of: " + str(r.bw))
+      yield r
 
 ####################### Secret Sauce ###########################
 
@@ -1956,6 +2038,71 @@ def do_gen_unit(gen, r_list, weight_bw, num_print):
     i += 1
     if i > num_print: break
 
+def do_gen_dist_unit(gen, weight_bw, trials):
+  """ Chi-square test that 'gen' chooses routers in proportion to
+  weight_bw(gen, r). Returns the two-tailed p-value of the statistic,
+  using the normal approximation for large degrees of freedom. """
+  expected = {}
+  total = 0.0
+  for r in gen.rstr_routers:
+    w = weight_bw(gen, r)
+    if w > 0:
+      expected[r] = w
+      total += w
+  counts = {}
+  gen.rewind()
+  rtrs = gen.generate()
+  for i in xrange(trials):
+    r = rtrs.next()
+    if r not in expected:
+      print "WARN: Chose router with no weight: "+r.idhex
+      return 0.0
+    counts[r] = counts.get(r, 0) + 1
+  chisq = 0.0
+  for (r, w) in expected.iteritems():
+    exp = trials*w/total
+    chisq += (counts.get(r, 0) - exp)**2/exp
+  df = len(expected) - 1
+  if df < 1: return 1.0
+  z = (chisq - df)/math.sqrt(2.0*df)
+  pval = 2.0*(1.0-TorUtil.zprob(abs(z)))
+  print "Chi-square: "+str(chisq)+", df: "+str(df)+", p: "+str(pval)
+  return pval
+
+def do_path_bench(selector, pathlen, num_paths):
+  """ Time 'num_paths' calls to selector.select_path(). Returns paths
+  generated per second. """
+  loglevel = TorUtil.loglevel
+  TorUtil.loglevel = "NOTICE"
+  start = time.time()
+  for i in xrange(num_paths):
+    path = selector.select_path(pathlen)
+    for r in path: r.refcount -= 1
+  elapsed = time.time() - start
+  TorUtil.loglevel = loglevel
+  rate = num_paths/max(elapsed, 1e-6)
+  print "Generated "+str(num_paths)+" paths in "+str(elapsed)+"s: "+\
+        str(rate)+" paths/sec"
+  return rate
+
+def do_rstr_cache_unit(rst, r_list, rebuilds):
+  """ Check that cached restriction results agree with a fresh r_is_ok()
+  and time 'rebuilds' cached filters of 'r_list' against uncached ones."""
+  for r in r_list:
+    if r_is_ok_cached(rst, r) != rst.r_is_ok(r):
+      print "Cache mismatch for "+r.idhex+" under "+str(rst)
+  start = time.time()
+  for i in xrange(rebuilds):
+    filter(lambda r: rst.r_is_ok(r), r_list)
+  uncached = time.time() - start
+  start = time.time()
+  for i in xrange(rebuilds):
+    filter(lambda r: r_is_ok_cached(rst, r), r_list)
+  cached = time.time() - start
+  print str(rst)+": "+str(rebuilds)+" rebuilds in "+str(uncached)+\
+        "s uncached, "+str(cached)+"s cached"
+  return (uncached, cached)
+
 def do_unit(rst, r_list, plamb):
   print "\n"
   print "-----------------------------------"
@@ -2026,7 +2173,24 @@ FlagsRestriction(["Valid"])])),
    BwWeightedGenerator(sorted_rlist, FlagsRestriction(["Valid"]), 3),
    sorted_rlist, flag_weighting, 500)
 
+  exitgen = BwWeightedGenerator(sorted_rlist, FlagsRestriction(["Exit"]),
+                                3, exit=True)
+  entrygen = BwWeightedGenerator(sorted_rlist, FlagsRestriction(["Guard"]),
+                                 3, guard=True)
+  midgen = BwWeightedGenerator(sorted_rlist, FlagsRestriction(["Valid"]), 3)
+  for gen in (entrygen, midgen, exitgen):
+    if do_gen_dist_unit(gen, flag_weighting, 200000) < 0.001:
+      print "WARN: "+str(gen.rstr_list)+" distribution is off"
+  do_path_bench(PathSelector(entrygen, midgen, exitgen,
+                             PathRestrictionList([UniqueRestriction()])),
+                3, 10000)
+
  
+  do_rstr_cache_unit(NodeRestrictionList([
+      FlagsRestriction(["Running", "Valid"], ["BadExit"]),
+      OSRestriction([], ["Windows"]),
+      ExitPolicyRestriction("255.255.255.255", 443)]), sorted_rlist, 100)
+
   for r in sorted_rlist:
     if r.will_exit_to("211.11.21.22", 465):
       print r.nickname+" "+str(r.bw)
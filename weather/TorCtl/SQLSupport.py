@@ -13,8 +13,11 @@ import sys
 import time
 import datetime
 import math
+import threading
+import traceback
+import Queue
 
-import PathSupport, TorCtl
+import PathSupport, TorCtl, TorUtil
 from TorUtil import *
 from PathSupport import *
 from TorUtil import meta_port, meta_host, control_port, control_host, control_pass
@@ -24,7 +27,7 @@ import sqlalchemy
 import sqlalchemy.orm.exc
 from sqlalchemy.orm import scoped_session, sessionmaker, eagerload, lazyload, eagerload_all
 from sqlalchemy import create_engine, and_, or_, not_, func
-from sqlalchemy.sql import func,select
+from sqlalchemy.sql import func,select,bindparam,case
 from sqlalchemy.schema import ThreadLocalMetaData,MetaData
 from elixir import *
 
@@ -57,6 +60,7 @@ def setup_db(db_uri, echo=False, drop=False):
     # DIAF SQLAlchemy. A token gesture at backwards compatibility
     # wouldn't kill you, you know.
     tc_session.add = tc_session.save_or_update
+    tc_session.expunge_all = tc_session.clear
 
 class Router(Entity):
   using_options(shortnames=True, order_by='-published', session=tc_session, metadata=tc_metadata)
@@ -86,25 +90,33 @@ class Router(Entity):
   stats = OneToOne('RouterStats', inverse="router")
 
   def from_router(self, router):
-    self.published = router.published
-    self.bw = router.bw
-    self.idhex = router.idhex
-    self.orhash = router.orhash
-    self.nickname = router.nickname
-    # XXX: Temporary hack. router.os can contain unicode, which makes
-    # us barf. Apparently 'Text' types can't have unicode chars?
-    # self.os = router.os
-    self.rate_limited = router.rate_limited
-    self.guard = "Guard" in router.flags
-    self.exit = "Exit" in router.flags
-    self.stable = "Stable" in router.flags
-    self.v2dir = "V2Dir" in router.flags
-    self.v3dir = "V3Dir" in router.flags
-    self.hsdir = "HSDir" in router.flags
-    self.version = router.version.version
+    for (k, v) in Router.columns_from(router).iteritems():
+      setattr(self, k, v)
     #self.router = router
     return self
 
+  def columns_from(router):
+    """ Returns the column values for TorCtl Router 'router' as a dict,
+    suitable for bulk inserts and updates of Router.table. """
+    return {"published" : router.published,
+            "bw" : router.bw,
+            "idhex" : router.idhex,
+            "orhash" : router.orhash,
+            "nickname" : router.nickname,
+            # XXX: Temporary hack. router.os can contain unicode, which
+            # makes us barf. Apparently 'Text' types can't have unicode
+            # chars?
+            # "os" : router.os,
+            "rate_limited" : router.rate_limited,
+            "guard" : "Guard" in router.flags,
+            "exit" : "Exit" in router.flags,
+            "stable" : "Stable" in router.flags,
+            "v2dir" : "V2Dir" in router.flags,
+            "v3dir" : "V3Dir" in router.flags,
+            "hsdir" : "HSDir" in router.flags,
+            "version" : router.version.version}
+  columns_from = Callable(columns_from)
+
 class BwHistory(Entity):
   using_options(shortnames=True, session=tc_session, metadata=tc_metadata)
   using_mapper_options(save_on_init=False)
@@ -205,6 +217,94 @@ class ClosedStream(Stream):
     #return self.read_bandwidth+self.write_bandwidth 
     return self.read_bandwidth
 
+class RouterTotals(Entity):
+  """ Running sums and counts for each router, updated as BwHistory,
+  Extension and Stream rows are written. RouterStats.compute() derives
+  the rank, circuit and stream statistics from these in O(routers)
+  instead of rescanning the history.
+
+  There is one row per router, keyed on router_idhex. add_counts() and
+  add_history() update and then insert, so they must only run on the
+  SQLWriter thread; ConsensusTrackerListener.add_counts() queues them
+  there. """
+  using_options(shortnames=True, session=tc_session, metadata=tc_metadata)
+  using_mapper_options(save_on_init=False)
+  router = ManyToOne('Router', primary_key=True)
+
+  # BwHistory
+  bwh_count = Field(Integer, default=0)
+  rank_sum = Field(Integer, default=0)
+  min_rank = Field(Integer)
+  max_rank = Field(Integer)
+  bw_sum = Field(Float, default=0)
+  desc_bw_sum = Field(Float, default=0)
+
+  # Extension and FailedExtension
+  circ_try_to = Field(Integer, default=0)
+  circ_try_from = Field(Integer, default=0)
+  circ_fail_to = Field(Integer, default=0)
+  circ_fail_from = Field(Integer, default=0)
+  first_ext_count = Field(Integer, default=0)
+  first_ext_sum = Field(Float, default=0)
+
+  # Streams
+  strm_try = Field(Integer, default=0)
+  strm_closed = Field(Integer, default=0)
+  sbw_sum = Field(Float, default=0)
+  sbw_sq_sum = Field(Float, default=0)
+
+  def add_counts(idhex, **deltas):
+    """ Add each of 'deltas' to the totals of the router 'idhex'. """
+    t = RouterTotals.table
+    values = {}
+    for (k, v) in deltas.iteritems():
+      values[t.c[k]] = t.c[k] + v
+    ret = tc_session.execute(t.update(t.c.router_idhex == idhex,
+                                      values=values))
+    if ret.rowcount == 0:
+      deltas["router_idhex"] = idhex
+      tc_session.execute(t.insert(), [deltas])
+  add_counts = Callable(add_counts)
+
+  def add_history(rows):
+    """ Add a consensus worth of BwHistory 'rows' (dicts of BwHistory
+    column values) to the totals with one executemany. """
+    t = RouterTotals.table
+    ids = map(lambda r: r["router_idhex"], rows)
+    have = set(map(lambda r: r[0],
+                   select_by_idhex([t.c.router_idhex], ids, t.c.router_idhex)))
+    missing = filter(lambda i: i not in have, ids)
+    if missing:
+      tc_session.execute(t.insert(),
+                         map(lambda i: {"router_idhex" : i}, missing))
+    rank = bindparam("rank")
+    tc_session.execute(t.update(t.c.router_idhex == bindparam("r_idhex"),
+      values={t.c.bwh_count : t.c.bwh_count + 1,
+              t.c.rank_sum : t.c.rank_sum + rank,
+              t.c.min_rank : case([(or_(t.c.min_rank == None,
+                                        t.c.min_rank > rank), rank)],
+                                  else_=t.c.min_rank),
+              t.c.max_rank : case([(or_(t.c.max_rank == None,
+                                        t.c.max_rank < rank), rank)],
+                                  else_=t.c.max_rank),
+              t.c.bw_sum : t.c.bw_sum + bindparam("bw"),
+              t.c.desc_bw_sum : t.c.desc_bw_sum + bindparam("desc_bw")}),
+      map(lambda r: {"r_idhex" : r["router_idhex"], "rank" : r["rank"],
+                     "bw" : r["bw"], "desc_bw" : r["desc_bw"]}, rows))
+  add_history = Callable(add_history)
+
+  def reset():
+    """ Zero the totals for every router. """
+    RouterTotals.table.drop()
+    RouterTotals.table.create()
+    ids = map(lambda r: r[0],
+              tc_session.execute(select([Router.table.c.idhex])).fetchall())
+    if ids:
+      tc_session.execute(RouterTotals.table.insert(),
+                         map(lambda i: {"router_idhex" : i}, ids))
+    tc_session.commit()
+  reset = Callable(reset)
+
 class RouterStats(Entity):
   using_options(shortnames=True, session=tc_session, metadata=tc_metadata)
   using_mapper_options(save_on_init=False)
@@ -290,7 +390,7 @@ class RouterStats(Entity):
   _compute_stats_relation = Callable(_compute_stats_relation)
 
   def _compute_stats_query(stats_clause):
-    tc_session.clear()
+    tc_session.expunge_all()
     # http://www.sqlalchemy.org/docs/04/sqlexpression.html#sql_update
     to_s = select([func.count(Extension.id)], 
         and_(stats_clause, Extension.table.c.to_node_idhex
@@ -319,6 +419,14 @@ class RouterStats(Entity):
        RouterStats.table.c.circ_fail_from:f_from_s,
        RouterStats.table.c.avg_first_ext:avg_ext}).execute()
 
+    RouterStats._compute_rates(stats_clause)
+
+    # TODO: Give the streams relation table a sane name and reduce this too
+    RouterStats._compute_stats_streams(stats_clause)
+    tc_session.commit()
+  _compute_stats_query = Callable(_compute_stats_query)
+
+  def _compute_rates(stats_clause):
     RouterStats.table.update(stats_clause, values=
       {RouterStats.table.c.circ_from_rate:
          RouterStats.table.c.circ_fail_from/RouterStats.table.c.circ_try_from,
@@ -328,9 +436,9 @@ class RouterStats(Entity):
          (RouterStats.table.c.circ_fail_to+RouterStats.table.c.circ_fail_from)
                           /
       (RouterStats.table.c.circ_try_to+RouterStats.table.c.circ_try_from)}).execute()
+  _compute_rates = Callable(_compute_rates)
 
-
-    # TODO: Give the streams relation table a sane name and reduce this too
+  def _compute_stats_streams(stats_clause):
     for rs in RouterStats.query.filter(stats_clause).\
                         options(eagerload('router'),
                                 eagerload('router.detached_streams'),
@@ -360,8 +468,7 @@ class RouterStats(Entity):
         tot_var /= s_cnt
         rs.sbw_dev = math.sqrt(tot_var)
       tc_session.add(rs)
-    tc_session.commit()
-  _compute_stats_query = Callable(_compute_stats_query)
+  _compute_stats_streams = Callable(_compute_stats_streams)
 
   def _compute_stats(stats_clause):
     RouterStats._compute_stats_query(stats_clause)
@@ -369,7 +476,7 @@ class RouterStats(Entity):
   _compute_stats = Callable(_compute_stats)
 
   def _compute_ranks():
-    tc_session.clear()
+    tc_session.expunge_all()
     min_r = select([func.min(BwHistory.rank)],
         BwHistory.table.c.router_idhex
             == RouterStats.table.c.router_idhex).as_scalar()
@@ -393,17 +500,125 @@ class RouterStats(Entity):
         RouterStats.table.c.avg_bw:avg_bw,
         RouterStats.table.c.avg_desc_bw:avg_desc_bw}).execute()
 
+    RouterStats._compute_percentiles()
+    tc_session.commit()
+  _compute_ranks = Callable(_compute_ranks)
+
+  def _compute_percentiles():
     #min_avg_rank = select([func.min(RouterStats.avg_rank)]).as_scalar()
     max_avg_rank = select([func.max(RouterStats.avg_rank)]).as_scalar()
 
     RouterStats.table.update(values=
        {RouterStats.table.c.percentile:
             (100.0*RouterStats.table.c.avg_rank)/max_avg_rank}).execute()
+  _compute_percentiles = Callable(_compute_percentiles)
+
+  def _totals(expr, default=None):
+    """ Correlated subquery for 'expr' over the RouterTotals row of each
+    RouterStats row. """
+    t = RouterTotals.table
+    q = select([expr], t.c.router_idhex
+                 == RouterStats.table.c.router_idhex).as_scalar()
+    if default is None: return q
+    return func.coalesce(q, default)
+  _totals = Callable(_totals)
+
+  def _load_ranks():
+    """ Like _compute_ranks(), but from RouterTotals. """
+    tc_session.expunge_all()
+    t = RouterTotals.table
+    def avg(col):
+      return RouterStats._totals(case([(t.c.bwh_count > 0,
+                                        col*1.0/t.c.bwh_count)]))
+    RouterStats.table.update(values=
+       {RouterStats.table.c.min_rank:RouterStats._totals(t.c.min_rank),
+        RouterStats.table.c.avg_rank:avg(t.c.rank_sum),
+        RouterStats.table.c.max_rank:RouterStats._totals(t.c.max_rank),
+        RouterStats.table.c.avg_bw:avg(t.c.bw_sum),
+        RouterStats.table.c.avg_desc_bw:avg(t.c.desc_bw_sum)}).execute()
+
+    RouterStats._compute_percentiles()
     tc_session.commit()
-  _compute_ranks = Callable(_compute_ranks)
+  _load_ranks = Callable(_load_ranks)
+
+  def _load_stats(stats_clause):
+    """ Like _compute_stats(), but from RouterTotals. """
+    tc_session.expunge_all()
+    t = RouterTotals.table
+    RouterStats.table.update(stats_clause, values=
+      {RouterStats.table.c.circ_try_to:
+         RouterStats._totals(t.c.circ_try_to, 0),
+       RouterStats.table.c.circ_try_from:
+         RouterStats._totals(t.c.circ_try_from, 0),
+       RouterStats.table.c.circ_fail_to:
+         RouterStats._totals(t.c.circ_fail_to, 0),
+       RouterStats.table.c.circ_fail_from:
+         RouterStats._totals(t.c.circ_fail_from, 0),
+       RouterStats.table.c.avg_first_ext:
+         RouterStats._totals(case([(t.c.first_ext_count > 0,
+                           t.c.first_ext_sum/t.c.first_ext_count)])),
+       RouterStats.table.c.strm_try:
+         RouterStats._totals(t.c.strm_try, 0),
+       RouterStats.table.c.strm_closed:
+         RouterStats._totals(t.c.strm_closed, 0)}).execute()
+    RouterStats._compute_rates(stats_clause)
+
+    # No sqrt() in SQLite, so the stream bandwidths are done here.
+    sbws = []
+    for (idhex, n, tot, sq) in tc_session.execute(select([t.c.router_idhex,
+                 t.c.strm_closed, t.c.sbw_sum, t.c.sbw_sq_sum],
+                 t.c.strm_closed > 0)).fetchall():
+      sbw = tot/n
+      sbws.append({"r_idhex" : idhex, "sbw" : sbw,
+                   "sbw_dev" : math.sqrt(max(sq/n - sbw*sbw, 0))})
+    if sbws:
+      tc_session.execute(RouterStats.table.update(and_(stats_clause,
+            RouterStats.table.c.router_idhex == bindparam("r_idhex")),
+          values={RouterStats.table.c.sbw : bindparam("sbw"),
+                  RouterStats.table.c.sbw_dev : bindparam("sbw_dev")}),
+        sbws)
+    tc_session.commit()
+  _load_stats = Callable(_load_stats)
+
+  def check_totals(tolerance=1e-6):
+    """ Recompute the statistics from the full history and compare them
+    with the ones derived from RouterTotals. Returns a list of
+    (idhex, column, full value, incremental value) that differ by more
+    than 'tolerance' (relative). Leaves the full values in RouterStats. """
+    cols = ["min_rank", "avg_rank", "max_rank", "avg_bw", "avg_desc_bw",
+            "percentile", "circ_try_to", "circ_try_from", "circ_fail_to",
+            "circ_fail_from", "circ_from_rate", "circ_to_rate",
+            "circ_bi_rate", "avg_first_ext", "strm_try", "strm_closed",
+            "sbw", "sbw_dev"]
+    everything = RouterStats.table.c.router_idhex != None
+    def snapshot():
+      q = select([RouterStats.table.c.router_idhex]+
+                 map(lambda c: RouterStats.table.c[c], cols))
+      return dict(map(lambda r: (r[0], r[1:]),
+                      tc_session.execute(q).fetchall()))
+    RouterStats.reset()
+    RouterStats._load_ranks()
+    RouterStats._load_stats(everything)
+    incremental = snapshot()
+    RouterStats.reset()
+    RouterStats._compute_ranks()
+    RouterStats._compute_stats(everything)
+    full = snapshot()
+
+    diffs = []
+    for (idhex, vals) in full.iteritems():
+      ivals = incremental.get(idhex, (None,)*len(cols))
+      for i in xrange(len(cols)):
+        a, b = vals[i], ivals[i]
+        if a is None or b is None:
+          if a != b: diffs.append((idhex, cols[i], a, b))
+        elif abs(a-b) > tolerance*max(abs(a), abs(b), 1):
+          diffs.append((idhex, cols[i], a, b))
+    return diffs
+  check_totals = Callable(check_totals)
 
   def _compute_ratios(stats_clause):
-    tc_session.clear()
+    tc_session.expunge_all()
     avg_from_rate = select([func.avg(RouterStats.circ_from_rate)],
                            stats_clause).as_scalar()
     avg_to_rate = select([func.avg(RouterStats.circ_to_rate)],
@@ -475,18 +690,24 @@ class RouterStats(Entity):
   _compute_filtered_ratios = Callable(_compute_filtered_ratios)
 
   def reset():
-    tc_session.clear()
+    tc_session.expunge_all()
     RouterStats.table.drop()
     RouterStats.table.create()
-    for r in Router.query.all():
-      rs = RouterStats()
-      rs.router = r
-      r.stats = rs
-      tc_session.add(r)
+    ids = map(lambda r: r[0],
+              tc_session.execute(select([Router.table.c.idhex])).fetchall())
+    if ids:
+      tc_session.execute(RouterStats.table.insert(),
+                         map(lambda i: {"router_idhex" : i}, ids))
     tc_session.commit()
   reset = Callable(reset)
 
-  def compute(pct_low=0, pct_high=100, stat_clause=None, filter_clause=None):
+  def compute(pct_low=0, pct_high=100, stat_clause=None, filter_clause=None,
+              full=False):
+    """ Fill in RouterStats. Without a stat_clause the rank, circuit and
+    stream statistics come from RouterTotals; pass full=True (or a
+    stat_clause, which may restrict the individual Extension rows) to
+    rescan the whole history instead. """
+    if stat_clause is not None: full = True
     pct_clause = and_(RouterStats.percentile >= pct_low, 
                          RouterStats.percentile < pct_high)
     if stat_clause:
@@ -495,8 +716,12 @@ class RouterStats(Entity):
       stat_clause = pct_clause
      
     RouterStats.reset()
-    RouterStats._compute_ranks() # No filters. Ranks are independent
-    RouterStats._compute_stats(stat_clause)
+    if full:
+      RouterStats._compute_ranks() # No filters. Ranks are independent
+      RouterStats._compute_stats(stat_clause)
+    else:
+      RouterStats._load_ranks()
+      RouterStats._load_stats(stat_clause)
     RouterStats._compute_ratios(stat_clause)
     RouterStats._compute_filtered_ratios(MIN_RATIO, stat_clause, filter_clause)
     tc_session.commit()
@@ -623,6 +848,21 @@ class RouterStats(Entity):
 ##################### End Model ####################
 
 #################### Model Support ################
+
+# SQLite allows at most 999 bound parameters in one statement
+IN_CLAUSE_MAX = 500
+
+def select_by_idhex(columns, idhexes, key=None):
+  """ Returns the rows of 'columns' for the routers in 'idhexes', using
+  as few queries as the IN clause limit allows. 'key' is the idhex
+  column to match on, Router.table.c.idhex by default. """
+  if key is None: key = Router.table.c.idhex
+  idhexes = list(idhexes)
+  rows = []
+  for i in xrange(0, len(idhexes), IN_CLAUSE_MAX):
+    rows.extend(tc_session.execute(select(columns,
+          key.in_(idhexes[i:i+IN_CLAUSE_MAX]))).fetchall())
+  return rows
 def reset_all():
   # Need to keep routers around.. 
   for r in Router.query.all():
@@ -636,7 +876,7 @@ def reset_all():
     tc_session.add(r)
 
   tc_session.commit()
-  tc_session.clear()
+  tc_session.expunge_all()
 
   BwHistory.table.drop() # Will drop subclasses
   Extension.table.drop()
@@ -651,6 +891,7 @@ def reset_all():
   Circuit.table.create()
 
   tc_session.commit()
+  RouterTotals.reset()
 
   #for r in Router.query.all():
   #  if len(r.bw_history) or len(r.circuits) or len(r.streams) or r.stats:
@@ -658,6 +899,85 @@ def reset_all():
 
   plog("NOTICE", "Reset all SQL stats")
 
+class SQLWriter:
+  """
+  Runs database jobs on a dedicated thread, in the order they were
+  queued, so that slow writes do not hold up Tor event processing.
+
+  Jobs must only use the data they were handed, never live TorCtl
+  objects, since those keep changing underneath the writer. The thread
+  has its own tc_session (it is thread-local).
+
+  At most 'max_queued' jobs wait at once. put() never blocks the
+  caller (usually the event thread): if the queue is full, the job is
+  not queued, is counted in 'dropped' and put() returns False. Callers
+  that cannot lose data keep it and queue again later, as
+  ConsensusTrackerListener does. Use flush() to wait until everything
+  queued so far is in the database.
+  """
+  def __init__(self, max_queued=64):
+    self._jobs = Queue.Queue(max_queued)
+    self._thread = None
+    self._start_lock = threading.Lock()
+    self.dropped = 0
+
+  def _start(self):
+    self._start_lock.acquire()
+    try:
+      if not self._thread:
+        self._thread = threading.Thread(target=self._run,
+                                        name="SQLWriter")
+        self._thread.setDaemon(True)
+        self._thread.start()
+    finally:
+      self._start_lock.release()
+
+  def put(self, job, *args):
+    """ Queue job(*args) to run on the writer thread. Returns False if
+    the queue was full and the job was not queued. """
+    if not self._thread: self._start()
+    try:
+      self._jobs.put((job, args), False)
+    except Queue.Full:
+      self.dropped += 1
+      plog("WARN", "SQL writer is behind. Could not queue "+
+           getattr(job, "__name__", str(job))+" ("+str(self.dropped)+
+           " so far).")
+      return False
+    return True
+
+  def flush(self, timeout=None):
+    """ Wait until every job queued before this call has finished.
+    Returns False if 'timeout' seconds passed first. Unlike put(), this
+    waits for room in the queue, so only call it from a thread that can
+    afford to wait. """
+    if not self._thread: self._start()
+    done = threading.Event()
+    self._jobs.put((done.set, ()))
+    done.wait(timeout)
+    return done.isSet()
+
+  def close(self):
+    """ Finish the queued jobs and stop the writer thread. """
+    if not self._thread: return
+    self._jobs.put((None, ()))
+    self._thread.join()
+    self._thread = None
+
+  def _run(self):
+    while 1:
+      job, args = self._jobs.get()
+      if job is None:
+        tc_session.remove()
+        return
+      try:
+        job(*args)
+      except:
+        plog("ERROR", "SQL writer job "+getattr(job, "__name__", str(job))+
+             " failed")
+        traceback.print_exception(*sys.exc_info())
+        tc_session.rollback()
+
 ##################### End Model Support ####################
 
 class ConsensusTrackerListener(TorCtl.DualEventListener):
@@ -666,45 +986,159 @@ class ConsensusTrackerListener(TorCtl.DualEventListener):
     self.last_desc_at = time.time()+60 # Give tor some time to start up
     self.consensus = None
     self.wait_for_signal = False
+    self.writer = SQLWriter()
+    # Work waiting for the writer. Each kind has at most one job queued
+    # at a time, which writes everything pending when it runs, so a
+    # full queue delays the work rather than losing it.
+    self._pending_lock = threading.Lock()
+    self._counts = {}
+    self._counts_queued = False
+    self._history = []
+    self._history_queued = False
 
   CONSENSUS_DONE = 0x7fffffff
 
+  def flush(self, timeout=None):
+    """ Wait for queued rank history and RouterTotals counts to reach
+    the database. Call this before relying on BwHistory or RouterTotals.
+    """
+    self._queue_counts()
+    self._queue_history()
+    if not self.writer.flush(timeout): return False
+    if (self._counts and not self._counts_queued) or \
+       (self._history and not self._history_queued):
+      # The writer was too full to take them. It has caught up now.
+      self._queue_counts()
+      self._queue_history()
+      return self.writer.flush(timeout)
+    return True
+
+  def add_counts(self, idhex, **deltas):
+    """ Add each of 'deltas' to the RouterTotals of router 'idhex' on the
+    writer thread. Counts added before the writer gets to them are merged
+    into a single write. """
+    self._pending_lock.acquire()
+    try:
+      counts = self._counts.setdefault(idhex, {})
+      for (k, v) in deltas.iteritems():
+        counts[k] = counts.get(k, 0) + v
+    finally:
+      self._pending_lock.release()
+    self._queue_counts()
+
+  def _queue_counts(self):
+    """ Queue a _write_counts() job unless one is already waiting. If the
+    writer drops it, the counts stay here for the next call. """
+    self._pending_lock.acquire()
+    try:
+      if self._counts and not self._counts_queued:
+        self._counts_queued = self.writer.put(self._write_counts)
+    finally:
+      self._pending_lock.release()
+
+  def _write_counts(self):
+    """ Writer thread half of add_counts(). """
+    self._pending_lock.acquire()
+    try:
+      counts, self._counts = self._counts, {}
+      self._counts_queued = False
+    finally:
+      self._pending_lock.release()
+    for (idhex, deltas) in counts.iteritems():
+      RouterTotals.add_counts(idhex, **deltas)
+    tc_session.commit()
+
   # TODO: What about non-running routers and uptime information?
   def _update_rank_history(self, idlist):
-    plog("INFO", "Consensus change... Updating rank history")
+    """ Queue a BwHistory row for each running router in 'idlist'. The
+    rank and bandwidth are copied now, so the writer thread sees the
+    consensus as it was at this call. """
+    history = []
     for idhex in idlist:
       if idhex not in self.consensus.routers: continue
       rc = self.consensus.routers[idhex]
       if rc.down: continue
-      try:
-        r = Router.query.options(eagerload('bw_history')).filter_by(
-                                    idhex=idhex).with_labels().one()
-        bwh = BwHistory(router=r, rank=rc.list_rank, bw=rc.bw,
-                        desc_bw=rc.desc_bw, pub_time=r.published)
-        r.bw_history.append(bwh)
-        #tc_session.add(bwh)
-        tc_session.add(r)
-      except sqlalchemy.orm.exc.NoResultFound:
+      history.append((idhex, rc.list_rank, rc.bw, rc.desc_bw))
+    self._pending_lock.acquire()
+    try:
+      self._history.append(history)
+    finally:
+      self._pending_lock.release()
+    self._queue_history()
+
+  def _queue_history(self):
+    """ Queue a _write_rank_history() job unless one is already waiting.
+    If the writer is too far behind to take it, the snapshots stay here
+    for the next call. """
+    self._pending_lock.acquire()
+    try:
+      if self._history and not self._history_queued:
+        self._history_queued = self.writer.put(self._write_rank_history)
+        if not self._history_queued:
+          plog("NOTICE", str(len(self._history))+
+               " rank history snapshots are waiting for the SQL writer")
+    finally:
+      self._pending_lock.release()
+
+  def _write_rank_history(self):
+    """ Writer thread half of _update_rank_history(). Writes every
+    snapshot queued so far. """
+    self._pending_lock.acquire()
+    try:
+      snapshots, self._history = self._history, []
+      self._history_queued = False
+    finally:
+      self._pending_lock.release()
+    for history in snapshots:
+      self._write_history_rows(history)
+    tc_session.commit()
+
+  def _write_history_rows(self, history):
+    """ Insert the BwHistory rows of one snapshot with a single
+    executemany, and add them to RouterTotals. """
+    plog("INFO", "Consensus change... Updating rank history")
+    published = dict(select_by_idhex(
+                       [Router.table.c.idhex, Router.table.c.published],
+                       map(lambda h: h[0], history)))
+    rows = []
+    for (idhex, rank, bw, desc_bw) in history:
+      if idhex not in published:
         plog("WARN", "No descriptor found for consenus router "+str(idhex))
+        continue
+      rows.append({"router_idhex" : idhex, "rank" : rank, "bw" : bw,
+                   "desc_bw" : desc_bw, "pub_time" : published[idhex]})
+    if rows:
+      tc_session.execute(BwHistory.table.insert(), rows)
+      RouterTotals.add_history(rows)
 
     plog("INFO", "Consensus history updated.")
-    tc_session.commit()
 
   def _update_db(self, idlist):
     # FIXME: It is tempting to delay this as well, but we need
     # this info to be present immediately for circuit construction...
     plog("INFO", "Consensus change... Updating db")
-    for idhex in idlist:
-      if idhex in self.consensus.routers:
-        rc = self.consensus.routers[idhex]
-        r = Router.query.filter_by(idhex=rc.idhex).first()
-        if r and r.orhash == rc.orhash:
-          # We already have it stored. (Possible spurious NEWDESC)
-          continue
-        if not r: r = Router()
-        r.from_router(rc)
-        tc_session.add(r)
+    # A NEWDESC can list a router more than once
+    rcs = filter(lambda rc: rc, map(self.consensus.routers.get, set(idlist)))
+    stored = dict(select_by_idhex(
+                    [Router.table.c.idhex, Router.table.c.orhash],
+                    map(lambda rc: rc.idhex, rcs)))
+    inserts = []
+    updates = []
+    for rc in rcs:
+      if rc.idhex not in stored:
+        inserts.append(Router.columns_from(rc))
+      elif stored[rc.idhex] != rc.orhash:
+        cols = Router.columns_from(rc)
+        cols["old_idhex"] = rc.idhex
+        updates.append(cols)
+      # Otherwise we already have it stored. (Possible spurious NEWDESC)
+    if inserts:
+      tc_session.execute(Router.table.insert(), inserts)
+    if updates:
+      tc_session.execute(Router.table.update().where(
+             Router.table.c.idhex == bindparam("old_idhex")), updates)
     plog("INFO", "Consensus db updated")
+    # Also expires any Router objects already loaded into the session
     tc_session.commit()
 
   def update_consensus(self):
@@ -733,21 +1167,10 @@ class ConsensusTrackerListener(TorCtl.DualEventListener):
           tc_session.add(OP)
           tc_session.commit()
         self.update_consensus()
-      # XXX: This hack exists because update_rank_history is expensive.
-      # However, even if we delay it till the end of the consensus update, 
-      # it still delays event processing for up to 30 seconds on a fast 
-      # machine.
-      # 
-      # The correct way to do this is give SQL processing
-      # to a dedicated worker thread that pulls events off of a secondary
-      # queue, that way we don't block stream handling on this processing.
-      # The problem is we are pretty heavily burdened with the need to 
-      # stay in sync with our parent event handler. A queue will break this 
-      # coupling (even if we could get all the locking right).
-      #
-      # A lighterweight hack might be to just make the scanners pause
-      # on a condition used to signal we are doing this (and other) heavy 
-      # lifting. We could have them possibly check self.last_desc_at..
+      # update_rank_history is expensive, so we wait for the end of the
+      # consensus update and then hand a snapshot of the ranks to
+      # self.writer. Anything that needs the history in the database
+      # (the scanners) must call flush() first.
       if not self.wait_for_signal and e.arrived_at - self.last_desc_at > 60.0:
         if not PathSupport.PathBuilder.is_urgent_event(e):
           plog("INFO", "Newdesc timer is up. Assuming we have full consensus")
@@ -767,10 +1190,13 @@ class ConsensusTrackerListener(TorCtl.DualEventListener):
 
 class CircuitListener(TorCtl.PreEventListener):
   def set_parent(self, parent_handler):
-    if not filter(lambda f: f.__class__ == ConsensusTrackerListener, 
-                  parent_handler.post_listeners):
+    trackers = filter(lambda f: f.__class__ == ConsensusTrackerListener, 
+                      parent_handler.post_listeners)
+    if not trackers:
        raise TorCtlError("CircuitListener needs a ConsensusTrackerListener")
     TorCtl.PreEventListener.set_parent(self, parent_handler)
+    # RouterTotals are written on its SQLWriter thread
+    self.totals = trackers[0]
     # TODO: This is really lame. We only know the extendee of a circuit
     # if we have built the path ourselves. Otherwise, Tor keeps it a
     # secret from us. This prevents us from properly tracking failures
@@ -837,6 +1263,13 @@ class CircuitListener(TorCtl.PreEventListener):
       circ.extensions.append(e)
       tc_session.add(e)
       tc_session.add(circ)
+      if e.hop == 0:
+        self.totals.add_counts(e.to_node.idhex, circ_try_to=1,
+                               first_ext_count=1, first_ext_sum=e.delta)
+      else:
+        self.totals.add_counts(e.to_node.idhex, circ_try_to=1)
+      if e.from_node:
+        self.totals.add_counts(e.from_node.idhex, circ_try_from=1)
       tc_session.commit()
     elif c.status == "FAILED":
       circ = Circuit.query.filter_by(circ_id = c.circ_id).first()
@@ -879,6 +1312,12 @@ class CircuitListener(TorCtl.PreEventListener):
         circ.extensions.append(e)
         circ.fail_time = c.arrived_at
         tc_session.add(e)
+        if e.to_node:
+          self.totals.add_counts(e.to_node.idhex, circ_try_to=1,
+                                 circ_fail_to=1)
+        if e.from_node:
+          self.totals.add_counts(e.from_node.idhex, circ_try_from=1,
+                                 circ_fail_from=1)
 
       tc_session.add(circ)
       tc_session.commit()
@@ -918,6 +1357,13 @@ class CircuitListener(TorCtl.PreEventListener):
         tc_session.commit()
 
 class StreamListener(CircuitListener):
+  def set_parent(self, parent_handler):
+    CircuitListener.set_parent(self, parent_handler)
+    # strm_id -> idhexes of the routers the stream succeeded over, so a
+    # CLOSED event need not look them up again. Streams leave it when
+    # they close, fail or are detached.
+    self.stream_routers = {}
+
   def stream_bw_event(self, s):
     strm = Stream.query.filter_by(strm_id = s.strm_id).first()
     if strm and strm.start_time and strm.start_time < s.arrived_at:
@@ -985,16 +1431,21 @@ class StreamListener(CircuitListener):
     
     if s.status == "SUCCEEDED":
       strm.start_time = s.arrived_at
+      routers = self.stream_routers.setdefault(s.strm_id, set())
       for r in strm.circuit.routers: 
         plog("DEBUG", "Added router "+r.idhex+" to stream "+str(s.strm_id))
         r.streams.append(strm)
+        routers.add(r.idhex)
         tc_session.add(r)
+        self.totals.add_counts(r.idhex, strm_try=1)
       tc_session.add(strm)
       tc_session.commit()
     elif s.status == "DETACHED":
+      self.stream_routers.pop(s.strm_id, None)
       for r in strm.circuit.routers:
         r.detached_streams.append(strm)
         tc_session.add(r)
+        self.totals.add_counts(r.idhex, strm_try=1)
       #strm.detached_circuits.append(strm.circuit)
       strm.circuit.detached_streams.append(strm)
       strm.circuit.streams.remove(strm)
@@ -1002,6 +1453,7 @@ class StreamListener(CircuitListener):
       tc_session.add(strm)
       tc_session.commit()
     elif s.status == "FAILED":
+      self.stream_routers.pop(s.strm_id, None)
       strm.expunge()
       # Convert to destroyed circuit
       Stream.table.update(Stream.id ==
@@ -1012,6 +1464,7 @@ class StreamListener(CircuitListener):
       tc_session.add(strm)
       tc_session.commit()
     elif s.status == "CLOSED":
+      routers = self.stream_routers.pop(s.strm_id, ())
       if isinstance(strm, FailedStream):
         strm.close_reason = reason
       else:
@@ -1031,10 +1484,63 @@ class StreamListener(CircuitListener):
           strm.write_bandwidth = strm.tot_write_bytes/(s.arrived_at-strm.start_time)
           strm.end_time = s.arrived_at
           plog("DEBUG", "Stream "+str(strm.strm_id)+" xmitted "+str(strm.tot_bytes()))
+          bw = strm.bandwidth()
+          for idhex in routers:
+            self.totals.add_counts(idhex, strm_closed=1, sbw_sum=bw,
+                                   sbw_sq_sum=bw*bw)
         strm.close_reason = reason
       tc_session.add(strm)
       tc_session.commit()
 
+def do_rank_history_bench(db_uri, num_routers=2000, days=90, rounds=5):
+  """ Fill 'db_uri' with 'days' of hourly rank history for 'num_routers'
+  synthetic routers, then time further consensus updates on top of it.
+  Returns BwHistory rows inserted per second. """
+  import random
+  loglevel = TorUtil.loglevel
+  TorUtil.loglevel = "NOTICE"
+  setup_db(db_uri, drop=True)
+  published = datetime.datetime.utcnow()
+  if db_uri.startswith("sqlite"):
+    published = published.time() # SQLite's Time type wants a time
+  routers = {}
+  for i in xrange(num_routers):
+    r = TorCtl.Router("%040X" % i, "bench"+str(i),
+                      random.randint(20, 10000)*1024, False, [],
+                      ["Valid", "Running"], "10.%d.%d.1" % (i/250, i%250),
+                      "0.2.2.13", "Linux", 0, published, None, False,
+                      "%027d" % i, None)
+    routers[r.idhex] = r
+  listener = ConsensusTrackerListener()
+  listener.consensus = TorCtl.Consensus(routers, routers.values(), routers,
+                                        {})
+  listener._update_db(routers.iterkeys())
+
+  history = map(lambda r: (r.idhex, 0, r.bw, r.desc_bw), routers.values())
+  start = time.time()
+  for h in xrange(days*24):
+    listener._write_history_rows(history)
+  tc_session.commit()
+  elapsed = time.time() - start
+  print "Filled "+str(days*24*num_routers)+" rows of history in "+\
+        str(elapsed)+"s"
+
+  start = time.time()
+  for i in xrange(rounds):
+    for r in routers.itervalues():
+      r.bw = random.randint(20, 10000)*1024
+      r.orhash = "%027d" % random.getrandbits(64)
+    listener._update_db(routers.iterkeys())
+    listener._update_rank_history(routers.iterkeys())
+  listener.flush()
+  elapsed = time.time() - start
+  TorUtil.loglevel = loglevel
+  listener.writer.close()
+  rate = rounds*num_routers/max(elapsed, 1e-6)
+  print str(rounds)+" consensus updates of "+str(num_routers)+\
+        " routers in "+str(elapsed)+"s: "+str(rate)+" rows/sec"
+  return rate
+
 def run_example(host, port):
   """ Example of basic TorCtl usage. See PathSupport for more advanced
       usage.
@@ -1075,5 +1581,8 @@ def run_example(host, port):
 
   
 if __name__ == '__main__':
+  if len(sys.argv) > 1 and sys.argv[1] == "--bench":
+    do_rank_history_bench("sqlite:///rankbench.sqlite")
+    sys.exit(0)
   run_example(control_host,control_port)
 
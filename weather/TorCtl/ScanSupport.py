@@ -179,6 +179,7 @@ class SQLScanHandler(ScanHandler):
   def write_sql_stats(self, rfilename=None, stats_filter=None):
     if not rfilename:
       rfilename="./data/stats/sql-"+time.strftime("20%y-%m-%d-%H:%M:%S")
+    self.sql_consensus_listener.flush()
     cond = threading.Condition()
     def notlambda(h):
       cond.acquire()
@@ -195,6 +196,7 @@ class SQLScanHandler(ScanHandler):
   def write_strm_bws(self, rfilename=None, slice_num=0, stats_filter=None):
     if not rfilename:
       rfilename="./data/stats/bws-"+time.strftime("20%y-%m-%d-%H:%M:%S")
+    self.sql_consensus_listener.flush()
     cond = threading.Condition()
     def notlambda(this):
       cond.acquire()
@@ -215,6 +217,9 @@ class SQLScanHandler(ScanHandler):
     cond = threading.Condition()
     def notlambda(this):
       cond.acquire()
+      # Flush from the event thread: it is the only thread that queues
+      # writer jobs, so none can be queued between here and reset_all().
+      this.sql_consensus_listener.flush()
       SQLSupport.tc_session.close()
       try:
         shutil.copy(sql_file, new_file)
@@ -245,6 +250,7 @@ class SQLScanHandler(ScanHandler):
     self.schedule_low_prio(notlambda)
     cond.wait()
     cond.release()
+    self.sql_consensus_listener.flush()
     plog("INFO", "Consensus OK")
 
 
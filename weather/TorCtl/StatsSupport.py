@@ -44,6 +44,9 @@ import copy
 import time
 import math
 import traceback
+import collections
+import csv
+import json
 
 import TorUtil, PathSupport, TorCtl
 from TorUtil import *
@@ -111,8 +114,7 @@ class SuspectRouterList(ReasonRouterList):
   
   def sort_list(self):
     rlist = self.rlist.keys()
-    rlist.sort(lambda x, y: cmp(y.reason_suspected[self.reason],
-                  x.reason_suspected[self.reason]))
+    rlist.sort(key=lambda r: r.reason_suspected[self.reason], reverse=True)
     return rlist
    
   def _verify_suspected(self):
@@ -127,63 +129,68 @@ class FailedRouterList(ReasonRouterList):
 
   def sort_list(self):
     rlist = self.rlist.keys()
-    rlist.sort(lambda x, y: cmp(y.reason_failed[self.reason],
-                  x.reason_failed[self.reason]))
+    rlist.sort(key=lambda r: r.reason_failed[self.reason], reverse=True)
     return rlist
 
   def _verify_failed(self):
     return reduce(lambda x, y: x + y.reason_failed[self.reason],
             self.rlist.iterkeys(), 0)
 class BandwidthStats:
-  "Class that manages observed bandwidth through a Router"
-  def __init__(self):
-    self.byte_list = []
-    self.duration_list = []
+  """Class that manages observed bandwidth through a Router.
+
+  The byte-weighted mean and deviation are kept as running moments
+  (West's weighted form of Welford's update), so add_bw() is O(1).
+  The last 'sample_window' samples are kept in byte_list and
+  duration_list. The default of 0 keeps none."""
+  sample_window = 0
+
+  def __init__(self, sample_window=None):
+    if sample_window is None: sample_window = self.sample_window
+    self.sample_window = sample_window
+    self.byte_list = collections.deque(maxlen=sample_window)
+    self.duration_list = collections.deque(maxlen=sample_window)
     self.min_bw = 1e10
     self.max_bw = 0
     self.mean = 0
     self.dev = 0
+    self.count = 0
+    self.tot_bytes = 0.0 # Sum of the weights
+    self._m2 = 0.0 # Weighted sum of squared differences from the mean
 
   def _exp(self): # Weighted avg
     "Expectation - weighted average of the bandwidth through this node"
-    tot_bw = reduce(lambda x, y: x+y, self.byte_list, 0.0)
-    EX = 0.0
-    for i in xrange(len(self.byte_list)):
-      EX += (self.byte_list[i]*self.byte_list[i])/self.duration_list[i]
-    if tot_bw == 0.0: return 0.0
-    EX /= tot_bw
-    return EX
+    return self.mean
 
   def _exp2(self): # E[X^2]
     "Second moment of the bandwidth"
-    tot_bw = reduce(lambda x, y: x+y, self.byte_list, 0.0)
-    EX = 0.0
-    for i in xrange(len(self.byte_list)):
-      EX += (self.byte_list[i]**3)/(self.duration_list[i]**2)
-    if tot_bw == 0.0: return 0.0
-    EX /= tot_bw
-    return EX
+    if self.tot_bytes == 0.0: return 0.0
+    return self._m2/self.tot_bytes + self.mean*self.mean
     
   def _dev(self): # Weighted dev
     "Standard deviation of bandwidth"
-    EX = self.mean
-    EX2 = self._exp2()
-    arg = EX2 - (EX*EX)
-    if arg < -0.05:
-      plog("WARN", "Diff of "+str(EX2)+" and "+str(EX)+"^2 is "+str(arg))
-    return math.sqrt(abs(arg))
+    if self.tot_bytes == 0.0: return 0.0
+    # Rounding can leave _m2 just below zero
+    return math.sqrt(max(self._m2, 0.0)/self.tot_bytes)
 
   def add_bw(self, bytes, duration):
     "Add an observed transfer of 'bytes' for 'duration' seconds"
     if not bytes: plog("NOTICE", "No bytes for bandwidth")
     bytes /= 1024.
-    self.byte_list.append(bytes)
-    self.duration_list.append(duration)
+    if self.sample_window:
+      self.byte_list.append(bytes)
+      self.duration_list.append(duration)
     bw = bytes/duration
     plog("DEBUG", "Got bandwidth "+str(bw))
     if self.min_bw > bw: self.min_bw = bw
     if self.max_bw < bw: self.max_bw = bw
-    self.mean = self._exp()
+    self.count += 1
+    if bytes:
+      # Each sample is weighted by its size
+      self.tot_bytes += bytes
+      delta = bw - self.mean
+      self.mean += delta*bytes/self.tot_bytes
+      self._m2 += bytes*delta*(bw - self.mean)
+      if self._m2 < 0.0: self._m2 = 0.0
     self.dev = self._dev()
 
 
@@ -380,6 +387,31 @@ class StatsRouter(TorCtl.Router):
       +" SR="+(str(round(self.strm_bw_ratio(),1)))
       +" U="+str(round(self.current_uptime()/3600, 1))+"\n")
 
+  # Columns of stat_row(), named after the keys above and in
+  # StatsHandler.ratio_key
+  stat_fields = ["idhex", "nickname", "CC", "CF", "CS", "SC", "SF", "SS",
+                 "FH", "SH", "ET", "EB", "BD", "ZB", "PB", "BR", "ZR", "PR",
+                 "SR", "AR", "BRR", "CSR", "CFR", "SSR", "SFR", "U", "P"]
+
+  def stat_row(self, nrouters):
+    """Return the values of stat_fields for this router. 'nrouters' is
+       the number of routers its rank is a percentile of"""
+    uptime = self.current_uptime()
+    return [self.idhex, self.nickname,
+      self.circ_chosen, self.circ_failed,
+      self.circ_suspected+self.circ_failed,
+      self.strm_chosen, self.strm_failed,
+      self.strm_suspected+self.strm_failed,
+      (3600.*(self.circ_failed+self.strm_failed))/uptime,
+      (3600.*(self.circ_suspected+self.strm_suspected
+          +self.circ_failed+self.strm_failed))/uptime,
+      self.avg_extend_time(), self.bwstats.mean, self.bwstats.dev,
+      self.z_bw, self.prob_zb, self.bw_ratio(), self.z_ratio, self.prob_zr,
+      self.strm_bw_ratio(), self.adv_ratio(), self.bw_ratio_ratio(),
+      self.circ_suspect_ratio(), self.circ_fail_ratio(),
+      self.strm_suspect_ratio(), self.strm_fail_ratio(),
+      uptime/3600, (100.0*self.avg_rank())/nrouters]
+
   def sanity_check(self):
     "Makes sure all stats are self-consistent"
     if (self.circ_failed + self.circ_succeeded + self.circ_suspected
@@ -429,21 +461,26 @@ class StatsHandler(PathSupport.PathBuilder):
     self.suspect_reasons = {}
     self.track_ranks = track_ranks
 
-  # XXX: Shit, all this stuff should be slice-based
+  def _ztest(self, values):
+    """Mean and standard deviation of the positive entries of 'values',
+       which holds one metric for each router in sorted_r"""
+    pos = filter(lambda v: v > 0, values)
+    n = len(pos)
+    if n == 0: return (0, 0)
+    avg = sum(values)/float(n)
+    stddev = math.sqrt(sum(map(lambda v: (v-avg)*(v-avg), pos))/float(n))
+    return (avg, stddev)
+
   def run_zbtest(self): # Unweighted z-test
     """Run unweighted z-test to calculate the probabilities of a node
        having a given stream bandwidth based on the Normal distribution"""
-    n = reduce(lambda x, y: x+(y.bwstats.mean > 0), self.sorted_r, 0)
-    if n == 0: return (0, 0)
-    avg = reduce(lambda x, y: x+y.bwstats.mean, self.sorted_r, 0)/float(n)
-    def notlambda(x, y):
-      if y.bwstats.mean <= 0: return x+0
-      else: return x+(y.bwstats.mean-avg)*(y.bwstats.mean-avg)
-    stddev = math.sqrt(reduce(notlambda, self.sorted_r, 0)/float(n))
+    means = map(lambda r: r.bwstats.mean, self.sorted_r)
+    (avg, stddev) = self._ztest(means)
     if not stddev: return (avg, stddev)
-    for r in self.sorted_r:
-      if r.bwstats.mean > 0:
-        r.z_bw = abs((r.bwstats.mean-avg)/stddev)
+    for i in xrange(len(means)):
+      if means[i] > 0:
+        r = self.sorted_r[i]
+        r.z_bw = abs((means[i]-avg)/stddev)
         r.prob_zb = TorUtil.zprob(-r.z_bw)
     return (avg, stddev)
 
@@ -451,54 +488,53 @@ class StatsHandler(PathSupport.PathBuilder):
     """Run unweighted z-test to calculate the probabilities of a node
        having a given ratio of stream bandwidth to advertised bandwidth
        based on the Normal distribution"""
-    n = reduce(lambda x, y: x+(y.bw_ratio() > 0), self.sorted_r, 0)
-    if n == 0: return (0, 0)
-    avg = reduce(lambda x, y: x+y.bw_ratio(), self.sorted_r, 0)/float(n)
-    def notlambda(x, y):
-      if y.bw_ratio() <= 0: return x+0
-      else: return x+(y.bw_ratio()-avg)*(y.bw_ratio()-avg)
-    stddev = math.sqrt(reduce(notlambda, self.sorted_r, 0)/float(n))
+    ratios = map(lambda r: r.bw_ratio(), self.sorted_r)
+    (avg, stddev) = self._ztest(ratios)
     if not stddev: return (avg, stddev)
-    for r in self.sorted_r:
-      if r.bw_ratio() > 0:
-        r.z_ratio = abs((r.bw_ratio()-avg)/stddev)
+    for i in xrange(len(ratios)):
+      if ratios[i] > 0:
+        r = self.sorted_r[i]
+        r.z_ratio = abs((ratios[i]-avg)/stddev)
         r.prob_zr = TorUtil.zprob(-r.z_ratio)
     return (avg, stddev)
 
+  def _avg_used(self, stat):
+    "Average of 'stat' over the routers that were used this round"
+    used = filter(lambda r: r.was_used(), self.sorted_r)
+    if not used: return (0, 0)
+    return sum(map(stat, used))/float(len(used))
+
   def avg_adv_bw(self):
-    n = reduce(lambda x, y: x+y.was_used(), self.sorted_r, 0)
-    if n == 0: return (0, 0)
-    avg = reduce(lambda x, y: x+y.bw, 
-            filter(lambda r: r.was_used(), self.sorted_r), 0)/float(n)
-    return avg 
+    return self._avg_used(lambda r: r.bw)
 
   def avg_circ_failure(self):
-    n = reduce(lambda x, y: x+y.was_used(), self.sorted_r, 0)
-    if n == 0: return (0, 0)
-    avg = reduce(lambda x, y: x+y.circ_fail_rate(), 
-            filter(lambda r: r.was_used(), self.sorted_r), 0)/float(n)
-    return avg 
+    return self._avg_used(lambda r: r.circ_fail_rate())
 
   def avg_stream_failure(self):
-    n = reduce(lambda x, y: x+y.was_used(), self.sorted_r, 0)
-    if n == 0: return (0, 0)
-    avg = reduce(lambda x, y: x+y.strm_fail_rate(), 
-            filter(lambda r: r.was_used(), self.sorted_r), 0)/float(n)
-    return avg 
+    return self._avg_used(lambda r: r.strm_fail_rate())
 
   def avg_circ_suspects(self):
-    n = reduce(lambda x, y: x+y.was_used(), self.sorted_r, 0)
-    if n == 0: return (0, 0)
-    avg = reduce(lambda x, y: x+y.circ_suspect_rate(), 
-            filter(lambda r: r.was_used(), self.sorted_r), 0)/float(n)
-    return avg 
+    return self._avg_used(lambda r: r.circ_suspect_rate())
 
   def avg_stream_suspects(self):
-    n = reduce(lambda x, y: x+y.was_used(), self.sorted_r, 0)
-    if n == 0: return (0, 0)
-    avg = reduce(lambda x, y: x+y.strm_suspect_rate(), 
-            filter(lambda r: r.was_used(), self.sorted_r), 0)/float(n)
-    return avg 
+    return self._avg_used(lambda r: r.strm_suspect_rate())
+
+  def update_globals(self):
+    "Recompute the network-wide averages the StatsRouter ratios use"
+    (avg, dev) = self.run_zbtest()
+    StatsRouter.global_strm_mean = avg
+    StatsRouter.global_strm_dev = dev
+    (avg, dev) = self.run_zrtest()
+    StatsRouter.global_ratio_mean = avg
+    StatsRouter.global_ratio_dev = dev
+
+    StatsRouter.global_bw_mean = self.avg_adv_bw()
+
+    StatsRouter.global_cf_mean = self.avg_circ_failure()
+    StatsRouter.global_sf_mean = self.avg_stream_failure()
+    
+    StatsRouter.global_cs_mean = self.avg_circ_suspects()
+    StatsRouter.global_ss_mean = self.avg_stream_suspects()
 
   def write_reasons(self, f, reasons, name):
     "Write out all the failure reasons and statistics for all Routers"
@@ -508,12 +544,15 @@ class StatsHandler(PathSupport.PathBuilder):
           +", Suspected: "+str(rsn.total_suspected())+"\n")
       rsn.write_list(f)
 
-  def write_routers(self, f, rlist, name):
-    "Write out all the usage statistics for all Routers"
+  def write_routers(self, f, rlist, name, text=None):
+    """Write out all the usage statistics for all Routers. 'text' can map
+       Routers to their already formatted statistics"""
     f.write("\n\n\t----------------- "+name+" -----------------\n\n")
     for r in rlist:
       # only print it if we've used it.
-      if r.circ_chosen+r.strm_chosen > 0: f.write(str(r))
+      if r.circ_chosen+r.strm_chosen > 0:
+        if text is None: f.write(str(r))
+        else: f.write(text[r])
 
   # FIXME: Maybe move this two up into StatsRouter too?
   ratio_key = """Metatroller Ratio Statistics:
@@ -528,28 +567,35 @@ class StatsHandler(PathSupport.PathBuilder):
     f = file(filename, "w")
     f.write(StatsHandler.ratio_key)
 
-    (avg, dev) = self.run_zbtest()
-    StatsRouter.global_strm_mean = avg
-    StatsRouter.global_strm_dev = dev
-    (avg, dev) = self.run_zrtest()
-    StatsRouter.global_ratio_mean = avg
-    StatsRouter.global_ratio_dev = dev
-
-    StatsRouter.global_bw_mean = self.avg_adv_bw()
-
-    StatsRouter.global_cf_mean = self.avg_circ_failure()
-    StatsRouter.global_sf_mean = self.avg_stream_failure()
-    
-    StatsRouter.global_cs_mean = self.avg_circ_suspects()
-    StatsRouter.global_ss_mean = self.avg_stream_suspects()
+    self.update_globals()
 
-    strm_bw_ratio = copy.copy(self.sorted_r)
-    strm_bw_ratio.sort(lambda x, y: cmp(x.strm_bw_ratio(), y.strm_bw_ratio()))
+    strm_bw_ratio = sorted(self.sorted_r, key=lambda r: r.strm_bw_ratio())
     for r in strm_bw_ratio:
       if r.circ_chosen == 0: continue
       f.write(r.idhex+"="+r.nickname+"\n  ")
       f.write("SR="+str(round(r.strm_bw_ratio(),4))+" AR="+str(round(r.adv_ratio(), 4))+" BRR="+str(round(r.bw_ratio_ratio(),4))+" CSR="+str(round(r.circ_suspect_ratio(),4))+" CFR="+str(round(r.circ_fail_ratio(),4))+" SSR="+str(round(r.strm_suspect_ratio(),4))+" SFR="+str(round(r.strm_fail_ratio(),4))+" CC="+str(r.circ_chosen)+" SC="+str(r.strm_chosen)+" U="+str(round(r.current_uptime()/3600,1))+" P="+str(round((100.0*r.avg_rank())/len(self.sorted_r),1))+"\n")
     f.close()
+
+  def write_table(self, filename, format="csv"):
+    """Write the statistics of every used Router to 'filename', one row
+       at a time, as CSV with a header of StatsRouter.stat_fields or as
+       one JSON object per line (format="json")"""
+    plog("DEBUG", "Writing "+format+" stats to "+filename)
+    if format not in ("csv", "json"):
+      raise ValueError("Unknown stats format "+format)
+    self.update_globals()
+    f = file(filename, "w")
+    if format == "csv":
+      writer = csv.writer(f)
+      writer.writerow(StatsRouter.stat_fields)
+      write_row = writer.writerow
+    else:
+      def write_row(row):
+        f.write(json.dumps(dict(zip(StatsRouter.stat_fields, row)))+"\n")
+    nrouters = len(self.sorted_r)
+    for r in self.sorted_r:
+      if r.circ_chosen+r.strm_chosen > 0: write_row(r.stat_row(nrouters))
+    f.close()
  
   def write_stats(self, filename):
     "Write out all the statistics the StatsHandler has gathered"
@@ -597,58 +643,56 @@ class StatsHandler(PathSupport.PathBuilder):
             +"/"+str(self.strm_count)+"\n")
 
     # Extend times 
-    n = 0.01+reduce(lambda x, y: x+(y.avg_extend_time() > 0), self.sorted_r, 0)
-    avg_extend = reduce(lambda x, y: x+y.avg_extend_time(), self.sorted_r, 0)/n
-    def notlambda(x, y):
-      return x+(y.avg_extend_time()-avg_extend)*(y.avg_extend_time()-avg_extend) 
-    dev_extend = math.sqrt(reduce(notlambda, self.sorted_r, 0)/float(n))
+    extend = map(lambda r: r.avg_extend_time(), self.sorted_r)
+    n = 0.01+len(filter(lambda e: e > 0, extend))
+    avg_extend = sum(extend)/n
+    dev_extend = math.sqrt(sum(map(lambda e: (e-avg_extend)*(e-avg_extend),
+                                   extend))/float(n))
 
     f.write("Extend time: u="+str(round(avg_extend,1))
              +" s="+str(round(dev_extend,1)))
     
     # sort+print by bandwidth
-    strm_bw_ratio = copy.copy(self.sorted_r)
-    strm_bw_ratio.sort(lambda x, y: cmp(x.strm_bw_ratio(), y.strm_bw_ratio()))
-    self.write_routers(f, strm_bw_ratio, "Stream Ratios")
+    # Every section lists the same routers, so format them only once
+    text = {}
+    for r in self.sorted_r:
+      if r.circ_chosen+r.strm_chosen > 0: text[r] = str(r)
+
+    # Sorting by key evaluates each stat once per router
+    strm_bw_ratio = sorted(self.sorted_r, key=lambda r: r.strm_bw_ratio())
+    self.write_routers(f, strm_bw_ratio, "Stream Ratios", text)
 
     # sort+print by bandwidth
-    bw_rate = copy.copy(self.sorted_r)
-    bw_rate.sort(lambda x, y: cmp(y.bw_ratio(), x.bw_ratio()))
-    self.write_routers(f, bw_rate, "Bandwidth Ratios")
-
-    failed = copy.copy(self.sorted_r)
-    failed.sort(lambda x, y:
-          cmp(y.circ_failed+y.strm_failed,
-            x.circ_failed+x.strm_failed))
-    self.write_routers(f, failed, "Failed Counts")
-
-    suspected = copy.copy(self.sorted_r)
-    suspected.sort(lambda x, y: # Suspected includes failed
-       cmp(y.circ_failed+y.strm_failed+y.circ_suspected+y.strm_suspected,
-         x.circ_failed+x.strm_failed+x.circ_suspected+x.strm_suspected))
-    self.write_routers(f, suspected, "Suspected Counts")
-
-    fail_rate = copy.copy(failed)
-    fail_rate.sort(lambda x, y: cmp(y.failed_per_hour(), x.failed_per_hour()))
-    self.write_routers(f, fail_rate, "Fail Rates")
-
-    suspect_rate = copy.copy(suspected)
-    suspect_rate.sort(lambda x, y:
-       cmp(y.suspected_per_hour(), x.suspected_per_hour()))
-    self.write_routers(f, suspect_rate, "Suspect Rates")
+    bw_rate = sorted(self.sorted_r, key=lambda r: r.bw_ratio(), reverse=True)
+    self.write_routers(f, bw_rate, "Bandwidth Ratios", text)
+
+    failed = sorted(self.sorted_r, key=lambda r: r.circ_failed+r.strm_failed,
+                    reverse=True)
+    self.write_routers(f, failed, "Failed Counts", text)
+
+    suspected = sorted(self.sorted_r, # Suspected includes failed
+       key=lambda r: r.circ_failed+r.strm_failed+r.circ_suspected
+                       +r.strm_suspected, reverse=True)
+    self.write_routers(f, suspected, "Suspected Counts", text)
+
+    fail_rate = sorted(failed, key=lambda r: r.failed_per_hour(),
+                       reverse=True)
+    self.write_routers(f, fail_rate, "Fail Rates", text)
+
+    suspect_rate = sorted(suspected, key=lambda r: r.suspected_per_hour(),
+                          reverse=True)
+    self.write_routers(f, suspect_rate, "Suspect Rates", text)
     
     # TODO: Sort by failed/selected and suspect/selected ratios
     # if we ever want to do non-uniform scanning..
 
     # FIXME: Add failed in here somehow..
-    susp_reasons = self.suspect_reasons.values()
-    susp_reasons.sort(lambda x, y:
-       cmp(y.total_suspected(), x.total_suspected()))
+    susp_reasons = sorted(self.suspect_reasons.values(),
+                          key=lambda x: x.total_suspected(), reverse=True)
     self.write_reasons(f, susp_reasons, "Suspect Reasons")
 
-    fail_reasons = self.failed_reasons.values()
-    fail_reasons.sort(lambda x, y:
-       cmp(y.total_failed(), x.total_failed()))
+    fail_reasons = sorted(self.failed_reasons.values(),
+                          key=lambda x: x.total_failed(), reverse=True)
     self.write_reasons(f, fail_reasons, "Failed Reasons")
     f.close()
 
@@ -22,13 +22,13 @@ classes and constants for each event.
 """
 
 __all__ = ["EVENT_TYPE", "TorCtlError", "TorCtlClosed", "ProtocolError",
-           "ErrorReply", "NetworkStatus", "ExitPolicyLine", "Router",
-           "RouterVersion", "Connection", "parse_ns_body",
+           "ErrorReply", "NetworkStatus", "ExitPolicyLine", "ExitPolicy",
+           "Router", "RouterVersion", "Connection", "parse_ns_body",
            "EventHandler", "DebugEventHandler", "NetworkStatusEvent",
            "NewDescEvent", "CircuitEvent", "StreamEvent", "ORConnEvent",
            "StreamBwEvent", "LogEvent", "AddrMapEvent", "BWEvent",
            "BuildTimeoutSetEvent", "UnknownEvent", "ConsensusTracker",
-           "EventListener", "EVENT_STATE" ]
+           "SortedRouterList", "EventListener", "EVENT_STATE" ]
 
 import os
 import re
@@ -43,6 +43,8 @@ import binascii
 import types
 import time
 import copy
+import bisect
+import itertools
 
 from TorUtil import *
 
@@ -79,6 +81,133 @@ EVENT_STATE = Enum2(
           POSTLISTEN="POSTLISTEN",
           DONE="DONE")
 
+# Most events the event thread will take off its queue at once
+EVENT_BATCH_SIZE = 64
+
+# Default upper bounds, in seconds, of the CallTracer latency buckets
+TRACE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                 0.25, 0.5, 1, 2.5, 5, 10)
+
+class TracedCall:
+  """One command sent on a Connection and its reply, as seen by a
+     CallTracer."""
+  def __init__(self, started, command, keys, sent, received, latency):
+    self.started = started
+    self.command = command
+    self.keys = keys
+    self.sent = sent
+    self.received = received
+    self.latency = latency
+
+  def __str__(self):
+    return "%s %s keys=%d sent=%d received=%d latency=%.6f" % (
+      time.strftime("%H:%M:%S", time.localtime(self.started)), self.command,
+      self.keys, self.sent, self.received, self.latency)
+
+class CallTracer:
+  """Records the commands sent on a Connection: the command, the number of
+     keys it asks about, the bytes sent and received, and the round-trip
+     latency. Every call is counted into a latency histogram for its
+     command, and the slowest calls are kept. One call in 'sample' is also
+     kept in a ring buffer of the last 'size' sampled calls.
+     Attach one with Connection.trace()."""
+  def __init__(self, size=1000, sample=1, slowest=50, buckets=TRACE_BUCKETS):
+    self.size = size
+    self.sample = sample
+    self.keep_slowest = slowest
+    self.buckets = tuple(buckets)
+    self.calls = []
+    self.histograms = {}
+    self._slowest = []
+    self._next = 0
+    self._seen = 0
+    self._lock = threading.Lock()
+
+  def record(self, call):
+    "Count a TracedCall 'call' into the histograms, buffer and slowest."
+    self._lock.acquire()
+    try:
+      hist = self.histograms.get(call.command)
+      if hist is None:
+        # bucket counts, then the sum and count of all latencies
+        hist = self.histograms[call.command] = [0]*len(self.buckets)+[0.0, 0]
+      i = bisect.bisect_left(self.buckets, call.latency)
+      if i < len(self.buckets):
+        hist[i] += 1
+      hist[-2] += call.latency
+      hist[-1] += 1
+
+      if self._seen % self.sample == 0 and self.size:
+        if len(self.calls) < self.size:
+          self.calls.append(call)
+        else:
+          self.calls[self._next] = call
+        self._next = (self._next + 1) % self.size
+      self._seen += 1
+
+      if len(self._slowest) < self.keep_slowest:
+        bisect.insort(self._slowest, (call.latency, call))
+      elif self._slowest and call.latency > self._slowest[0][0]:
+        self._slowest.pop(0)
+        bisect.insort(self._slowest, (call.latency, call))
+    finally:
+      self._lock.release()
+
+  def recent(self):
+    "Returns the sampled calls in the ring buffer, oldest first."
+    self._lock.acquire()
+    try:
+      if len(self.calls) < self.size:
+        return list(self.calls)
+      return self.calls[self._next:] + self.calls[:self._next]
+    finally:
+      self._lock.release()
+
+  def slowest(self, n=10):
+    "Returns the n slowest calls seen, slowest first."
+    self._lock.acquire()
+    try:
+      return [call for latency, call in self._slowest[::-1][:n]]
+    finally:
+      self._lock.release()
+
+  def dump_slowest(self, f, n=10):
+    "Writes the n slowest calls seen to the file 'f', one per line."
+    for call in self.slowest(n):
+      f.write(str(call)+"\n")
+
+  def summary(self):
+    """Returns a list of (command, calls, total seconds, buckets) tuples,
+       busiest first. 'buckets' is a list of (upper bound, cumulative
+       count) pairs, ending with (None, calls)."""
+    self._lock.acquire()
+    try:
+      r = []
+      for command, hist in self.histograms.iteritems():
+        buckets = []
+        seen = 0
+        for bound, count in zip(self.buckets, hist):
+          seen += count
+          buckets.append((bound, seen))
+        buckets.append((None, hist[-1]))
+        r.append((command, hist[-1], hist[-2], buckets))
+      r.sort(key=lambda s: -s[2])
+      return r
+    finally:
+      self._lock.release()
+
+  def reset(self):
+    "Forget every call."
+    self._lock.acquire()
+    try:
+      self.calls = []
+      self.histograms = {}
+      self._slowest = []
+      self._next = 0
+      self._seen = 0
+    finally:
+      self._lock.release()
+
 class TorCtlError(Exception):
   "Generic error raised by TorControl code."
   pass
@@ -116,6 +245,17 @@ class Event:
     self.arrived_at = 0
     self.state = EVENT_STATE.PRISTINE
 
+  def __getattr__(self, name):
+    # Only called for attributes that are not set yet: parse the fields
+    # of an event created by _lazy_event() on first use.
+    if name.startswith("__") or "_unparsed" not in self.__dict__:
+      raise AttributeError(name)
+    body = self.__dict__.pop("_unparsed")
+    parsed = _lazy_events[self.event_name][1](self.event_name, body)
+    for k, v in parsed.__dict__.iteritems():
+      if k not in self.__dict__: self.__dict__[k] = v
+    return getattr(self, name)
+
 class TimerEvent(Event):
   def __init__(self, event_name, type):
     Event.__init__(self, event_name)
@@ -231,6 +371,110 @@ class UnknownEvent(Event):
     Event.__init__(self, event_name)
     self.event_string = event_string
 
+def _parse_circ_event(evtype, body):
+  m = re.match(r"(\d+)\s+(\S+)(\s\S+)?(\s\S+)?(\s\S+)?(\s\S+)?", body)
+  if not m:
+    raise ProtocolError("CIRC event misformatted.")
+  ident,status,path,purpose,reason,remote = m.groups()
+  ident = int(ident)
+  if path:
+    if "PURPOSE=" in path:
+      remote = reason
+      reason = purpose
+      purpose=path
+      path=[]
+    elif "REASON=" in path:
+      remote = reason
+      reason = path
+      purpose = ""
+      path=[]
+    else:
+      path_verb = path.strip().split(",")
+      path = []
+      for p in path_verb:
+        path.append(p.replace("~", "=").split("=")[0])
+  else:
+    path = []
+
+  if purpose and "REASON=" in purpose:
+    remote=reason
+    reason=purpose
+    purpose=""
+
+  if purpose: purpose = purpose[9:]
+  if reason: reason = reason[8:]
+  if remote: remote = remote[15:]
+  return CircuitEvent(evtype, ident, status, path, purpose, reason, remote)
+
+def _parse_stream_event(evtype, body):
+  #plog("DEBUG", "STREAM: "+body)
+  m = re.match(r"(\S+)\s+(\S+)\s+(\S+)\s+(\S+)?:(\d+)(\sREASON=\S+)?(\sREMOTE_REASON=\S+)?(\sSOURCE=\S+)?(\sSOURCE_ADDR=\S+)?(\s+PURPOSE=\S+)?", body)
+  if not m:
+    raise ProtocolError("STREAM event misformatted.")
+  ident,status,circ,target_host,target_port,reason,remote,source,source_addr,purpose = m.groups()
+  ident,circ = map(int, (ident,circ))
+  if not target_host: # This can happen on SOCKS_PROTOCOL failures
+    target_host = "(none)"
+  if reason: reason = reason[8:]
+  if remote: remote = remote[15:]
+  if source: source = source[8:]
+  if source_addr: source_addr = source_addr[13:]
+  if purpose:
+    purpose = purpose.lstrip()
+    purpose = purpose[8:]
+  return StreamEvent(evtype, ident, status, circ, target_host,
+           int(target_port), reason, remote, source, source_addr, purpose)
+
+def _parse_orconn_event(evtype, body):
+  m = re.match(r"(\S+)\s+(\S+)(\sAGE=\S+)?(\sREAD=\S+)?(\sWRITTEN=\S+)?(\sREASON=\S+)?(\sNCIRCS=\S+)?", body)
+  if not m:
+    raise ProtocolError("ORCONN event misformatted.")
+  target, status, age, read, wrote, reason, ncircs = m.groups()
+
+  #plog("DEBUG", "ORCONN: "+body)
+  if ncircs: ncircs = int(ncircs[8:])
+  else: ncircs = 0
+  if reason: reason = reason[8:]
+  if age: age = int(age[5:])
+  else: age = 0
+  if read: read = int(read[6:])
+  else: read = 0
+  if wrote: wrote = int(wrote[9:])
+  else: wrote = 0
+  return ORConnEvent(evtype, status, target, age, read, wrote,
+            reason, ncircs)
+
+def _parse_stream_bw_event(evtype, body):
+  m = re.match(r"(\d+)\s+(\d+)\s+(\d+)", body)
+  if not m:
+    raise ProtocolError("STREAM_BW event misformatted.")
+  return StreamBwEvent(evtype, *m.groups())
+
+def _parse_bw_event(evtype, body):
+  m = re.match(r"(\d+)\s+(\d+)", body)
+  if not m:
+    raise ProtocolError("BANDWIDTH event misformatted.")
+  read, written = map(long, m.groups())
+  return BWEvent(evtype, read, written)
+
+# High-volume events that EventHandler._decode1() may leave unparsed
+# until a field is read. Maps event name to (class, parser).
+_lazy_events = {
+  "CIRC" : (CircuitEvent, _parse_circ_event),
+  "STREAM" : (StreamEvent, _parse_stream_event),
+  "ORCONN" : (ORConnEvent, _parse_orconn_event),
+  "STREAM_BW" : (StreamBwEvent, _parse_stream_bw_event),
+  "BW" : (BWEvent, _parse_bw_event)
+  }
+
+def _lazy_event(evtype, body):
+  """ Returns an instance of the Event subclass for 'evtype' that only
+  parses 'body' when one of its fields is first read. """
+  event = types.InstanceType(_lazy_events[evtype][0])
+  Event.__init__(event, evtype)
+  event._unparsed = body
+  return event
+
 class ExitPolicyLine:
   """ Class to represent a line in a Router's exit policy in a way 
       that can be easily checked. """
@@ -279,6 +523,135 @@ class ExitPolicyLine:
     retr += str(self.port_low)+"-"+str(self.port_high)
     return retr
 
+class ExitPolicy:
+  """ Compiled form of a list of ExitPolicyLines. The port space is split
+      into disjoint ranges at every line boundary, and each range gets a
+      sorted table of address ranges with the first-match result already
+      resolved. will_exit_to() is then two bisects instead of a walk over
+      every line. Also caches whether the policy exits to the web ports. """
+  _accept_re = re.compile(r"^accept (\S+):([^-]+)(?:-(\d+))?")
+  _reject_re = re.compile(r"^reject (\S+):([^-]+)(?:-(\d+))?")
+
+  def __init__(self, lines):
+    self.lines = lines
+    self.port_starts = []
+    self.port_tables = []
+    self.port_accepts = []
+    self.compiled = True
+    for line in lines:
+      mask = line.netmask & 0xFFFFFFFF
+      inv = ~mask & 0xFFFFFFFF
+      if inv & (inv + 1):
+        # Non-contiguous netmask. Can't be expressed as one address range.
+        self.compiled = False
+        break
+    if self.compiled:
+      self._compile()
+    self.web_exit = self.will_exit_to_port(80) or self.will_exit_to_port(443)
+
+  def build_from_desc(desc):
+    """ Static method that builds an ExitPolicy from the accept/reject
+        lines of a descriptor. 'desc' is a list of descriptor lines. """
+    lines = []
+    for line in desc:
+      ac = ExitPolicy._accept_re.search(line)
+      if ac:
+        lines.append(ExitPolicyLine(True, *ac.groups()))
+        continue
+      rj = ExitPolicy._reject_re.search(line)
+      if rj:
+        lines.append(ExitPolicyLine(False, *rj.groups()))
+    return ExitPolicy(lines)
+  build_from_desc = Callable(build_from_desc)
+
+  def _compile(self):
+    bounds = set([0])
+    for line in self.lines:
+      bounds.add(line.port_low)
+      if line.port_high < 65535:
+        bounds.add(line.port_high+1)
+    self.port_starts = sorted(bounds)
+    for i in xrange(len(self.port_starts)):
+      port = self.port_starts[i]
+      # Every port in this range is covered by exactly the same lines
+      covering = []
+      accepts = None
+      for line in self.lines:
+        if line.port_low <= port <= line.port_high:
+          covering.append(line)
+          if accepts is None and line.netmask & 0xFFFFFFFF == 0:
+            accepts = line.match
+          if line.netmask & 0xFFFFFFFF == 0:
+            break # Nothing after a wildcard line can ever match
+      self.port_tables.append(self._compile_addrs(covering))
+      self.port_accepts.append(bool(accepts))
+
+  def _compile_addrs(self, lines):
+    """ Resolve first-match over 'lines' into sorted, disjoint address
+        ranges. Returns (starts, results), where results[i] applies from
+        starts[i] up to starts[i+1]-1 and is None if no line matched. """
+    painted = [] # sorted, disjoint (lo, hi, match)
+    for line in lines:
+      mask = line.netmask & 0xFFFFFFFF
+      lo = line.ip & mask
+      hi = lo | (~mask & 0xFFFFFFFF)
+      gaps = []
+      cur = lo
+      for (plo, phi, pm) in painted:
+        if phi < cur: continue
+        if plo > hi: break
+        if plo > cur:
+          gaps.append((cur, plo-1, line.match))
+        cur = phi+1
+        if cur > hi: break
+      if cur <= hi:
+        gaps.append((cur, hi, line.match))
+      if gaps:
+        painted = sorted(painted + gaps)
+    starts = []
+    results = []
+    cur = 0
+    for (plo, phi, pm) in painted:
+      if plo > cur:
+        starts.append(cur)
+        results.append(None)
+      starts.append(plo)
+      results.append(pm)
+      cur = phi+1
+    if cur <= 0xFFFFFFFF:
+      starts.append(cur)
+      results.append(None)
+    return (starts, results)
+
+  def check(self, ip, port):
+    """ Returns True if the policy accepts 'ip':'port', False if it
+        rejects it, and -1 if no line matches. 'ip' is a dotted quad. """
+    if not self.compiled:
+      for line in self.lines:
+        ret = line.check(ip, port)
+        if ret != -1:
+          return ret
+      return -1
+    ip = struct.unpack(">I", socket.inet_aton(ip))[0]
+    (starts, results) = \
+        self.port_tables[bisect.bisect_right(self.port_starts, port)-1]
+    ret = results[bisect.bisect_right(starts, ip)-1]
+    if ret is None:
+      return -1
+    return ret
+
+  def will_exit_to_port(self, port):
+    """ Returns True if the first line covering 'port' for every address
+        (ie with a '*' address) is an accept. Lines for specific
+        addresses, such as the private network rejects, are skipped. """
+    if not self.compiled:
+      for line in self.lines:
+        if line.netmask & 0xFFFFFFFF == 0 and \
+            line.port_low <= port <= line.port_high:
+          return line.match
+      return False
+    return self.port_accepts[bisect.bisect_right(self.port_starts, port)-1]
+
 class RouterVersion:
   """ Represents a Router's version. Overloads all comparison operators
       to check for newer, older, or equivalent versions. """
@@ -299,6 +672,11 @@ class RouterVersion:
   def __ne__(self, other): return self.version != other.version
   def __str__(self): return self.ver_string
 
+# Source of Router._rstr_gen values. Unique across all Router instances so
+# that a cached restriction result can never match a different router
+# object that reuses the same idhex.
+_rstr_generation = itertools.count(1)
+
 class Router:
   """ 
   Class to represent a router from a descriptor. Can either be
@@ -320,6 +698,7 @@ class Router:
       self.bw = bw
     self.desc_bw = bw
     self.exitpolicy = exitpolicy
+    self._compiled_policy = None # ExitPolicy, built on first exit check
     self.flags = flags # Technicaly from NS doc
     self.down = down
     self.ip = struct.unpack(">I", socket.inet_aton(ip))[0]
@@ -334,6 +713,9 @@ class Router:
     self.rate_limited = rate_limited
     self.orhash = orhash
     self._generated = [] # For ExactUniformGenerator
+    # Changes whenever the descriptor or consensus entry changes. Used by
+    # PathSupport.r_is_ok_cached() to invalidate cached restriction results.
+    self._rstr_gen = _rstr_generation.next()
 
   def __str__(self):
     s = self.idhex, self.nickname
@@ -409,26 +791,65 @@ class Router:
         ns.orhash, ns.bandwidth)
   build_from_desc = Callable(build_from_desc)
 
+  def annotate_routers(routers):
+    """ Called by ConsensusTracker with all the routers of this class it
+    has just created or updated from a consensus or a NEWDESC, so that
+    subclasses can derive extra fields once per batch. Does nothing
+    here. """
+    pass
+  annotate_routers = Callable(annotate_routers)
+
+  def _restriction_state(self):
+    """ Everything NodeRestrictions may look at besides list_rank. The
+    descriptor fields are all covered by orhash. """
+    return (self.orhash, self.nickname, self.bw, self.down,
+            tuple(self.flags))
+
+  def mark_changed(self):
+    """ Invalidate cached restriction results for this router. Call after
+    modifying its flags or down state in place. """
+    self._rstr_gen = _rstr_generation.next()
+
   def update_to(self, new):
     """ Somewhat hackish method to update this router to be a copy of
     'new' """
     if self.idhex != new.idhex:
       plog("ERROR", "Update of router "+self.nickname+"changes idhex!")
     plog("DEBUG", "Updating refcount "+str(self.refcount)+" for "+self.idhex)
+    state = self._restriction_state()
     for i in new.__dict__.iterkeys():
-      if i == "refcount" or i == "_generated": continue
+      if i == "refcount" or i == "_generated" or i == "_rstr_gen": continue
       self.__dict__[i] = new.__dict__[i]
+    if self._restriction_state() != state:
+      self.mark_changed()
     plog("DEBUG", "Updated refcount "+str(self.refcount)+" for "+self.idhex)
 
+  def get_exit_policy(self):
+    """ Returns the compiled ExitPolicy for this router's exitpolicy,
+        compiling it on first use. update_to() replaces it along with
+        the rest of the descriptor. """
+    if self._compiled_policy is None or \
+        self._compiled_policy.lines is not self.exitpolicy:
+      self._compiled_policy = ExitPolicy(self.exitpolicy)
+    return self._compiled_policy
+
   def will_exit_to(self, ip, port):
     """ Check the entire exitpolicy to see if the router will allow
         connections to 'ip':'port' """
-    for line in self.exitpolicy:
-      ret = line.check(ip, port)
-      if ret != -1:
-        return ret
+    ret = self.get_exit_policy().check(ip, port)
+    if ret != -1:
+      return ret
     plog("WARN", "No matching exit line for "+self.nickname)
     return False
+
+  def will_exit_to_port(self, port):
+    """ Check if the router allows connections to 'port' for any
+        address (see ExitPolicy.will_exit_to_port) """
+    return self.get_exit_policy().will_exit_to_port(port)
+
+  def is_web_exit(self):
+    """ Cached summary bit: does the router exit to port 80 or 443? """
+    return self.get_exit_policy().web_exit
    
 class Connection:
   """A Connection represents a connection to the Tor process via the 
@@ -449,6 +870,8 @@ class Connection:
     self._eventQueue = Queue.Queue()
     self._s = BufSock(sock)
     self._debugFile = None
+    self._tracer = None
+    self._replyBytes = 0
 
   def set_close_handler(self, handler):
     """Call 'handler' when the Tor process has closed its connection or
@@ -558,22 +981,29 @@ class Connection:
     return
 
   def _eventLoop(self):
-    """DOCDOC"""
+    """Event thread loop: hand queued events to the event handler. Events
+       that have piled up are taken off the queue in one batch."""
     while 1:
-      (timestamp, reply) = self._eventQueue.get()
-      if reply[0][0] == "650" and reply[0][1] == "OK":
-        plog("DEBUG", "Ignoring incompatible syntactic sugar: 650 OK")
-        continue
-      if reply == "CLOSE":
-        plog("INFO", "Event loop received close message.")
-        return
+      batch = [self._eventQueue.get()]
       try:
-        self._handleFn(timestamp, reply)
-      except:
-        for code, msg, data in reply:
-            plog("WARN", "No event for: "+str(code)+" "+str(msg))
-        self._err(sys.exc_info(), 1)
-        return
+        while len(batch) < EVENT_BATCH_SIZE:
+          batch.append(self._eventQueue.get_nowait())
+      except Queue.Empty:
+        pass
+      for (timestamp, reply) in batch:
+        if reply[0][0] == "650" and reply[0][1] == "OK":
+          plog("DEBUG", "Ignoring incompatible syntactic sugar: 650 OK")
+          continue
+        if reply == "CLOSE":
+          plog("INFO", "Event loop received close message.")
+          return
+        try:
+          self._handleFn(timestamp, reply)
+        except:
+          for code, msg, data in reply:
+              plog("WARN", "No event for: "+str(code)+" "+str(msg))
+          self._err(sys.exc_info(), 1)
+          return
 
   def _sendImpl(self, sendFn, msg):
     """DOCDOC"""
@@ -589,17 +1019,23 @@ class Connection:
     elif self._closed:
       raise TorCtlClosed()
 
+    # Runs in the _loop thread right after _read_reply, so _replyBytes is
+    # the size of this reply.
     def cb(reply,condition=condition,result=result):
       condition.acquire()
       try:
         result.append(reply)
+        result.append(self._replyBytes)
         condition.notify()
       finally:
         condition.release()
 
+    tracer = self._tracer
     # Sends a message to Tor...
     self._sendLock.acquire() # ensure queue+sendmsg is atomic
     try:
+      if tracer:
+        started = time.time()
       self._queue.put(cb)
       sendFn(msg) # _doSend(msg)
     finally:
@@ -614,11 +1050,16 @@ class Connection:
       condition.release()
 
     # ...And handle the answer appropriately.
-    assert len(result) == 1
+    assert len(result) == 2
     reply = result[0]
     if reply == "EXCEPTION":
       raise self._closedEx
 
+    if tracer:
+      words = msg.split("\r\n", 1)[0].split()
+      tracer.record(TracedCall(started, words and words[0].upper() or "",
+                               max(len(words) - 1, 0), len(msg), result[1],
+                               time.time() - started))
     return reply
 
 
@@ -626,12 +1067,21 @@ class Connection:
     """DOCDOC"""
     self._debugFile = f
 
+  def trace(self, tracer=None):
+    """Record every command sent from now on in the CallTracer 'tracer',
+       or in a new one if it is None. Returns the tracer."""
+    if tracer is None:
+      tracer = CallTracer()
+    self._tracer = tracer
+    return tracer
+
   def set_event_handler(self, handler):
     """Cause future events from the Tor process to be sent to 'handler'.
     """
     if self._handler:
       handler.pre_listeners = self._handler.pre_listeners
       handler.post_listeners = self._handler.post_listeners
+      handler.reroute()
     self._handler = handler
     self._handler.c = self
     self._handleFn = handler._handle1
@@ -643,11 +1093,13 @@ class Connection:
 
   def _read_reply(self):
     lines = []
+    size = 0
     while 1:
       line = self._s.readline()
       if not line:
         self._closed = True
         raise TorCtlClosed() 
+      size += len(line)
       line = line.strip()
       if self._debugFile:
         self._debugFile.write(str(time.time())+"\t  %s\n" % line)
@@ -661,6 +1113,8 @@ class Connection:
       elif tp == " ":
         lines.append((code, s, None))
         isEvent = (lines and lines[0][0][0] == '6')
+        if not isEvent:
+          self._replyBytes = size
         return isEvent, lines
       elif tp != "+":
         raise ProtocolError("Badly formatted reply line: unknown type %r"%tp)
@@ -668,6 +1122,7 @@ class Connection:
         more = []
         while 1:
           line = self._s.readline()
+          size += len(line)
           if self._debugFile:
             self._debugFile.write("+++ %s" % line)
           if line in (".\r\n", ".\n", "650 OK\n", "650 OK\r\n"): 
@@ -1065,7 +1520,22 @@ class DualEventListener(PreEventListener,PostEventListener):
 class EventHandler(EventSink):
   """An 'EventHandler' wraps callbacks for the events Tor can return. 
      Each event argument is an instance of the corresponding event
-     class."""
+     class.
+
+     If lazy_decode is set, the fields of high-volume events (CIRC,
+     STREAM, ORCONN, STREAM_BW, BW) are only parsed when first read, so
+     events nobody looks at cost almost nothing. It is off by default:
+     with it on, a malformed event raises ProtocolError in whichever
+     callback first reads a field rather than when it arrives.
+
+     Callbacks that are still the no-op defaults are not called at all.
+     Which callbacks to call is worked out once per event type, when the
+     first event of that type arrives. Adding a listener or replacing
+     the handler starts over; anything else that changes a handler's or
+     listener's callbacks after events have arrived must call
+     reroute()."""
+  lazy_decode = False
+
   def __init__(self):
     """Create a new EventHandler."""
     self._map1 = {
@@ -1090,22 +1560,59 @@ class EventHandler(EventSink):
     self.c = None # Gets set by Connection.set_event_hanlder()
     self.pre_listeners = []
     self.post_listeners = []
+    self._routes = {}
+
+  def _route(self, event_name):
+    """ Work out which callbacks actually do something for 'event_name'.
+    Returns (pre, heartbeat, handle, post) where pre and post are lists
+    and heartbeat and handle may be None. """
+    def listener_calls(listeners):
+      calls = []
+      for l in listeners:
+        if _is_callback(l.listen, EventListener.__dict__["listen"]):
+          calls.append(l.listen)
+          continue
+        if _is_callback(l.heartbeat_event):
+          calls.append(l.heartbeat_event)
+        f = l._map1.get(event_name, l.unknown_event)
+        if _is_callback(f):
+          calls.append(f)
+      return calls
+    heartbeat = handle = None
+    if _is_callback(self.heartbeat_event):
+      heartbeat = self.heartbeat_event
+    f = self._map1.get(event_name, self.unknown_event)
+    if _is_callback(f):
+      handle = f
+    route = (listener_calls(self.pre_listeners), heartbeat, handle,
+             listener_calls(self.post_listeners))
+    self._routes[event_name] = route
+    return route
+
+  def reroute(self):
+    """ Forget which callbacks were found for each event type, so the
+    next event of each type looks them up again. """
+    self._routes = {}
 
   def _handle1(self, timestamp, lines):
     """Dispatcher: called from Connection when an event is received."""
     for code, msg, data in lines:
       event = self._decode1(msg, data)
       event.arrived_at = timestamp
+      try:
+        pre, heartbeat, handle, post = self._routes[event.event_name]
+      except KeyError:
+        pre, heartbeat, handle, post = self._route(event.event_name)
       event.state=EVENT_STATE.PRELISTEN
-      for l in self.pre_listeners:
-        l.listen(event)
+      for f in pre:
+        f(event)
       event.state=EVENT_STATE.HEARTBEAT
-      self.heartbeat_event(event)
+      if heartbeat: heartbeat(event)
       event.state=EVENT_STATE.HANDLING
-      self._map1.get(event.event_name, self.unknown_event)(event)
+      if handle: handle(event)
       event.state=EVENT_STATE.POSTLISTEN
-      for l in self.post_listeners:
-        l.listen(event)
+      for f in post:
+        f(event)
 
   def _decode1(self, body, data):
     """Unpack an event message into a type/arguments-tuple tuple."""
@@ -1114,88 +1621,11 @@ class EventHandler(EventSink):
     else:
       evtype,body = body,""
     evtype = evtype.upper()
-    if evtype == "CIRC":
-      m = re.match(r"(\d+)\s+(\S+)(\s\S+)?(\s\S+)?(\s\S+)?(\s\S+)?", body)
-      if not m:
-        raise ProtocolError("CIRC event misformatted.")
-      ident,status,path,purpose,reason,remote = m.groups()
-      ident = int(ident)
-      if path:
-        if "PURPOSE=" in path:
-          remote = reason
-          reason = purpose
-          purpose=path
-          path=[]
-        elif "REASON=" in path:
-          remote = reason
-          reason = path
-          purpose = ""
-          path=[]
-        else:
-          path_verb = path.strip().split(",")
-          path = []
-          for p in path_verb:
-            path.append(p.replace("~", "=").split("=")[0])
-      else:
-        path = []
-
-      if purpose and "REASON=" in purpose:
-        remote=reason
-        reason=purpose
-        purpose=""
-
-      if purpose: purpose = purpose[9:]
-      if reason: reason = reason[8:]
-      if remote: remote = remote[15:]
-      event = CircuitEvent(evtype, ident, status, path, purpose, reason, remote)
-    elif evtype == "STREAM":
-      #plog("DEBUG", "STREAM: "+body)
-      m = re.match(r"(\S+)\s+(\S+)\s+(\S+)\s+(\S+)?:(\d+)(\sREASON=\S+)?(\sREMOTE_REASON=\S+)?(\sSOURCE=\S+)?(\sSOURCE_ADDR=\S+)?(\s+PURPOSE=\S+)?", body)
-      if not m:
-        raise ProtocolError("STREAM event misformatted.")
-      ident,status,circ,target_host,target_port,reason,remote,source,source_addr,purpose = m.groups()
-      ident,circ = map(int, (ident,circ))
-      if not target_host: # This can happen on SOCKS_PROTOCOL failures
-        target_host = "(none)"
-      if reason: reason = reason[8:]
-      if remote: remote = remote[15:]
-      if source: source = source[8:]
-      if source_addr: source_addr = source_addr[13:]
-      if purpose:
-        purpose = purpose.lstrip()
-        purpose = purpose[8:]
-      event = StreamEvent(evtype, ident, status, circ, target_host,
-               int(target_port), reason, remote, source, source_addr, purpose)
-    elif evtype == "ORCONN":
-      m = re.match(r"(\S+)\s+(\S+)(\sAGE=\S+)?(\sREAD=\S+)?(\sWRITTEN=\S+)?(\sREASON=\S+)?(\sNCIRCS=\S+)?", body)
-      if not m:
-        raise ProtocolError("ORCONN event misformatted.")
-      target, status, age, read, wrote, reason, ncircs = m.groups()
-
-      #plog("DEBUG", "ORCONN: "+body)
-      if ncircs: ncircs = int(ncircs[8:])
-      else: ncircs = 0
-      if reason: reason = reason[8:]
-      if age: age = int(age[5:])
-      else: age = 0
-      if read: read = int(read[6:])
-      else: read = 0
-      if wrote: wrote = int(wrote[9:])
-      else: wrote = 0
-      event = ORConnEvent(evtype, status, target, age, read, wrote,
-                reason, ncircs)
-    elif evtype == "STREAM_BW":
-      m = re.match(r"(\d+)\s+(\d+)\s+(\d+)", body)
-      if not m:
-        raise ProtocolError("STREAM_BW event misformatted.")
-      event = StreamBwEvent(evtype, *m.groups())
-    elif evtype == "BW":
-      m = re.match(r"(\d+)\s+(\d+)", body)
-      if not m:
-        raise ProtocolError("BANDWIDTH event misformatted.")
-      read, written = map(long, m.groups())
-      event = BWEvent(evtype, read, written)
-    elif evtype in ("DEBUG", "INFO", "NOTICE", "WARN", "ERR"):
+    if evtype in _lazy_events:
+      if self.lazy_decode:
+        return _lazy_event(evtype, body)
+      return _lazy_events[evtype][1](evtype, body)
+    if evtype in ("DEBUG", "INFO", "NOTICE", "WARN", "ERR"):
       event = LogEvent(evtype, body)
     elif evtype == "NEWDESC":
       ids_verb = body.split(" ")
@@ -1243,6 +1673,7 @@ class EventHandler(EventSink):
     if isinstance(evlistener, PostEventListener):
       self.post_listeners.append(evlistener)
     evlistener.set_parent(self)
+    self.reroute()
 
   def heartbeat_event(self, event):
     """Called before any event is received. Convenience function
@@ -1311,6 +1742,19 @@ class EventHandler(EventSink):
   def timer_event(self, event):
     pass
 
+# The do-nothing default callbacks. EventHandler._handle1() skips these.
+_default_callbacks = set()
+for _cls in (EventSink, EventHandler):
+  for _f in _cls.__dict__.itervalues():
+    if type(_f) == types.FunctionType and _f.func_name.endswith("_event"):
+      _default_callbacks.add(_f)
+
+def _is_callback(f, default=None):
+  """ True if calling 'f' might do something, i.e. it is not one of the
+  default callbacks (or 'default'). """
+  f = getattr(f, "im_func", f)
+  return f is not default and f not in _default_callbacks
+
 class Consensus:
   """
   A Consensus is a pickleable container for the members of
@@ -1326,16 +1770,135 @@ class Consensus:
     self.routers = router_map
     self.name_to_key = nick_map
 
+class SortedRouterList:
+  """
+  Keeps a list of Routers sorted by descending bandwidth (ties broken by
+  idhex) under single-router updates, along with each Router's list_rank.
+
+  'routers' is a plain list that is changed in place, so it must not be
+  handed out while updates may happen: ConsensusTracker publishes a copy
+  of it as sorted_r instead. Positions are found by bisecting a parallel
+  list of keys.
+  list_rank is only renumbered over the range an update actually
+  disturbed, and only when fix_ranks() is called, so a batch of updates
+  pays for one renumbering.
+  """
+  def __init__(self):
+    self.routers = []
+    self._keys = []
+    self._key_of = {} # idhex -> key currently stored in self._keys
+    self._dirty_lo = None
+    self._dirty_hi = 0
+
+  def _key(r): return (-r.bw, r.idhex)
+  _key = Callable(_key)
+
+  def _mark_dirty(self, lo, hi):
+    if self._dirty_lo is None or lo < self._dirty_lo: self._dirty_lo = lo
+    if hi > self._dirty_hi: self._dirty_hi = hi
+
+  def __len__(self): return len(self.routers)
+
+  def __contains__(self, r): return r.idhex in self._key_of
+
+  def rebuild(self, routers):
+    """ Replace the contents with the Routers in 'routers'. """
+    routers = list(routers)
+    routers.sort(key=SortedRouterList._key)
+    self.routers[:] = routers
+    self._keys = map(SortedRouterList._key, routers)
+    self._key_of = dict(map(lambda k: (k[1], k), self._keys))
+    self._dirty_lo = None
+    self._dirty_hi = 0
+    for i in xrange(len(routers)): routers[i].list_rank = i
+
+  def discard(self, r):
+    """ Remove 'r' if present. Returns True if it was. """
+    key = self._key_of.pop(r.idhex, None)
+    if key is None: return False
+    i = bisect.bisect_left(self._keys, key)
+    del self._keys[i]
+    del self.routers[i]
+    self._mark_dirty(i, len(self.routers))
+    return True
+
+  def update(self, r):
+    """ Insert, move or remove 'r' after its bw or down state changed.
+    The Router may already have been updated in place. """
+    if r.down:
+      self.discard(r)
+      return
+    key = SortedRouterList._key(r)
+    old = self._key_of.get(r.idhex)
+    if old == key:
+      i = bisect.bisect_left(self._keys, key)
+      if self.routers[i] is not r: # Same idhex, new instance
+        self.routers[i] = r
+        self._mark_dirty(i, i+1)
+      return
+    if old is not None:
+      i = bisect.bisect_left(self._keys, old)
+      del self._keys[i]
+      del self.routers[i]
+    j = bisect.bisect_left(self._keys, key)
+    self._keys.insert(j, key)
+    self.routers.insert(j, r)
+    self._key_of[r.idhex] = key
+    if old is None: # Everything after j shifted down
+      self._mark_dirty(j, len(self.routers))
+    else: # Only the routers between the old and new spot moved
+      self._mark_dirty(min(i, j), max(i, j)+1)
+
+  def rank(self, r):
+    """ Returns the position of 'r' in the list, or None. Unlike
+    r.list_rank, this is current even before fix_ranks(). """
+    key = self._key_of.get(r.idhex)
+    if key is None: return None
+    return bisect.bisect_left(self._keys, key)
+
+  def fix_ranks(self):
+    """ Renumber list_rank over the range disturbed since the last call. """
+    if self._dirty_lo is None: return
+    hi = min(self._dirty_hi, len(self.routers))
+    for i in xrange(self._dirty_lo, hi): self.routers[i].list_rank = i
+    self._dirty_lo = None
+    self._dirty_hi = 0
+
+  def check(self):
+    """ Verify ordering, keys and list_rank. Returns a list of problems. """
+    errs = []
+    if len(self._keys) != len(self.routers) or \
+        len(self._key_of) != len(self.routers):
+      errs.append("length mismatch")
+    for i in xrange(len(self.routers)):
+      r = self.routers[i]
+      if self._keys[i] != SortedRouterList._key(r):
+        errs.append("stale key for "+r.idhex)
+      if i and self._keys[i-1] > self._keys[i]:
+        errs.append("out of order at "+r.idhex)
+      if r.list_rank != i:
+        errs.append("list_rank "+str(r.list_rank)+" != "+str(i)+" for "+r.idhex)
+    return errs
+
 class ConsensusTracker(EventHandler):
   """
   A ConsensusTracker is an EventHandler that tracks the current
   consensus of Tor in self.ns_map, self.routers and self.sorted_r
+
+  The ranking is maintained incrementally in self.ranked_r, and
+  self.sorted_r is a fresh copy of it after every update, so lists handed
+  out earlier (Consensus.sorted_r, NodeGenerator.sorted_r) never change
+  while other threads iterate them. Set sanity_checks to verify the
+  ranking (and the routers in it) after every update.
   """
+  sanity_checks = False
+
   def __init__(self, c, RouterClass=Router):
     EventHandler.__init__(self)
     c.set_event_handler(self)
     self.ns_map = {}
     self.routers = {}
+    self.ranked_r = SortedRouterList()
     self.sorted_r = []
     self.name_to_key = {}
     self.RouterClass = RouterClass
@@ -1362,6 +1925,8 @@ class ConsensusTracker(EventHandler):
       else:
         rc = self.RouterClass(r)
         self.routers[rc.idhex] = rc
+    self.RouterClass.annotate_routers(map(lambda r: self.routers[r.idhex],
+                                          routers))
 
     removed_idhexes = old_idhexes - new_idhexes
     removed_idhexes.update(set(map(lambda r: r.idhex,
@@ -1372,6 +1937,7 @@ class ConsensusTracker(EventHandler):
       self.routers[i].down = True
       if "Running" in self.routers[i].flags:
         self.routers[i].flags.remove("Running")
+      self.routers[i].mark_changed()
       if self.routers[i].refcount == 0:
         self.routers[i].deleted = True
         if self.routers[i].__class__.__name__ == "StatsRouter":
@@ -1383,14 +1949,17 @@ class ConsensusTracker(EventHandler):
         plog("INFO", "Postponing expiring non-running router "+i)
         self.routers[i].deleted = True
 
-    self.sorted_r = filter(lambda r: not r.down, self.routers.itervalues())
-    self.sorted_r.sort(lambda x, y: cmp(y.bw, x.bw))
-    for i in xrange(len(self.sorted_r)): self.sorted_r[i].list_rank = i
+    self.ranked_r.rebuild(filter(lambda r: not r.down,
+                                 self.routers.itervalues()))
+    self.sorted_r = list(self.ranked_r.routers)
 
-    # XXX: Verification only. Can be removed.
-    self._sanity_check(self.sorted_r)
+    if self.sanity_checks:
+      self._sanity_check(self.sorted_r)
 
   def _sanity_check(self, list):
+    for e in self.ranked_r.check():
+      plog("WARN", "Sorted router list: "+e)
+
     downed =  filter(lambda r: r.down, list)
     for d in downed:
       plog("WARN", "Router "+d.idhex+" still present but is down. Del: "+str(d.deleted)+", flags: "+str(d.flags)+", bw: "+str(d.bw))
@@ -1446,14 +2015,15 @@ class ConsensusTracker(EventHandler):
           self.routers[r.idhex].update_to(r)
         else:
           self.routers[r.idhex] = self.RouterClass(r)
+        self.RouterClass.annotate_routers([self.routers[r.idhex]])
+        self.ranked_r.update(self.routers[r.idhex])
     if update:
-      self.sorted_r = filter(lambda r: not r.down, self.routers.itervalues())
-      self.sorted_r.sort(lambda x, y: cmp(y.bw, x.bw))
-      for i in xrange(len(self.sorted_r)): self.sorted_r[i].list_rank = i
+      self.ranked_r.fix_ranks()
+      self.sorted_r = list(self.ranked_r.routers)
     plog("DEBUG", str(time.time()-d.arrived_at)+ " Read " + str(len(d.idlist))
        +" ND => "+str(len(self.sorted_r))+" routers. Update: "+str(update))
-    # XXX: Verification only. Can be removed.
-    self._sanity_check(self.sorted_r)
+    if self.sanity_checks:
+      self._sanity_check(self.sorted_r)
     return update
 
   def current_consensus(self):
@@ -1579,9 +2149,74 @@ def run_example(host,port):
   th.join()
   return
 
+def read_debug_log(f):
+  """ Read the events out of a control port log written by
+      Connection.debug(). Returns a list of (timestamp, lines) tuples
+      as Connection hands them to EventHandler._handle1().
+  """
+  replies = []
+  lines = []
+  more = None
+  for l in f:
+    if l.startswith("+++ "):
+      if more is None: continue
+      l = l[4:]
+      if l in (".\r\n", ".\n", "650 OK\n", "650 OK\r\n"):
+        lines.append((code, msg, unescape_dots("".join(more))))
+        more = None
+        if code[0] == "6":
+          replies.append((timestamp, lines))
+          lines = []
+      else:
+        more.append(l)
+      continue
+    parts = l.split("\t", 1)
+    if len(parts) != 2 or not parts[1].startswith("  "):
+      continue # Something we sent
+    line = parts[1].strip()
+    if len(line) < 4: continue
+    timestamp = float(parts[0])
+    code, tp, msg = line[:3], line[3], line[4:]
+    if tp == "+":
+      more = []
+      continue
+    lines.append((code, msg, None))
+    if tp == " ":
+      if code[0] == "6":
+        replies.append((timestamp, lines))
+      lines = []
+  return replies
+
+def replay_events(handler, replies, rounds=1):
+  """ Feed 'replies' from read_debug_log() through 'handler' 'rounds'
+      times. Returns the number of events handled per second.
+  """
+  handled = 0
+  start = time.time()
+  for i in xrange(rounds):
+    for timestamp, reply in replies:
+      if reply[0][0] == "650" and reply[0][1] == "OK":
+        continue
+      handler._handle1(timestamp, reply)
+      handled += len(reply)
+  elapsed = time.time() - start
+  rate = handled/max(elapsed, 1e-6)
+  print "Replayed "+str(handled)+" events in "+str(elapsed)+"s: "+\
+        str(rate)+" events/sec"
+  return rate
+
 if __name__ == '__main__':
+  if len(sys.argv) == 3 and sys.argv[1] == "--replay":
+    replies = read_debug_log(open(sys.argv[2]))
+    for lazy in (False, True):
+      handler = EventHandler()
+      handler.lazy_decode = lazy
+      print "lazy_decode="+str(lazy)+":",
+      replay_events(handler, replies, 10)
+    sys.exit(0)
   if len(sys.argv) > 2:
     print "Syntax: TorControl.py torhost:torport"
+    print "        TorControl.py --replay control.log"
     sys.exit(0)
   else:
     sys.argv.append("localhost:9051")
@@ -0,0 +1,182 @@
+"""Database throughput benchmark for the updater's writes, on the backend
+settings.py selects. Each phase writes the router or subscription state of a
+consensus run twice, once with a C{save()} per row as the updater used to and
+once with L{bulk.upsert<weatherapp.bulk.upsert>} or
+L{bulk.update_all<weatherapp.bulk.update_all>}. While it writes, a reader
+thread looks routers up by fingerprint the way the web application does, so
+the results show both the write rate and how much the writes hold up
+readers. A throwaway test database is used, and the results can be saved as
+JSON.
+
+Run from the weather directory. On SQLite::
+
+    python benchmarks/bench_db.py --routers 5000 --subscribers 2000
+
+On PostgreSQL, for example in a local container (the user must be allowed
+to create the test database)::
+
+    docker run --rm -d -p 5432:5432 -e POSTGRES_USER=weather \\
+        -e POSTGRES_PASSWORD=weather postgres:13
+    WEATHER_DB_ENGINE=postgresql_psycopg2 WEATHER_DB_HOST=127.0.0.1 \\
+        WEATHER_DB_PASSWORD=weather python benchmarks/bench_db.py
+"""
+
+import os
+import random
+import sys
+import threading
+import time
+from datetime import datetime
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ['DJANGO_SETTINGS_MODULE'] = 'settings'
+
+from django.conf import settings
+from django.db import connection
+from django.test.utils import setup_test_environment, \
+                              teardown_test_environment
+from django.utils import simplejson
+
+from weatherapp import bulk
+from weatherapp.models import Router, Subscriber, NodeDownSub
+
+class Reader(threading.Thread):
+    """Looks up random routers by fingerprint until stopped, on its own
+    database connection.
+
+    @type fingerprints: list[str]
+    @ivar fingerprints: The fingerprints to look up.
+    @type reads: int
+    @ivar reads: Lookups that succeeded.
+    @type errors: int
+    @ivar errors: Lookups that failed, such as on a locked database.
+    @type slowest: float
+    @ivar slowest: Seconds the slowest lookup took.
+    """
+
+    def __init__(self, fingerprints, seed):
+        threading.Thread.__init__(self)
+        self.fingerprints = fingerprints
+        self.rand = random.Random(seed)
+        self.reads = 0
+        self.errors = 0
+        self.slowest = 0.0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.isSet():
+            start = time.time()
+            try:
+                Router.objects.filter(fingerprint =
+                    self.rand.choice(self.fingerprints)).exists()
+            except Exception:
+                self.errors += 1
+            else:
+                self.reads += 1
+            self.slowest = max(self.slowest, time.time() - start)
+        connection.close()
+
+def measure(name, rows, fingerprints, function, *args):
+    """Call C{function} while a L{Reader} runs and report both."""
+    reader = Reader(fingerprints, len(name))
+    reader.start()
+    start = time.time()
+    try:
+        function(*args)
+    finally:
+        seconds = time.time() - start
+        reader.stopped.set()
+        reader.join()
+    result = {'phase': name, 'rows': rows, 'seconds': seconds,
+              'rows_per_second': rows / max(seconds, 1e-9),
+              'reads_per_second': reader.reads / max(seconds, 1e-9),
+              'read_errors': reader.errors,
+              'slowest_read': reader.slowest}
+    print '  %-26s %8d %9.3f %12.0f %10.0f %8d %10.4f' % (name, rows,
+          seconds, result['rows_per_second'], result['reads_per_second'],
+          reader.errors, reader.slowest)
+    return result
+
+def make_routers(fingerprints, now):
+    return [Router(fingerprint = fingerprint, name = 'bench%d' % i,
+                   last_seen = now, up = True, welcomed = True)
+            for i, fingerprint in enumerate(fingerprints)]
+
+def save_routers(routers):
+    """Save each router as update_all_routers used to: look it up, then
+    save it."""
+    for router in routers:
+        try:
+            router.id = Router.objects.get(fingerprint = router.fingerprint).id
+        except Router.DoesNotExist:
+            router.id = None
+        router.save()
+
+def save_subs(subs):
+    for sub in subs:
+        sub.save()
+
+def main():
+    parser = OptionParser(usage = '%prog [options]')
+    parser.add_option('--routers', type = 'int', default = 5000)
+    parser.add_option('--subscribers', type = 'int', default = 2000)
+    parser.add_option('--seed', type = 'int', default = 0)
+    parser.add_option('--output', help = 'file to save the results as JSON')
+    options, args = parser.parse_args()
+
+    rand = random.Random(options.seed)
+    fingerprints = ['%040X' % rand.getrandbits(160)
+                    for i in xrange(options.routers)]
+    engine = settings.DATABASES['default']['ENGINE']
+    print 'Backend: %s' % engine
+    print '  %-26s %8s %9s %12s %10s %8s %10s' % ('phase', 'rows', 'seconds',
+          'rows/s', 'reads/s', 'errors', 'slowest')
+
+    setup_test_environment()
+    old_name = settings.DATABASES['default']['NAME']
+    connection.creation.create_test_db(verbosity = 0, autoclobber = True)
+    results = []
+    try:
+        now = datetime.now()
+        for method, write in [('save', save_routers),
+                              ('upsert', lambda routers: bulk.upsert(Router,
+                                         routers, 'fingerprint'))]:
+            Router.objects.all().delete()
+            results.append(measure('routers insert (%s)' % method,
+                                   options.routers, fingerprints, write,
+                                   make_routers(fingerprints, now)))
+            results.append(measure('routers update (%s)' % method,
+                                   options.routers, fingerprints, write,
+                                   make_routers(fingerprints, now)))
+
+        routers = list(Router.objects.all())
+        subs = []
+        for i in xrange(options.subscribers):
+            subscriber = Subscriber(email = 'sub%d@example.com' % i,
+                                    router = rand.choice(routers),
+                                    confirmed = True)
+            subscriber.save()
+            sub = NodeDownSub(subscriber = subscriber, grace_pd = 1)
+            sub.save()
+            subs.append(sub)
+        for method, write in [('save', save_subs),
+                              ('update_all', lambda subs: bulk.update_all(
+                                             NodeDownSub, subs))]:
+            for sub in subs:
+                sub.emailed = not sub.emailed
+            results.append(measure('subscriptions (%s)' % method, len(subs),
+                                   fingerprints, write, subs))
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity = 0)
+        teardown_test_environment()
+
+    if options.output:
+        output = open(options.output, 'w')
+        simplejson.dump({'started': now.isoformat(), 'backend': engine,
+                         'options': options.__dict__, 'results': results},
+                        output, indent = 2)
+        output.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""Micro-benchmark for building notification emails. Builds node down emails
+for 100,000 subscriptions spread over 5,000 routers, then turns them into
+SMTP-ready messages, both with L{emails.mime_messages} and with Django's
+C{EmailMessage}, which C{send_mass_mail} uses.
+
+Run from the weather directory: 'python benchmarks/bench_emails.py [count]'.
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ['DJANGO_SETTINGS_MODULE'] = 'settings'
+
+from django.core.mail import EmailMessage
+
+from weatherapp import emails
+
+_ROUTERS = 5000
+
+def _timed(label, count, function, *args):
+    start = time.time()
+    result = function(*args)
+    elapsed = time.time() - start
+    print '%-32s %8.3fs %10.0f/s' % (label, elapsed, count / elapsed)
+    return result
+
+def build_tuples(count):
+    email_list = []
+    for i in xrange(count):
+        router = i % _ROUTERS
+        email_list.append(emails.node_down_tuple('op%d@example.com' % i,
+                          '%040X' % router, 'relay%d' % router, 1 + i % 3,
+                          'unsubs%020d' % i, 'pref%022d' % i))
+    return email_list
+
+def django_messages(email_list):
+    return [EmailMessage(*mail).message().as_string() for mail in email_list]
+
+def main(count):
+    emails.clear_cache()
+    email_list = _timed('node_down_tuple', count, build_tuples, count)
+    _timed('mime_messages', count, emails.mime_messages, email_list)
+    _timed('EmailMessage.message', count, django_messages, email_list)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main(100000)
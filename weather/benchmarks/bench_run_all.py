@@ -0,0 +1,254 @@
+"""End-to-end benchmark for updaters.run_all. Serves a synthetic network from
+a L{FakeControlServer<weatherapp.fakecontrol.FakeControlServer>}, adds
+subscribers with a mix of subscription types, and drives a series of
+consensuses with churn through C{updaters.run_all}. For each phase of each
+run it reports wall time, database queries, control port round trips and peak
+RSS, and the results are saved as JSON so runs can be compared over time.
+
+The phases are the functions run_all calls: C{update_all_routers},
+C{RouterHistory.compact}, each C{check_*}, C{emails.digest} (building the
+emails to send) and C{emails.send_mass_mime} (sending them, to Django's
+in-memory test backend). A throwaway test database is used.
+
+Run from the weather directory, for example::
+
+    python benchmarks/bench_run_all.py --relays 2000 --subscribers 1000 \\
+        --mix node_down=4,bandwidth=2,tshirt=1,version=2 --runs 5 \\
+        --output log/bench_run_all.json
+"""
+
+import logging
+import os
+import random
+import resource
+import sys
+import time
+from datetime import datetime
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ['DJANGO_SETTINGS_MODULE'] = 'settings'
+
+from django.conf import settings
+from django.core import mail
+from django.db import connection, reset_queries
+from django.test.utils import setup_test_environment, \
+                              teardown_test_environment
+from django.utils import simplejson
+
+from weatherapp import updaters, emails
+from weatherapp.ctlutil import CtlUtil
+from weatherapp.fakecontrol import FakeControlServer, synthetic_network, \
+                                   RECOMMENDED_VERSIONS
+from TorCtl import TorUtil
+from weatherapp.models import Router, Subscriber, NodeDownSub, BandwidthSub, \
+                              TShirtSub, VersionSub, RouterHistory
+
+_PHASES = [(updaters, 'update_all_routers'), (updaters, 'check_node_down'),
+           (updaters, 'check_version'), (updaters, 'check_low_bandwidth'),
+           (updaters, 'check_earn_tshirt'), (emails, 'digest'),
+           (emails, 'send_mass_mime')]
+
+class PhaseRecorder:
+    """Wraps the phases of run_all to measure each call.
+
+    @type server: FakeControlServer
+    @ivar server: The server whose commands are counted as round trips.
+    @type phases: list[dict]
+    @ivar phases: The measurements of the current run, in call order.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.phases = []
+        self._originals = []
+
+    def _wrap(self, name, function):
+        def measured(*args, **kwargs):
+            reset_queries()
+            commands = len(self.server.commands)
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.phases.append({
+                    'phase': name,
+                    'seconds': time.time() - start,
+                    'queries': len(connection.queries),
+                    'round_trips': len(self.server.commands) - commands,
+                    'peak_rss_kb': resource.getrusage(
+                        resource.RUSAGE_SELF).ru_maxrss})
+        return measured
+
+    def install(self):
+        for module, name in _PHASES:
+            function = getattr(module, name)
+            self._originals.append((module, name, function))
+            setattr(module, name, self._wrap(name, function))
+        compact = RouterHistory.compact
+        self._originals.append((RouterHistory, 'compact',
+                                staticmethod(compact)))
+        RouterHistory.compact = staticmethod(self._wrap('compact', compact))
+
+    def uninstall(self):
+        for owner, name, function in self._originals:
+            setattr(owner, name, function)
+        self._originals = []
+
+def parse_mix(text):
+    """Parse a subscription mix like C{node_down=4,bandwidth=2} into a list
+    of C{(weight, type)} pairs."""
+    mix = []
+    for part in text.split(','):
+        name, weight = part.split('=')
+        mix.append((float(weight), name.strip()))
+    return mix
+
+def add_subscribers(count, mix, rand):
+    """Subscribe C{count} confirmed subscribers to random routers, each with
+    one subscription whose type is picked from C{mix}."""
+    routers = list(Router.objects.all())
+    total = sum([weight for weight, name in mix])
+    for i in xrange(count):
+        subscriber = Subscriber(email = 'sub%d@example.com' % i,
+                                router = rand.choice(routers),
+                                confirmed = True)
+        subscriber.save()
+        point = rand.random() * total
+        for weight, name in mix:
+            point -= weight
+            if point < 0:
+                break
+        if name == 'node_down':
+            sub = NodeDownSub(subscriber = subscriber,
+                              grace_pd = rand.choice([1, 1, 2, 6, 24]))
+        elif name == 'bandwidth':
+            sub = BandwidthSub(subscriber = subscriber,
+                               threshold = rand.choice([20, 50, 100]))
+        elif name == 'tshirt':
+            sub = TShirtSub(subscriber = subscriber)
+        elif name == 'version':
+            sub = VersionSub(subscriber = subscriber,
+                             notify_type = rand.choice(['UNRECOMMENDED',
+                                                        'OBSOLETE']))
+        else:
+            raise ValueError('Unknown subscription type %s' % name)
+        sub.save()
+
+def churn(relays, rate, rand):
+    """Change about C{rate} of C{relays} between consensuses: relays go down
+    or come back up, and the ones that stay up get a new bandwidth and
+    sometimes a new version and descriptor."""
+    for relay in relays:
+        if rand.random() >= rate:
+            continue
+        if 'Running' in relay.flags:
+            if rand.random() < 0.5:
+                relay.flags.remove('Running')
+                continue
+        else:
+            relay.flags.insert(1, 'Running')
+        relay.bandwidth = max(1, int(relay.bandwidth *
+                                     rand.uniform(0.5, 1.5)))
+        if rand.random() < 0.2:
+            relay.version = rand.choice(RECOMMENDED_VERSIONS)
+        relay.published = datetime.now().replace(microsecond = 0)
+
+def summarize(runs):
+    """Total each phase over C{runs}, in the order the phases ran."""
+    totals = []
+    by_name = {}
+    for run in runs:
+        for phase in run['phases']:
+            if phase['phase'] not in by_name:
+                by_name[phase['phase']] = {'phase': phase['phase'],
+                                           'seconds': 0.0, 'queries': 0,
+                                           'round_trips': 0, 'peak_rss_kb': 0}
+                totals.append(by_name[phase['phase']])
+            total = by_name[phase['phase']]
+            total['seconds'] += phase['seconds']
+            total['queries'] += phase['queries']
+            total['round_trips'] += phase['round_trips']
+            total['peak_rss_kb'] = max(total['peak_rss_kb'],
+                                       phase['peak_rss_kb'])
+    return totals
+
+def print_phases(title, phases):
+    print title
+    print '  %-22s %10s %9s %12s %12s' % ('phase', 'seconds', 'queries',
+                                          'round trips', 'peak RSS kB')
+    for phase in phases:
+        print '  %-22s %10.3f %9d %12d %12d' % (phase['phase'],
+              phase['seconds'], phase['queries'], phase['round_trips'],
+              phase['peak_rss_kb'])
+
+def main():
+    parser = OptionParser(usage = '%prog [options]')
+    parser.add_option('--relays', type = 'int', default = 2000)
+    parser.add_option('--subscribers', type = 'int', default = 1000)
+    parser.add_option('--mix', default =
+                      'node_down=4,bandwidth=2,tshirt=1,version=2',
+                      help = 'relative weights of the subscription types')
+    parser.add_option('--runs', type = 'int', default = 5,
+                      help = 'consensuses to drive after the first')
+    parser.add_option('--churn', type = 'float', default = 0.05,
+                      help = 'share of relays changing between consensuses')
+    parser.add_option('--latency', type = 'float', default = 0,
+                      help = 'seconds the control port waits per reply')
+    parser.add_option('--seed', type = 'int', default = 0)
+    parser.add_option('--output', help = 'file to save the results as JSON')
+    options, args = parser.parse_args()
+    # Relays that are down make CtlUtil log an error for every lookup.
+    logging.disable(logging.CRITICAL)
+    TorUtil.loglevel = 'ERROR'
+
+    rand = random.Random(options.seed)
+    relays = synthetic_network(options.relays, options.seed)
+    server = FakeControlServer(relays, latency = options.latency)
+    server.start()
+
+    setup_test_environment()
+    old_name = settings.DATABASES['default']['NAME']
+    connection.creation.create_test_db(verbosity = 0)
+    settings.DEBUG = True
+    recorder = PhaseRecorder(server)
+    runs = []
+    try:
+        ctl_util = CtlUtil(control_port = server.port)
+        updaters.run_all(ctl_util = ctl_util)
+        add_subscribers(options.subscribers, parse_mix(options.mix), rand)
+
+        recorder.install()
+        for i in xrange(options.runs):
+            churn(relays, options.churn, rand)
+            server.set_relays(relays)
+            recorder.phases = []
+            mail.outbox = []
+            start = time.time()
+            updaters.run_all(ctl_util = ctl_util)
+            runs.append({'run': i + 1, 'seconds': time.time() - start,
+                         'emails': len(mail.outbox),
+                         'phases': recorder.phases})
+            print_phases('Run %d: %.3fs, %d emails' % (i + 1,
+                         runs[-1]['seconds'], runs[-1]['emails']),
+                         recorder.phases)
+    finally:
+        recorder.uninstall()
+        settings.DEBUG = False
+        connection.creation.destroy_test_db(old_name, verbosity = 0)
+        teardown_test_environment()
+        server.stop()
+
+    totals = summarize(runs)
+    print_phases('Total: %.3fs' % sum([run['seconds'] for run in runs]),
+                 totals)
+    if options.output:
+        results = {'started': datetime.now().isoformat(),
+                   'options': options.__dict__, 'runs': runs,
+                   'totals': totals}
+        output = open(options.output, 'w')
+        simplejson.dump(results, output, indent = 2)
+        output.close()
+
+if __name__ == '__main__':
+    main()
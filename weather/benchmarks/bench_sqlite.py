@@ -0,0 +1,219 @@
+"""SQLite durability benchmark for the updater's writes. Each combination of
+journal mode and C{synchronous} setting writes the router and subscription
+state of a consensus three ways: with a C{save()} per row in autocommit, as
+the updater used to, with a C{save()} per row inside one transaction, and
+with L{bulk<weatherapp.bulk>} inside one transaction, as the updater does
+now. For each, it reports wall time and the number of C{fsync}s and
+C{fdatasync}s made.
+
+The syncs are counted by a small C{LD_PRELOAD} library that wraps both
+calls, so a C compiler (C{cc}) is needed to count them; without one, only
+wall time is reported. A throwaway test database is used, and the results
+can be saved as JSON.
+
+Run from the weather directory, for example::
+
+    python benchmarks/bench_sqlite.py --routers 2000 --subscribers 1000
+"""
+
+import ctypes
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ['DJANGO_SETTINGS_MODULE'] = 'settings'
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.test.utils import setup_test_environment, \
+                              teardown_test_environment
+from django.utils import simplejson
+
+from config import config
+from weatherapp import bulk
+from weatherapp.models import Router, Subscriber, NodeDownSub
+
+_SHIM_ENV = 'WEATHER_FSYNC_SHIM'
+
+_SHIM_SOURCE = r"""
+#define _GNU_SOURCE
+#include <dlfcn.h>
+
+static long count;
+
+long weather_fsync_count(void) { return count; }
+
+int fsync(int fd) {
+    static int (*real)(int);
+    if (!real) real = (int (*)(int)) dlsym(RTLD_NEXT, "fsync");
+    __sync_fetch_and_add(&count, 1);
+    return real(fd);
+}
+
+int fdatasync(int fd) {
+    static int (*real)(int);
+    if (!real) real = (int (*)(int)) dlsym(RTLD_NEXT, "fdatasync");
+    __sync_fetch_and_add(&count, 1);
+    return real(fd);
+}
+"""
+
+_SETTINGS = [('DELETE', 'FULL'), ('DELETE', 'NORMAL'), ('WAL', 'FULL'),
+             ('WAL', 'NORMAL')]
+
+def preload_shim():
+    """Run this script again with the sync counting library preloaded, if it
+    is not already and it can be built. Only returns if it does not run the
+    script again."""
+    if os.environ.get(_SHIM_ENV):
+        return
+    build = tempfile.mkdtemp(prefix = 'weather-fsync-')
+    source = os.path.join(build, 'fsync.c')
+    library = os.path.join(build, 'fsync.so')
+    open(source, 'w').write(_SHIM_SOURCE)
+    try:
+        built = subprocess.call(['cc', '-shared', '-fPIC', '-o', library,
+                                 source, '-ldl']) == 0
+    except OSError:
+        built = False
+    if not built:
+        print 'Could not build the fsync counter, only timing the writes.'
+        shutil.rmtree(build)
+        return
+    env = dict(os.environ)
+    env[_SHIM_ENV] = build
+    env['LD_PRELOAD'] = ' '.join(filter(None, [library,
+                                               env.get('LD_PRELOAD')]))
+    os.execve(sys.executable, [sys.executable] + sys.argv, env)
+
+def fsync_count():
+    """Get the number of syncs made so far, or None if they are not
+    counted."""
+    if not os.environ.get(_SHIM_ENV):
+        return None
+    try:
+        return ctypes.CDLL(None).weather_fsync_count()
+    except AttributeError:
+        return None
+
+def make_routers(fingerprints, now):
+    return [Router(fingerprint = fingerprint, name = 'bench%d' % i,
+                   last_seen = now, up = True, welcomed = True)
+            for i, fingerprint in enumerate(fingerprints)]
+
+def save_each(routers, subs):
+    """Save each router and subscription, as update_all_routers and the
+    check functions used to."""
+    for router in routers:
+        try:
+            router.id = Router.objects.get(fingerprint = router.fingerprint).id
+        except Router.DoesNotExist:
+            router.id = None
+        router.save()
+    for sub in subs:
+        sub.save()
+
+def save_bulk(routers, subs):
+    """Write the routers and subscriptions as the updater does now."""
+    bulk.upsert(Router, routers, 'fingerprint')
+    bulk.update_all(NodeDownSub, subs)
+
+def measure(name, rows, function, *args):
+    """Call C{function} and report its wall time and syncs."""
+    syncs = fsync_count()
+    start = time.time()
+    function(*args)
+    seconds = time.time() - start
+    if syncs is not None:
+        syncs = fsync_count() - syncs
+    result = {'phase': name, 'rows': rows, 'seconds': seconds,
+              'rows_per_second': rows / max(seconds, 1e-9), 'fsyncs': syncs}
+    print '  %-36s %8d %9.3f %12.0f %8s' % (name, rows, seconds,
+          result['rows_per_second'], syncs is None and '-' or syncs)
+    return result
+
+def reconnect(journal_mode, synchronous):
+    """Open a new connection to the test database with the given pragmas."""
+    connection.close()
+    config.sqlite_journal_mode = journal_mode
+    config.sqlite_synchronous = synchronous
+    cursor = connection.cursor()
+    cursor.execute('PRAGMA journal_mode')
+    assert cursor.fetchone()[0].upper() == journal_mode
+
+def main():
+    preload_shim()
+    parser = OptionParser(usage = '%prog [options]')
+    parser.add_option('--routers', type = 'int', default = 2000)
+    parser.add_option('--subscribers', type = 'int', default = 1000)
+    parser.add_option('--seed', type = 'int', default = 0)
+    parser.add_option('--output', help = 'file to save the results as JSON')
+    options, args = parser.parse_args()
+
+    if settings.DATABASES['default']['ENGINE'] != \
+            'django.db.backends.sqlite3':
+        parser.error('this benchmark needs the SQLite backend')
+    rand = random.Random(options.seed)
+    fingerprints = ['%040X' % rand.getrandbits(160)
+                    for i in xrange(options.routers)]
+    print '  %-36s %8s %9s %12s %8s' % ('phase', 'rows', 'seconds', 'rows/s',
+                                        'fsyncs')
+
+    setup_test_environment()
+    old_name = settings.DATABASES['default']['NAME']
+    connection.creation.create_test_db(verbosity = 0, autoclobber = True)
+    results = []
+    now = datetime.now()
+    try:
+        routers = make_routers(fingerprints, now)
+        bulk.upsert(Router, routers, 'fingerprint')
+        routers = list(Router.objects.all())
+        subs = []
+        for i in xrange(options.subscribers):
+            subscriber = Subscriber(email = 'sub%d@example.com' % i,
+                                    router = rand.choice(routers),
+                                    confirmed = True)
+            subscriber.save()
+            sub = NodeDownSub(subscriber = subscriber, grace_pd = 1)
+            sub.save()
+            subs.append(sub)
+        rows = options.routers + len(subs)
+
+        for journal_mode, synchronous in _SETTINGS:
+            reconnect(journal_mode, synchronous)
+            for method, write in [
+                    ('save, autocommit', save_each),
+                    ('save, one transaction',
+                     transaction.commit_on_success(save_each)),
+                    ('bulk, one transaction',
+                     transaction.commit_on_success(save_bulk))]:
+                for sub in subs:
+                    sub.emailed = not sub.emailed
+                name = '%s/%s %s' % (journal_mode, synchronous, method)
+                result = measure(name, rows, write,
+                                 make_routers(fingerprints, now), subs)
+                result.update({'journal_mode': journal_mode,
+                               'synchronous': synchronous})
+                results.append(result)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity = 0)
+        teardown_test_environment()
+        if os.environ.get(_SHIM_ENV):
+            shutil.rmtree(os.environ[_SHIM_ENV], True)
+
+    if options.output:
+        output = open(options.output, 'w')
+        simplejson.dump({'started': now.isoformat(),
+                         'options': options.__dict__, 'results': results},
+                        output, indent = 2)
+        output.close()
+
+if __name__ == '__main__':
+    main()
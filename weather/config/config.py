@@ -7,6 +7,38 @@ Configuration settings.
 @var updater_port: The Tor control port for the updater to use. This port 
     must be configured in the torrc file.
 @var base_url: The root URL for the Tor Weather web application.
+@var node_down_events: Whether the listener follows NS and NEWDESC events to
+    detect relays going down between consensuses.
+@var liveness_tick: Seconds between the listener's checks for node down
+    grace periods and t-shirt uptimes that have ended.
+@var digest_min: The fewest emails to one recipient in one run that are
+    combined into a digest email. 0 sends every email on its own.
+@var digest_max: The most notifications in one digest email.
+@var control_debug_file: The file the raw control port traffic is written
+    to, or None for no such file.
+@var control_trace: Whether control port calls are traced, see
+    C{TorCtl.CallTracer}.
+@var control_trace_size: The number of sampled calls the tracer keeps.
+@var control_trace_sample: The tracer keeps one call in this many.
+@var profile_every_run: Whether every updater run is profiled, not only the
+    ones asked for with SIGUSR1. See C{weatherapp.profiling}.
+@var profile_layer: What a profiled run profiles: 'all', 'control' for the
+    control port calls only, or 'orm' for the database calls only.
+@var profile_dir: The directory profiler stats files are saved in.
+@var profile_top: The number of functions in the logged profile summary.
+@var sqlite_journal_mode: The SQLite journal mode, or None for SQLite's
+    default. See C{weatherapp.pragmas}.
+@var sqlite_synchronous: The SQLite synchronous setting, or None for
+    SQLite's default.
+@var sqlite_cache_kb: The SQLite page cache size of each connection in KiB,
+    or 0 for SQLite's default.
+@var sqlite_busy_timeout: Milliseconds an SQLite connection waits for a
+    lock held by another before failing, or 0 for the default.
+@var consensus_index_file: The index of the current consensus the updater
+    writes for the web application, or None for no index. See
+    C{weatherapp.routerindex}.
+@var metrics_allowed_ips: The client addresses that may read the metrics
+    at /metrics/. Empty to serve them to no one.
 """
 
 # XXX: Make bulletproof
@@ -17,3 +49,36 @@ control_port = 9051
 
 #The base URL for the Tor Weather web application:
 base_url = 'http://www.weather.torproject.org'
+
+#Detect relays going down from NS/NEWDESC events, not only each consensus:
+node_down_events = True
+liveness_tick = 60
+
+#Combine a run's emails to the same recipient into digests:
+digest_min = 2
+digest_max = 50
+
+#Record control port traffic (to a file such as 'log/debug', which holds the
+#raw replies) and trace control port calls:
+control_debug_file = None
+control_trace = True
+control_trace_size = 1000
+control_trace_sample = 1
+
+#Profile updater runs (SIGUSR1 to the listener profiles the next one):
+profile_every_run = False
+profile_layer = 'all'
+profile_dir = 'log'
+profile_top = 30
+
+#SQLite connection settings (ignored for other databases):
+sqlite_journal_mode = 'WAL'
+sqlite_synchronous = 'NORMAL'
+sqlite_cache_kb = 20000
+sqlite_busy_timeout = 20000
+
+#The index of the current consensus that web requests look routers up in:
+consensus_index_file = 'log/consensus.idx'
+
+#The addresses allowed to scrape /metrics/:
+metrics_allowed_ips = ('127.0.0.1', '::1')
@@ -11,17 +11,32 @@ ADMINS = (
 
 MANAGERS = ADMINS
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3', # Add 'postgresql_psycopg2', 'postgresql', 'mysql', 'sqlite3' or 'oracle'.
-        'NAME': PROJECT_PATH + "/WeatherDB",                      # Or path to database file if using sqlite3.
-        'TEST_NAME': 'WeatherTestDB',
-        'USER': '',                      # Not used with sqlite3.
-        'PASSWORD': '',                  # Not used with sqlite3.
-        'HOST': '',                      # Set to empty string for localhost. Not used with sqlite3.
-        'PORT': '',                      # Set to empty string for default. Not used with sqlite3.
+# The database. SQLite is used unless WEATHER_DB_ENGINE names another backend.
+# For PostgreSQL (9.5 or later), set WEATHER_DB_ENGINE=postgresql_psycopg2
+# and WEATHER_DB_NAME, _USER, _PASSWORD, _HOST and _PORT. Django opens a new
+# connection for every request, so point _HOST and _PORT at a connection
+# pooler such as PgBouncer rather than at PostgreSQL itself; see
+# doc/INSTALL and doc/pgbouncer.ini.
+_DB_ENGINE = os.environ.get('WEATHER_DB_ENGINE', 'sqlite3')
+if _DB_ENGINE == 'sqlite3':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': PROJECT_PATH + "/WeatherDB",
+            'TEST_NAME': 'WeatherTestDB',
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.' + _DB_ENGINE,
+            'NAME': os.environ.get('WEATHER_DB_NAME', 'weather'),
+            'USER': os.environ.get('WEATHER_DB_USER', 'weather'),
+            'PASSWORD': os.environ.get('WEATHER_DB_PASSWORD', ''),
+            'HOST': os.environ.get('WEATHER_DB_HOST', ''),
+            'PORT': os.environ.get('WEATHER_DB_PORT', ''),
+        }
     }
-}
 
 # Local time zone for this installation. Choices can be found here:
 # http://en.wikipedia.org/wiki/List_of_tz_zones_by_name
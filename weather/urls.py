@@ -29,6 +29,7 @@ urlpatterns = patterns('',
                         'weatherapp.views.router_name_lookup'),
     (r'^router_fingerprint_lookup/$',
                         'weatherapp.views.router_fingerprint_lookup'),
+    (r'^metrics/$', 'weatherapp.views.metrics'),
     
     # This is for serving static files for the development server, mainly for
     # getting the CSS file and jquery file.
@@ -0,0 +1,126 @@
+"""A module for writing many rows in few statements. The updater saves every
+router in the consensus and every subscription on each run; with one
+C{save()} per row, that is two queries per row and, outside a transaction,
+a commit each. L{upsert} writes a list of model instances as multi-row
+C{INSERT ... ON CONFLICT ... DO UPDATE} statements instead, which both
+PostgreSQL (9.5 and later) and SQLite (3.24 and later) understand. On older
+SQLite, it falls back to C{INSERT OR IGNORE} followed by C{UPDATE}.
+L{update_all} writes rows that must already exist, such as subscriptions,
+which the web application may delete while the updater runs.
+
+@type MAX_VARIABLES: int
+@var MAX_VARIABLES: The most query parameters put in one statement, the
+    lowest limit of the supported databases (SQLite before 3.32).
+"""
+
+from django.db import connection, transaction
+from django.db.models import AutoField
+
+MAX_VARIABLES = 999
+
+def _supports_upsert():
+    """Whether the database understands C{INSERT ... ON CONFLICT}."""
+    if connection.settings_dict['ENGINE'].endswith('sqlite3'):
+        from django.db.backends.sqlite3.base import Database
+        return Database.sqlite_version_info >= (3, 24, 0)
+    return True
+
+def _column(model, name):
+    return model._meta.get_field(name).column
+
+def upsert(model, objects, unique):
+    """Save C{objects}, inserting a row for each one that does not collide
+    with an existing row on the C{unique} fields and updating the row for
+    each one that does. Only the table of C{model} itself is written. When
+    C{unique} is not the primary key, the primary keys of the new rows are
+    left to the database and not set on C{objects}.
+
+    @type model: C{Model} subclass
+    @param model: The model whose table is written.
+    @type objects: list
+    @param objects: Instances of C{model}. No two may share C{unique}.
+    @type unique: str or tuple
+    @param unique: The name of the field, or the names of the fields, with a
+        unique constraint to match rows on.
+    """
+    if not objects:
+        return
+    if isinstance(unique, basestring):
+        unique = (unique,)
+    opts = model._meta
+    fields = [field for field in opts.local_fields
+              if not (isinstance(field, AutoField) and
+                      field.name not in unique)]
+    qn = connection.ops.quote_name
+    table = qn(opts.db_table)
+    columns = [qn(field.column) for field in fields]
+    keys = [qn(_column(model, name)) for name in unique]
+    updated = [column for column in columns if column not in keys]
+    rows = [[field.get_db_prep_save(field.pre_save(obj, False),
+                                    connection = connection)
+             for field in fields] for obj in objects]
+
+    cursor = connection.cursor()
+    if _supports_upsert():
+        placeholders = '(%s)' % ', '.join(['%s'] * len(columns))
+        if updated:
+            action = 'UPDATE SET %s' % ', '.join(['%s = excluded.%s' %
+                     (column, column) for column in updated])
+        else:
+            action = 'NOTHING'
+        per_statement = max(1, MAX_VARIABLES // len(columns))
+        for start in xrange(0, len(rows), per_statement):
+            chunk = rows[start:start + per_statement]
+            cursor.execute('INSERT INTO %s (%s) VALUES %s ON CONFLICT (%s) '
+                           'DO %s' % (table, ', '.join(columns),
+                           ', '.join([placeholders] * len(chunk)),
+                           ', '.join(keys), action),
+                           [value for row in chunk for value in row])
+    else:
+        cursor.executemany('INSERT OR IGNORE INTO %s (%s) VALUES (%s)' % (
+                           table, ', '.join(columns),
+                           ', '.join(['%s'] * len(columns))), rows)
+        if updated:
+            positions = [columns.index(column) for column in updated] + \
+                        [columns.index(key) for key in keys]
+            cursor.executemany('UPDATE %s SET %s WHERE %s' % (table,
+                               ', '.join(['%s = %%s' % column
+                                          for column in updated]),
+                               ' AND '.join(['%s = %%s' % key
+                                             for key in keys])),
+                               [[row[i] for i in positions] for row in rows])
+    transaction.commit_unless_managed()
+
+def update_all(model, objects):
+    """Update the rows of C{objects}, which are already in the database,
+    with one batch of C{UPDATE}s per table: those of the parents of
+    C{model}, then that of C{model}. Unlike L{upsert}, this never inserts a
+    row, so objects deleted by another process since they were read stay
+    deleted.
+
+    @type model: C{Model} subclass
+    @param model: The model of C{objects}.
+    @type objects: list
+    @param objects: Saved instances of C{model}.
+    """
+    if not objects:
+        return
+    parents = list(model._meta.get_parent_list())
+    parents.sort(key = lambda parent: len(parent._meta.get_parent_list()))
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    for table_model in parents + [model]:
+        opts = table_model._meta
+        fields = [field for field in opts.local_fields
+                  if not field.primary_key]
+        if not fields:
+            continue
+        fields.append(opts.pk)
+        rows = [[field.get_db_prep_save(field.pre_save(obj, False),
+                                        connection = connection)
+                 for field in fields] for obj in objects]
+        cursor.executemany('UPDATE %s SET %s WHERE %s = %%s' % (
+                           qn(opts.db_table), ', '.join(['%s = %%s' %
+                           qn(field.column) for field in fields[:-1]]),
+                           qn(opts.pk.column)), rows)
+    transaction.commit_unless_managed()
@@ -2,23 +2,40 @@
 to TorCtl and handle communication concerning consensus documents and 
 descriptor files.
 
-@var debugfile: The debug file used by TorCtl .
+@var debugfile: The debug file used by TorCtl, opened when the first
+    L{CtlUtil} connects.
+@var tracer: The C{TorCtl.CallTracer} shared by the connections of every
+    L{CtlUtil}, or None if tracing is off.
 @var unparsable_email_file: A log file for contacts with unparsable emails.
+@var exit_policy_cache: Per-relay cache of the exit summary computed by
+    L{CtlUtil.is_exit}, keyed by fingerprint and invalidated when the relay's
+    descriptor changes.
 """
 
 import socket
 from TorCtl import TorCtl
 from config import config
+from weatherapp import metrics
 import logging
 import re
 import string
+import time
+from hashlib import sha1
 
 #for TorCtl
-debugfile = open('log/debug', 'w')
+debugfile = None
+if config.control_trace:
+    tracer = TorCtl.CallTracer(config.control_trace_size,
+                               config.control_trace_sample)
+else:
+    tracer = None
 
 #for unparsable emails
 unparsable_email_file = 'log/unparsable_emails.txt'
 
+#maps fingerprint -> (descriptor digest, exits to 80/443), see is_exit()
+exit_policy_cache = {}
+
 class CtlUtil:
     """A class that handles communication with the local Tor process via
     TorCtl.
@@ -77,7 +94,13 @@ class CtlUtil:
         self.control.authenticate(config.authenticator)
 
         # Set up log file
-        self.control.debug(debugfile)
+        global debugfile
+        if debugfile == None and config.control_debug_file:
+            debugfile = open(config.control_debug_file, 'w')
+        if debugfile:
+            self.control.debug(debugfile)
+        if tracer:
+            self.control.trace(tracer)
 
     def __del__(self):
         """Closes the connection when the CtlUtil object is garbage collected.
@@ -96,6 +119,27 @@ class CtlUtil:
         del self.control
         self.control = None
 
+    def _get_info(self, key):
+        """Send a GETINFO for C{key}, timed into C{metrics.control_seconds}.
+        Per-relay keys such as C{ns/id/<fingerprint>} are labelled without
+        the fingerprint.
+
+        @type key: str
+        @param key: The GETINFO key.
+        @rtype: dict {str: str}
+        @return: Maps C{key} to its value.
+        """
+        parts = key.split('/')
+        if len(parts) > 2 and parts[1] in ('id', 'name'):
+            command = 'GETINFO %s/%s' % (parts[0], parts[1])
+        else:
+            command = 'GETINFO ' + key
+        start = time.time()
+        try:
+            return self.control.get_info(key)
+        finally:
+            metrics.control_seconds.observe(time.time() - start, command)
+
     def get_single_consensus(self, node_id):
         """Get a consensus document for a specific router with fingerprint
         C{node_id}.
@@ -110,7 +154,7 @@ class CtlUtil:
         # all the info stored as the single value, so this extracts the string
         cons = ''
         try:
-            cons = self.control.get_info("ns/id/" + node_id).values()[0]
+            cons = self._get_info("ns/id/" + node_id).values()[0]
 
         except TorCtl.ErrorReply, e:
             #If we're getting here, we're likely seeing:
@@ -131,7 +175,7 @@ class CtlUtil:
         """
         # get_info method returns a dictionary with single mapping, with
         # all the info stored as the single value, so this extracts the string
-        return self.control.get_info("ns/all").values()[0]
+        return self._get_info("ns/all").values()[0]
 
     def get_single_descriptor(self, node_id):
         """Get a descriptor file for a specific router with fingerprint 
@@ -148,7 +192,7 @@ class CtlUtil:
         # all the info stored as the single value, so this extracts the string
         desc = ''
         try:
-            desc = self.control.get_info("desc/id/" + node_id).values()[0]
+            desc = self._get_info("desc/id/" + node_id).values()[0]
         except TorCtl.ErrorReply, e:
             logging.error("ErrorReply: %s" % str(e))
         except:
@@ -164,7 +208,7 @@ class CtlUtil:
         """
         # get_info method returns a dictionary with single mapping, with
         # all the info stored as the single value, so this extracts the string
-        return self.control.get_info("desc/all-recent").values()[0]
+        return self._get_info("desc/all-recent").values()[0]
 
     def get_descriptor_list(self):
         """Get a list of strings of all descriptor files for every router
@@ -179,7 +223,7 @@ class CtlUtil:
     def get_rec_version_list(self):
         """Get a list of currently recommended versions sorted in ascending
         order."""
-        return self.control.get_info("status/version/recommended").\
+        return self._get_info("status/version/recommended").\
         values()[0].split(',')
 
     def get_stable_version_list(self):
@@ -303,23 +347,32 @@ class CtlUtil:
         else:
             return True
 
-    def is_exit(self, node_id):
-        """Check if this node is an exit node (accepts exits to port 80).
+    def is_exit(self, node_id, descriptor = None):
+        """Check if this node is an exit node (accepts exits to port 80 or
+        443). The descriptor's exit policy is compiled into a
+        C{TorCtl.ExitPolicy} and the result is cached per relay in
+        C{exit_policy_cache} until the relay publishes a new descriptor.
         
         @type node_id: str
         @param node_id: The router's fingerprint
+        @type descriptor: str
+        @param descriptor: The router's descriptor, as in the map returned by
+            L{get_descriptor_map}. Fetched if not given.
         @rtype: bool
-        @return: True if this router accepts exits to port 80, false if not
-            or if the descriptor file can't be accessed for this router.
+        @return: True if this router accepts exits to port 80 or 443, false
+            if not or if the descriptor file can't be accessed for this
+            router.
         """
         try:
-            descriptor = self.get_single_descriptor(node_id)
-            desc_lines = descriptor.split('\n')
-            for line in desc_lines:
-                if (line.startswith('accept') and (line.endswith(':80') 
-                                                   or line.endswith('*:*'))):
-                    return True
-            return False
+            if descriptor == None:
+                descriptor = self.get_single_descriptor(node_id)
+            digest = sha1(descriptor).digest()
+            cached = exit_policy_cache.get(node_id)
+            if cached != None and cached[0] == digest:
+                return cached[1]
+            policy = TorCtl.ExitPolicy.build_from_desc(descriptor.split('\n'))
+            exit_policy_cache[node_id] = (digest, policy.web_exit)
+            return policy.web_exit
         except TorCtl.ErrorReply, e:
             logging.error("ErrorReply: %s" % str(e))
             return False
@@ -327,20 +380,52 @@ class CtlUtil:
             # some other error with the function
             logging.error("Unknown exception in ctlutil.Ctlutil.is_exit()")
 
-    def get_finger_name_list(self):
+    def get_descriptor_map(self, desc_list = None):
+        """Get the descriptor of every router in the current descriptor file
+        by fingerprint, so that per-router checks such as L{is_exit} need not
+        fetch them again one at a time.
+
+        @type desc_list: list[str]
+        @param desc_list: The descriptors to read, as returned by
+            L{get_descriptor_list}. Fetched if not given.
+        @rtype: dict {str: str}
+        @return: Dictionary mapping fingerprints to descriptors.
+        """
+        if desc_list == None:
+            desc_list = self.get_descriptor_list()
+
+        descriptors = {}
+        for desc in desc_list:
+            start = desc.find('opt fingerprint')
+            if start == -1:
+                continue
+            end = desc.find('\n', start)
+            if end == -1:
+                end = len(desc)
+            finger = desc[start + len('opt fingerprint'):end]
+            descriptors[finger.replace(' ', '')] = desc
+        return descriptors
+
+    def get_finger_name_list(self, desc_list = None):
         """Get a list of fingerprint and name pairs for all routers in the
         current descriptor file.
 
+        @type desc_list: list[str]
+        @param desc_list: The descriptors to read, as returned by
+            L{get_descriptor_list}. Fetched if not given.
         @rtype: list[(str,str)]
         @return: List of fingerprint and name pairs for all routers in the 
                  current descriptor file.
         """
+        if desc_list == None:
+            desc_list = self.get_descriptor_list()
+
         # Make a list of tuples of all router fingerprints in descriptor
         # with whitespace removed and router names.
         router_list= []
             
         # Loop through each individual descriptor file.
-        for desc in self.get_descriptor_list():
+        for desc in desc_list:
             finger = ""
 
             # Split each descriptor into lines.
@@ -362,6 +447,45 @@ class CtlUtil:
         
         return router_list
 
+    def get_observations(self, desc_list = None):
+        """Get the observed bandwidth, consensus flags and version of every
+        router in the current consensus, from one fetch of the consensus and
+        the descriptors.
+
+        @type desc_list: list[str]
+        @param desc_list: The descriptors to read, as returned by
+            L{get_descriptor_list}. Fetched if not given.
+        @rtype: dict {str: (int, list[str], str)}
+        @return: Dictionary mapping fingerprints to the bandwidth in kB/s (as
+            in L{get_bandwidth}), flags and version (as in L{get_version}) of
+            each router. Routers without a descriptor have bandwidth 0 and
+            version ''.
+        """
+        if desc_list == None:
+            desc_list = self.get_descriptor_list()
+
+        descs = {}
+        for desc in desc_list:
+            finger = ''
+            bandwidth = 0
+            version = ''
+            for line in desc.split('\n'):
+                if line.startswith('opt fingerprint'):
+                    finger = line.replace('opt fingerprint', '')
+                    finger = finger.replace(' ', '')
+                elif line.startswith('bandwidth'):
+                    bandwidth = int(line.split()[3]) / 1000
+                elif line.startswith('platform Tor '):
+                    version = line.split()[2]
+            if not finger == '':
+                descs[finger] = (bandwidth, version)
+
+        observations = {}
+        for ns in TorCtl.parse_ns_body(self.get_full_consensus()):
+            bandwidth, version = descs.get(ns.idhex, (0, ''))
+            observations[ns.idhex] = (bandwidth, ns.flags, version)
+        return observations
+
     def get_finger_list(self):
         """Get a list of fingerprints for all routers in the current
         descriptor file.
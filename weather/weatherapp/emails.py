@@ -1,5 +1,7 @@
 """The emails module contains methods to send individual confirmation and confirmed emails as well as methods to return tuples needed by Django's 
-send_mass_mail() method. Emails are sent after all database checks/updates. 
+send_mass_mail() method. Emails are sent after all database checks/updates,
+by L{send_mass_mime}. Message bodies are compiled with the generic footer
+once, at import, so each email is a single format operation.
 
 @type _SENDER: str
 @var _SENDER: The email address for the Tor Weather emailer
@@ -48,13 +50,31 @@ send_mass_mail() method. Emails are sent after all database checks/updates.
 @type _GENERIC_FOOTER: str
 @var _GENERIC_FOOTER: A footer containing unsubscribe and preferences page
     links.
+@type _DIGEST_SUBJ: str
+@var _DIGEST_SUBJ: The subject line for a digest of several notifications.
+@type _DIGEST_MAIL: str
+@var _DIGEST_MAIL: The introduction of a digest email.
+@type _DIGEST_SECTION: str
+@var _DIGEST_SECTION: One notification in a digest email, under its subject.
+@type _ROUTER_NAMES_MAX: int
+@var _ROUTER_NAMES_MAX: How many router names L{_get_router_name} remembers
+    before starting over; L{clear_cache} empties them for each run.
 """
+import os
 import re
+import time
+from itertools import count
 
-from config import url_helper
+from config import config, url_helper
 from weatherapp.models import insert_fingerprint_spaces
+from weatherapp import metrics
 
-from django.core.mail import send_mail
+from django.conf import settings
+from django.core.mail import send_mail, send_mass_mail, get_connection, \
+                             EmailMessage, BadHeaderError
+from django.core.mail.backends.smtp import EmailBackend
+from django.core.mail.utils import DNS_NAME
+from email.Utils import formatdate
 
 _SENDER = 'tor-ops@torproject.org'
 _SUBJECT_HEADER = '[Tor Weather] '
@@ -140,6 +160,38 @@ _GENERIC_FOOTER = "\n\nYou can unsubscribe from these reports at any time "+\
     "by visiting the following url:\n\n%s\n\nor change your Tor Weather "+\
     "notification preferences here: \n\n%s"
 
+_DIGEST_SUBJ = '%d notifications about your Tor nodes'
+_DIGEST_MAIL = "This is a Tor Weather Report.\n\n" +\
+    "Several of the Tor nodes you've been observing need your attention. "+\
+    "Each notification below has its own links to unsubscribe from, or "+\
+    "change the preferences of, the subscription that sent it."
+
+_DIGEST_SECTION = "\n\n" + "=" * 70 + "\n%s\n" + "=" * 70 + "\n\n%s"
+
+def _url_format(get_url):
+    """Returns the url made by C{get_url} for an auth key of C{%s}, as a
+    format string."""
+    return get_url('\0').replace('%', '%%').replace('\0', '%s')
+
+# The footer with the unsubscribe and preferences auth keys left to fill in.
+_FOOTER_FORMAT = _GENERIC_FOOTER % (
+    _url_format(url_helper.get_unsubscribe_url),
+    _url_format(url_helper.get_preferences_url))
+
+# Subjects and bodies (with the footer) compiled once, so each email is a
+# single format operation.
+_LOW_BANDWIDTH = (_SUBJECT_HEADER + _LOW_BANDWIDTH_SUBJ,
+                  _LOW_BANDWIDTH_MAIL + _FOOTER_FORMAT)
+_NODE_DOWN = (_SUBJECT_HEADER + _NODE_DOWN_SUBJ,
+              _NODE_DOWN_MAIL + _FOOTER_FORMAT)
+_T_SHIRT = (_SUBJECT_HEADER + _T_SHIRT_SUBJ, _T_SHIRT_MAIL + _FOOTER_FORMAT)
+_VERSION = (_SUBJECT_HEADER + _VERSION_SUBJ, _VERSION_MAIL + _FOOTER_FORMAT)
+_WELCOME = (_SUBJECT_HEADER + _WELCOME_SUBJ, _WELCOME_MAIL)
+
+_ROUTER_NAMES_MAX = 20000
+_router_names = {}
+
+
 
 def _get_router_name(fingerprint, name):
     """Returns a string representation of the name and fingerprint of
@@ -153,14 +205,28 @@ def _get_router_name(fingerprint, name):
     @rtype: str
     @return: An email-friendly string representation of the name and
     fingerprint. Only returns a representation of the fingerprint 
-    C{if name == 'Unnamed'}.
+    C{if name == 'Unnamed'}. Names are remembered until L{clear_cache}.
     """
 
+    key = (fingerprint, name)
+    try:
+        return _router_names[key]
+    except KeyError:
+        pass
     spaced_fingerprint = insert_fingerprint_spaces(fingerprint) 
     if name == 'Unnamed':
-        return "(id: %s)" % spaced_fingerprint
+        router = "(id: %s)" % spaced_fingerprint
     else:
-        return "%s (id: %s)" % (name, spaced_fingerprint)
+        router = "%s (id: %s)" % (name, spaced_fingerprint)
+    if len(_router_names) >= _ROUTER_NAMES_MAX:
+        _router_names.clear()
+    _router_names[key] = router
+    return router
+
+def clear_cache():
+    """Forget the router names remembered by L{_get_router_name}. Called at
+    the start of each run, so renamed routers are picked up."""
+    _router_names.clear()
 
 def _add_generic_footer(msg, unsubs_auth, pref_auth):
     """
@@ -224,10 +290,8 @@ def send_confirmed(recipient, fingerprint, name, unsubs_auth, pref_auth):
     router = _get_router_name(fingerprint, name)
     subj = _SUBJECT_HEADER + _CONFIRMED_SUBJ
     sender = _SENDER
-    unsubURL = url_helper.get_unsubscribe_url(unsubs_auth)
-    prefURL = url_helper.get_preferences_url(pref_auth)
     msg = _CONFIRMED_MAIL % router
-    msg = _add_generic_footer(msg, unsubURL, prefURL)
+    msg = _add_generic_footer(msg, unsubs_auth, pref_auth)
     send_mail(subj, msg, sender, [recipient], fail_silently=False)
 
 def bandwidth_tuple(recipient, fingerprint, name,  observed, threshold,
@@ -248,15 +312,9 @@ def bandwidth_tuple(recipient, fingerprint, name,  observed, threshold,
     @param pref_auth: The user's unique preferences auth key
     """
     router = _get_router_name(fingerprint, name)
-    subj = _SUBJECT_HEADER + _LOW_BANDWIDTH_SUBJ
-    sender = _SENDER
-    unsubURL = url_helper.get_unsubscribe_url(unsubs_auth)
-    prefURL = url_helper.get_preferences_url(pref_auth)
-
-    msg = _LOW_BANDWIDTH_MAIL % (router, observed, threshold)
-    msg = _add_generic_footer(msg, unsubURL, prefURL)
-
-    return (subj, msg, sender, [recipient])
+    subj, body = _LOW_BANDWIDTH
+    msg = body % (router, observed, threshold, unsubs_auth, pref_auth)
+    return (subj, msg, _SENDER, [recipient])
 
 def node_down_tuple(recipient, fingerprint, name, grace_pd, unsubs_auth, 
                     pref_auth):
@@ -277,16 +335,12 @@ def node_down_tuple(recipient, fingerprint, name, grace_pd, unsubs_auth,
         used by the send_mass_mail method in updaters.
     """
     router = _get_router_name(fingerprint, name)
-    subj = _SUBJECT_HEADER + _NODE_DOWN_SUBJ
-    sender = _SENDER
-    num_hours = grace_pd + " hour"
+    subj, body = _NODE_DOWN
+    num_hours = str(grace_pd) + " hour"
     if grace_pd > 1:
         num_hours += "s"
-    unsubURL = url_helper.get_unsubscribe_url(unsubs_auth)
-    prefURL = url_helper.get_preferences_url(pref_auth)
-    msg = _NODE_DOWN_MAIL % (router, num_hours)
-    msg = _add_generic_footer(msg, unsubURL, prefURL)
-    return (subj, msg, sender, [recipient])
+    msg = body % (router, num_hours, unsubs_auth, pref_auth)
+    return (subj, msg, _SENDER, [recipient])
 
 def t_shirt_tuple(recipient, fingerprint, name, avg_bandwidth, 
                   hours_since_triggered, is_exit, unsubs_auth, pref_auth):
@@ -314,17 +368,12 @@ def t_shirt_tuple(recipient, fingerprint, name, avg_bandwidth,
     router = _get_router_name(fingerprint, name)
     stable_message = 'running'
     if is_exit:
-        node_type += ' as an exit node'
+        stable_message += ' as an exit node'
     days_running = hours_since_triggered / 24
-    avg_bandwidth = avg_bandwidth
-    subj = _SUBJECT_HEADER + _T_SHIRT_SUBJ
-    sender = _SENDER
-    unsubURL = url_helper.get_unsubscribe_url(unsubs_auth)
-    prefURL = url_helper.get_preferences_url(pref_auth)
-    msg = _T_SHIRT_MAIL % (router, stable_message, days_running, 
-                           avg_bandwidth)
-    msg = _add_generic_footer(msg, unsubURL, prefURL)
-    return (subj, msg, sender, [recipient])
+    subj, body = _T_SHIRT
+    msg = body % (router, stable_message, days_running, avg_bandwidth,
+                  unsubs_auth, pref_auth)
+    return (subj, msg, _SENDER, [recipient])
 
 def welcome_tuple(recipient, fingerprint, name, exit):
     """Returns a tuple for the welcome email. If the operator runs an exit
@@ -342,15 +391,14 @@ def welcome_tuple(recipient, fingerprint, name, exit):
         used by the send_mass_mail method in updaters.
     """
     router = _get_router_name(fingerprint, name)
-    subj = _SUBJECT_HEADER + _WELCOME_SUBJ
-    sender = _SENDER
+    subj, body = _WELCOME
     append = ''
     # if the router is an exit node, append legal info 
     if exit:
         append = _LEGAL_INFO
     url = url_helper.get_home_url()
-    msg = _WELCOME_MAIL % (router, url, append)
-    return (subj, msg, sender, [recipient])
+    msg = body % (router, url, append)
+    return (subj, msg, _SENDER, [recipient])
 
 def version_tuple(recipient, fingerprint, name, version_type, unsubs_auth, 
                   pref_auth):
@@ -371,13 +419,156 @@ def version_tuple(recipient, fingerprint, name, version_type, unsubs_auth,
              C{updaters}.
     """
     router = _get_router_name(fingerprint, name)
-    subj = _SUBJECT_HEADER + _VERSION_SUBJ
-    sender = _SENDER
+    subj, body = _VERSION
     version_type = version_type.lower()
-    unsubURL = url_helper.get_unsubscribe_url(unsubs_auth)
-    prefURL = url_helper.get_preferences_url(pref_auth)
     downloadURL = url_helper.get_download_url()
-    msg = _VERSION_MAIL % (router, version_type, downloadURL)
-    msg = _add_generic_footer(msg, unsubURL, prefURL)
-                           
-    return (subj, msg, sender, [recipient])
+    msg = body % (router, version_type, downloadURL, unsubs_auth, pref_auth)
+    return (subj, msg, _SENDER, [recipient])
+
+def _digest_tuple(mails):
+    """Returns one tuple for an email holding all of C{mails}, which have the
+    same sender and recipients.
+
+    @type mails: list
+    @param mails: Email tuples as returned by the other methods of this
+        module.
+    @rtype: tuple
+    @return: A tuple listing information about the digest email.
+    """
+    subj = _SUBJECT_HEADER + _DIGEST_SUBJ % len(mails)
+    msg = _DIGEST_MAIL
+    for mail_subj, mail_msg, sender, recipients in mails:
+        if mail_subj.startswith(_SUBJECT_HEADER):
+            mail_subj = mail_subj[len(_SUBJECT_HEADER):]
+        msg += _DIGEST_SECTION % (mail_subj, mail_msg)
+    return (subj, msg, mails[0][2], mails[0][3])
+
+def digest(email_list, min_mails=None, max_mails=None):
+    """Group the tuples in C{email_list} by sender and recipients, replacing
+    each group of at least C{min_mails} emails by digest emails of at most
+    C{max_mails} notifications each. Every notification keeps its own
+    message, including its unsubscribe and preferences links.
+
+    @type email_list: list
+    @param email_list: Email tuples as returned by the other methods of this
+        module.
+    @type min_mails: int
+    @param min_mails: The fewest emails to one recipient that are sent as a
+        digest. Default is C{config.digest_min}; 0 turns digests off.
+    @type max_mails: int
+    @param max_mails: The most notifications in one digest. Default is
+        C{config.digest_max}.
+    @rtype: list
+    @return: The email tuples to send, in the order their recipients first
+        appear in C{email_list}.
+    """
+    if min_mails == None:
+        min_mails = config.digest_min
+    if max_mails == None:
+        max_mails = config.digest_max
+    if not min_mails:
+        return list(email_list)
+
+    groups = {}
+    order = []
+    for mail in email_list:
+        key = (mail[2], tuple(mail[3]))
+        if key not in groups:
+            groups[key] = []
+            order.append(key)
+        groups[key].append(mail)
+
+    mails = []
+    for key in order:
+        group = groups[key]
+        if len(group) < min_mails:
+            mails.extend(group)
+            continue
+        for start in xrange(0, len(group), max_mails):
+            chunk = group[start:start + max_mails]
+            if len(chunk) == 1:
+                mails.append(chunk[0])
+            else:
+                mails.append(_digest_tuple(chunk))
+    return mails
+
+_MIME_HEADERS = 'Content-Type: text/plain; charset="%s"\n' + \
+    'MIME-Version: 1.0\nContent-Transfer-Encoding: 7bit\nSubject: %s\n' + \
+    'From: %s\nTo: %s\nDate: %s\nMessage-ID: <%s.%s.%d@%s>\n\n%s'
+
+_message_ids = count()
+
+def mime_messages(email_list):
+    """Returns the messages for C{email_list} as they go to an SMTP server.
+    Plain ASCII emails, which are all the ones this module makes, are
+    written straight into a header template with one date for the whole
+    batch; any others are built by Django's C{EmailMessage}.
+
+    @type email_list: list
+    @param email_list: Email tuples as returned by the other methods of this
+        module.
+    @rtype: list
+    @return: A C{(sender, recipients, message)} tuple for each email, where
+        C{message} is the message as a string.
+    """
+    charset = settings.DEFAULT_CHARSET
+    date = formatdate()
+    stamp = int(time.time() * 100)
+    pid = os.getpid()
+    dns_name = str(DNS_NAME)
+    messages = []
+    for subj, msg, sender, recipients in email_list:
+        try:
+            header_text = ''.join((subj, sender) + tuple(recipients))
+            header_text.encode('ascii')
+            msg.encode('ascii')
+        except UnicodeError:
+            message = EmailMessage(subj, msg, sender,
+                                   recipients).message().as_string()
+        else:
+            if '\n' in header_text:
+                raise BadHeaderError("Header values can't contain newlines")
+            message = _MIME_HEADERS % (charset, subj, sender,
+                                       ', '.join(recipients), date, stamp,
+                                       pid, _message_ids.next(), dns_name,
+                                       msg)
+        messages.append((sender, recipients, message))
+    return messages
+
+def send_mass_mime(email_list, fail_silently=False):
+    """Sends the emails in C{email_list} over one connection. With the SMTP
+    email backend, the messages from L{mime_messages} are handed to the
+    server directly; other backends get C{send_mass_mail}.
+
+    @type email_list: list
+    @param email_list: Email tuples as returned by the other methods of this
+        module.
+    @type fail_silently: bool
+    @param fail_silently: Whether to ignore errors from the mail server.
+    @rtype: int
+    @return: The number of emails sent.
+    """
+    connection = get_connection(fail_silently=fail_silently)
+    if not isinstance(connection, EmailBackend):
+        sent = send_mass_mail(tuple(email_list), fail_silently=fail_silently,
+                              connection=connection)
+        metrics.emails_sent.inc(amount = sent)
+        return sent
+    if not email_list:
+        return 0
+    new_connection = connection.open()
+    try:
+        sent = 0
+        for sender, recipients, message in mime_messages(email_list):
+            try:
+                connection.connection.sendmail(sender, recipients, message)
+            except:
+                if not fail_silently:
+                    raise
+            else:
+                sent += 1
+    finally:
+        if new_connection:
+            connection.close()
+        metrics.emails_sent.inc(amount = sent)
+    return sent
@@ -0,0 +1,522 @@
+"""A module for exercising Tor Weather without a running Tor. L{FakeControlServer}
+listens on a local port and speaks the part of the Tor control protocol that
+TorCtl and L{CtlUtil<ctlutil.CtlUtil>} use: AUTHENTICATE, GETINFO for
+C{ns/*}, C{desc/*}, C{status/version/recommended} and C{version}, SETEVENTS,
+QUIT, and asynchronous 650 events. It serves a network of L{FakeRelay}s,
+either made up by L{synthetic_network} or read from recorded consensus and
+descriptor documents with L{FakeControlServer.load}, and can wait before
+each reply to imitate a slow Tor.
+
+@type RECOMMENDED_VERSIONS: list[str]
+@var RECOMMENDED_VERSIONS: The default answer to
+    C{GETINFO status/version/recommended}.
+@type EVENT_NAMES: list[str]
+@var EVENT_NAMES: The event names SETEVENTS accepts.
+"""
+
+import base64
+import random
+import re
+import socket
+import threading
+import time
+from datetime import datetime
+from hashlib import sha1
+
+RECOMMENDED_VERSIONS = ['0.2.1.26', '0.2.1.27', '0.2.2.19-alpha',
+                        '0.2.2.20-alpha']
+EVENT_NAMES = ['CIRC', 'STREAM', 'ORCONN', 'BW', 'DEBUG', 'INFO', 'NOTICE',
+               'WARN', 'ERR', 'NEWDESC', 'ADDRMAP', 'AUTHDIR_NEWDESCS',
+               'DESCCHANGED', 'NS', 'STATUS_GENERAL', 'STATUS_CLIENT',
+               'STATUS_SERVER', 'GUARD', 'STREAM_BW', 'CLIENTS_SEEN',
+               'NEWCONSENSUS', 'BUILDTIMEOUT_SET']
+
+def _b64(hex_digest):
+    """Encode a hex digest as the unpadded base64 used in consensus entries."""
+    return base64.b64encode(hex_digest.decode('hex')).rstrip('=')
+
+def _data_reply(key, data):
+    """Format C{data} as a multi-line GETINFO reply line for C{key}."""
+    lines = data.rstrip('\n').split('\n')
+    lines = [line.startswith('.') and '.' + line or line for line in lines]
+    return '250+%s=\r\n%s\r\n.\r\n' % (key, '\r\n'.join(lines))
+
+class FakeRelay:
+    """A relay in a fake network, which can write its own consensus entry and
+    server descriptor.
+
+    @type fingerprint: str
+    @ivar fingerprint: The relay's fingerprint, 40 hex digits.
+    @type name: str
+    @ivar name: The relay's nickname.
+    @type address: str
+    @ivar address: The relay's IP address.
+    @type or_port: int
+    @ivar or_port: The relay's OR port.
+    @type dir_port: int
+    @ivar dir_port: The relay's directory port, or 0.
+    @type flags: list[str]
+    @ivar flags: The relay's consensus flags. Relays without C{Running} are
+        left out of C{ns/all}.
+    @type bandwidth: int
+    @ivar bandwidth: The relay's observed bandwidth in kB/s.
+    @type version: str
+    @ivar version: The Tor version the relay runs.
+    @type contact: str
+    @ivar contact: The relay's contact line, or C{None}.
+    @type exit_policy: list[str]
+    @ivar exit_policy: The accept and reject lines of the relay's descriptor.
+    @type family: list[str]
+    @ivar family: Fingerprints of the relays the operator declares as the
+        same family.
+    @type published: datetime
+    @ivar published: When the relay's descriptor was published.
+    """
+
+    def __init__(self, fingerprint, name, address = '10.0.0.1',
+                 or_port = 9001, dir_port = 0,
+                 flags = ('Fast', 'Running', 'Stable', 'Valid'),
+                 bandwidth = 100, version = '0.2.2.20-alpha', contact = None,
+                 exit_policy = ('reject *:*',), family = (),
+                 published = None):
+        self.fingerprint = fingerprint.upper()
+        self.name = name
+        self.address = address
+        self.or_port = or_port
+        self.dir_port = dir_port
+        self.flags = list(flags)
+        self.bandwidth = bandwidth
+        self.version = version
+        self.contact = contact
+        self.exit_policy = list(exit_policy)
+        self.family = list(family)
+        if published == None:
+            published = datetime.now().replace(microsecond = 0)
+        self.published = published
+
+    def descriptor(self):
+        """Get the relay's server descriptor.
+
+        @rtype: str
+        """
+        fingerprint = ' '.join([self.fingerprint[i:i + 4]
+                                for i in xrange(0, 40, 4)])
+        lines = ['router %s %s %d 0 %d' % (self.name, self.address,
+                                           self.or_port, self.dir_port),
+                 'platform Tor %s on Linux x86_64' % self.version,
+                 'opt protocols Link 1 2 Circuit 1',
+                 'published %s' % self.published,
+                 'opt fingerprint %s' % fingerprint,
+                 'uptime 3600',
+                 'bandwidth %d %d %d' % (self.bandwidth * 2000,
+                                         self.bandwidth * 4000,
+                                         self.bandwidth * 1000)]
+        if self.family:
+            lines.append('family %s' % ' '.join(['$' + fingerprint
+                                                 for fingerprint in
+                                                 self.family]))
+        if self.contact:
+            lines.append('contact %s' % self.contact)
+        lines.extend(self.exit_policy)
+        lines.extend(['router-signature', '-----BEGIN SIGNATURE-----',
+                      base64.b64encode(sha1(self.fingerprint).digest() * 6),
+                      '-----END SIGNATURE-----'])
+        return '\n'.join(lines) + '\n'
+
+    def ns_entry(self):
+        """Get the relay's entry in the consensus.
+
+        @rtype: str
+        """
+        digest = sha1(self.descriptor()).hexdigest()
+        return 'r %s %s %s %s %s %d %d\ns %s\nw Bandwidth=%d\n' % (
+            self.name, _b64(self.fingerprint), _b64(digest), self.published,
+            self.address, self.or_port, self.dir_port, ' '.join(self.flags),
+            self.bandwidth)
+
+# Exit policies for synthetic relays, with how often each is picked.
+_POLICIES = [(0.55, ['reject *:*']),
+             (0.15, ['accept *:80', 'accept *:443', 'reject *:*']),
+             (0.1, ['reject 0.0.0.0/8:*', 'reject 10.0.0.0/8:*',
+                    'reject 127.0.0.0/8:*', 'reject 192.168.0.0/16:*',
+                    'reject *:25', 'reject *:119', 'reject *:135-139',
+                    'reject *:445', 'reject *:563', 'reject *:1214',
+                    'reject *:4661-4666', 'reject *:6346-6429',
+                    'reject *:6699', 'reject *:6881-6999', 'accept *:*']),
+             (0.1, ['accept *:20-23', 'accept *:43', 'accept *:53',
+                    'accept *:79-81', 'accept *:88', 'accept *:110',
+                    'accept *:143', 'accept *:194', 'accept *:220',
+                    'accept *:443', 'accept *:464', 'accept *:531',
+                    'accept *:543-544', 'accept *:563', 'accept *:706',
+                    'accept *:749', 'accept *:873', 'accept *:902-904',
+                    'accept *:981', 'accept *:989-995', 'reject *:*']),
+             (0.1, ['accept *:6660-6697', 'accept *:5222-5223',
+                    'reject *:*'])]
+
+def _choose(rand, weighted):
+    """Pick from a list of C{(weight, value)} pairs."""
+    point = rand.random() * sum([weight for weight, value in weighted])
+    for weight, value in weighted:
+        point -= weight
+        if point < 0:
+            return value
+    return weighted[-1][1]
+
+def synthetic_network(count, seed = 0, versions = RECOMMENDED_VERSIONS,
+                      family_fraction = 0.3):
+    """Make up a network of C{count} relays. The same C{seed} gives the same
+    network. Bandwidths follow a Pareto distribution, exit policies are
+    picked from a few common ones, newer versions are more likely, and some
+    operators run families of two to five relays.
+
+    @type count: int
+    @param count: The number of relays.
+    @type seed: int
+    @param seed: Seed for the random choices.
+    @type versions: list[str]
+    @param versions: The Tor versions to pick from, oldest first.
+    @type family_fraction: float
+    @param family_fraction: The share of relays that are in a family.
+    @rtype: list[L{FakeRelay}]
+    """
+    rand = random.Random(seed)
+    weighted_versions = [(i + 1, version)
+                         for i, version in enumerate(versions)]
+    relays = []
+    for i in xrange(count):
+        fingerprint = sha1('%d-%d' % (seed, i)).hexdigest().upper()
+        policy = _choose(rand, _POLICIES)
+        flags = ['Fast', 'Running', 'Valid']
+        if rand.random() < 0.6:
+            flags.insert(2, 'Stable')
+        if policy[-1] == 'accept *:*' or 'accept *:443' in policy:
+            flags.insert(0, 'Exit')
+        relays.append(FakeRelay(fingerprint, 'relay%d' % i,
+                                address = '10.%d.%d.%d' % (i >> 16,
+                                          (i >> 8) & 255, i & 255),
+                                flags = flags,
+                                bandwidth = int(rand.paretovariate(1.2) * 20),
+                                version = _choose(rand, weighted_versions),
+                                contact = 'op%d at example dot com' % i,
+                                exit_policy = policy))
+
+    i = 0
+    while i < count:
+        if rand.random() < family_fraction:
+            size = rand.randint(2, 5)
+            family = relays[i:i + size]
+            for relay in family:
+                relay.family = [other.fingerprint for other in family
+                                if other is not relay]
+                relay.contact = family[0].contact
+            i += size
+        else:
+            i += 1
+    return relays
+
+class FakeControlServer:
+    """A local stand-in for Tor's control port, for tests and benchmarks.
+    Call L{start} to listen on an unused port (see L{port}) and L{stop} when
+    done. The network served can be changed at any time; changes are seen by
+    the next command, and the event methods send 650 events to the
+    connections that asked for them.
+
+    @type authenticator: str
+    @ivar authenticator: The password AUTHENTICATE must give, or C{None} to
+        accept any.
+    @type latency: float or function
+    @ivar latency: Seconds to wait before each reply, or a function taking
+        the command line and returning that.
+    @type recommended: list[str]
+    @ivar recommended: The recommended versions.
+    @type commands: list[str]
+    @ivar commands: Every command received, in order.
+    @type host: str
+    @ivar host: The address the server listens on.
+    @type port: int
+    @ivar port: The port the server listens on, once started.
+    """
+
+    def __init__(self, relays = (), authenticator = None, latency = 0,
+                 recommended = RECOMMENDED_VERSIONS, host = '127.0.0.1'):
+        """Create a server for the network C{relays}.
+
+        @type relays: list[L{FakeRelay}]
+        @param relays: The relays of the network.
+        """
+        self.authenticator = authenticator
+        self.latency = latency
+        self.recommended = list(recommended)
+        self.commands = []
+        self.host = host
+        self.port = None
+        self._lock = threading.RLock()
+        self._connections = []
+        self._socket = None
+        self.set_relays(relays)
+
+    def set_relays(self, relays):
+        """Serve the network C{relays}.
+
+        @type relays: list[L{FakeRelay}]
+        """
+        ns = []
+        descs = []
+        for relay in relays:
+            descs.append((relay.fingerprint, relay.name, relay.descriptor()))
+            if 'Running' in relay.flags:
+                ns.append((relay.fingerprint, relay.name, relay.ns_entry()))
+        self._set_documents(ns, descs)
+
+    def load(self, ns_text, desc_text):
+        """Serve a recorded network: the output of C{GETINFO ns/all} and
+        C{GETINFO desc/all-recent}.
+
+        @type ns_text: str
+        @param ns_text: The consensus entries.
+        @type desc_text: str
+        @param desc_text: The server descriptors.
+        """
+        ns = []
+        for entry in re.split(r'(?m)^(?=r )', ns_text):
+            if entry.startswith('r '):
+                fields = entry.split()
+                fingerprint = (fields[2] + '=').decode('base64').encode(
+                    'hex').upper()
+                ns.append((fingerprint, fields[1], entry))
+        descs = []
+        for desc in desc_text.split('-----END SIGNATURE-----'):
+            match = re.search(r'(?m)^(?:opt )?fingerprint ([0-9A-F ]+)$',
+                              desc)
+            name = re.search(r'(?m)^router (\S+)', desc)
+            if match and name:
+                descs.append((match.group(1).replace(' ', ''),
+                              name.group(1),
+                              desc.lstrip('\n') + '-----END SIGNATURE-----\n'))
+        self._set_documents(ns, descs)
+
+    def _set_documents(self, ns, descs):
+        by_id = {}
+        by_name = {}
+        for fingerprint, name, entry in ns:
+            by_id['ns/id/' + fingerprint] = entry
+            by_name['ns/name/' + name] = entry
+        for fingerprint, name, desc in descs:
+            by_id['desc/id/' + fingerprint] = desc
+            by_name['desc/name/' + name] = desc
+        by_name.update(by_id)
+        by_name['ns/all'] = ''.join([entry for f, n, entry in ns])
+        by_name['desc/all-recent'] = ''.join([desc for f, n, desc in descs])
+        self._info = by_name
+
+    def start(self):
+        """Start listening, on an unused port unless L{port} is set.
+
+        @rtype: int
+        @return: The port.
+        """
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((self.host, self.port or 0))
+        self._socket.listen(5)
+        self.port = self._socket.getsockname()[1]
+        thread = threading.Thread(target = self._accept,
+                                  name = 'FakeControlServer')
+        thread.setDaemon(True)
+        thread.start()
+        return self.port
+
+    def stop(self):
+        """Stop listening and close every connection."""
+        if self._socket:
+            try:
+                self._socket.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self._socket.close()
+            self._socket = None
+        self._lock.acquire()
+        try:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+        finally:
+            self._lock.release()
+
+    def _accept(self):
+        while self._socket:
+            try:
+                sock, address = self._socket.accept()
+            except (socket.error, AttributeError):
+                return
+            connection = _Connection(self, sock)
+            self._lock.acquire()
+            try:
+                self._connections.append(connection)
+            finally:
+                self._lock.release()
+            thread = threading.Thread(target = connection.serve,
+                                      name = 'FakeControlConnection')
+            thread.setDaemon(True)
+            thread.start()
+
+    def _forget(self, connection):
+        self._lock.acquire()
+        try:
+            if connection in self._connections:
+                self._connections.remove(connection)
+        finally:
+            self._lock.release()
+
+    def _wait(self, command):
+        latency = self.latency
+        if callable(latency):
+            latency = latency(command)
+        if latency:
+            time.sleep(latency)
+
+    def getinfo(self, keys):
+        """Get the reply to C{GETINFO} for C{keys}.
+
+        @type keys: list[str]
+        @rtype: str
+        """
+        reply = []
+        for key in keys:
+            if key == 'status/version/recommended':
+                reply.append('250-%s=%s\r\n' % (key,
+                             ','.join(self.recommended)))
+            elif key == 'version':
+                reply.append('250-version=%s (fake)\r\n' %
+                             self.recommended[-1])
+            elif key in self._info:
+                reply.append(_data_reply(key, self._info[key]))
+            else:
+                return '552 Unrecognized key "%s"\r\n' % key
+        return ''.join(reply) + '250 OK\r\n'
+
+    def send_event(self, name, text):
+        """Send an event to the connections that asked for C{name} events.
+
+        @type name: str
+        @param name: The event name.
+        @type text: str
+        @param text: The whole event, 650 lines included.
+        """
+        self._lock.acquire()
+        try:
+            connections = list(self._connections)
+        finally:
+            self._lock.release()
+        for connection in connections:
+            if name in connection.events:
+                connection.write(text)
+
+    def ns_event(self, relays, name = 'NS'):
+        """Send an NS event for C{relays}.
+
+        @type relays: list[L{FakeRelay}]
+        @param relays: The relays whose status changed.
+        @type name: str
+        @param name: The event name; C{'NEWCONSENSUS'} sends a consensus.
+        """
+        body = ''.join([relay.ns_entry() for relay in relays])
+        self.send_event(name, '650+%s\r\n%s.\r\n650 OK\r\n' %
+                        (name, body.replace('\n', '\r\n')))
+
+    def new_consensus_event(self, relays):
+        """Serve C{relays} and send a NEWCONSENSUS event with the relays
+        that are running.
+
+        @type relays: list[L{FakeRelay}]
+        """
+        self.set_relays(relays)
+        self.ns_event([relay for relay in relays
+                       if 'Running' in relay.flags], 'NEWCONSENSUS')
+
+    def new_desc_event(self, relays):
+        """Send a NEWDESC event for C{relays}.
+
+        @type relays: list[L{FakeRelay}]
+        """
+        ids = ' '.join(['$%s~%s' % (relay.fingerprint, relay.name)
+                        for relay in relays])
+        self.send_event('NEWDESC', '650 NEWDESC %s\r\n' % ids)
+
+class _Connection:
+    """One client of a L{FakeControlServer}."""
+
+    def __init__(self, server, sock):
+        self.server = server
+        self.sock = sock
+        self.events = set()
+        self.authenticated = False
+        self._write_lock = threading.Lock()
+
+    def write(self, text):
+        self._write_lock.acquire()
+        try:
+            try:
+                self.sock.sendall(text)
+            except socket.error:
+                pass
+        finally:
+            self._write_lock.release()
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+
+    def serve(self):
+        reader = self.sock.makefile('rb')
+        try:
+            while True:
+                try:
+                    line = reader.readline()
+                except socket.error:
+                    break
+                if not line:
+                    break
+                command = line.rstrip('\r\n')
+                self.server.commands.append(command)
+                self.server._wait(command)
+                reply = self.handle(command)
+                self.write(reply)
+                if command.upper() == 'QUIT':
+                    break
+        finally:
+            self.server._forget(self)
+            self.close()
+
+    def handle(self, command):
+        parts = command.split(' ', 1)
+        verb = parts[0].upper()
+        arg = len(parts) > 1 and parts[1] or ''
+        if verb == 'QUIT':
+            return '250 closing connection\r\n'
+        if verb == 'AUTHENTICATE':
+            secret = arg.strip()
+            if secret.startswith('"') and secret.endswith('"'):
+                secret = secret[1:-1]
+            if self.server.authenticator != None and \
+                    secret != self.server.authenticator:
+                return '515 Authentication failed\r\n'
+            self.authenticated = True
+            return '250 OK\r\n'
+        if not self.authenticated:
+            return '514 Authentication required.\r\n'
+        if verb == 'GETINFO':
+            return self.server.getinfo(arg.split())
+        if verb == 'SETEVENTS':
+            names = [name.upper() for name in arg.split()]
+            if names and names[0] == 'EXTENDED':
+                names = names[1:]
+            for name in names:
+                if name not in EVENT_NAMES:
+                    return '552 Unrecognized event "%s"\r\n' % name
+            self.events = set(names)
+            return '250 OK\r\n'
+        return '510 Unrecognized command "%s"\r\n' % parts[0]
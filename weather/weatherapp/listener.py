@@ -1,47 +1,105 @@
 """A module for listening to TorCtl for new consensus events. When one occurs,
-initializes the checker/updater cascade in the updaters module."""
+initializes the checker/updater cascade in the updaters module. If
+C{config.node_down_events} is set, NS and NEWDESC events also go to a
+L{LivenessTracker<liveness.LivenessTracker>}, which handles node down and
+t-shirt subscriptions as their deadlines pass, driven by TorCtl timer
+events. Sending the listener SIGUSR1 profiles the next run of
+C{updaters.run_all}."""
 
 import sys, os
 import logging
 import socket
+import time
 
 from config import config
-from weatherapp import updaters
+from weatherapp import updaters, profiling
+from weatherapp.liveness import LivenessTracker
 from TorCtl import TorCtl
 
-#very basic log setup
-logging.basicConfig(format = '%(asctime) - 15s (%(process)d) %(message)s',
-                    level = logging.DEBUG, filename = 'log/weather.log')
-
 class MyEventHandler(TorCtl.EventHandler):
     """Extends C{TorCtl.EventHandler} so that C{updaters.run_all} is called
     when a NEWCONSENSUS event is received.
+
+    @type liveness: L{LivenessTracker<liveness.LivenessTracker>}
+    @ivar liveness: Tracker for node down and t-shirt subscriptions, or
+        C{None} to leave them to C{updaters.run_all}.
     """
+    def __init__(self, liveness = None):
+        TorCtl.EventHandler.__init__(self)
+        self.liveness = liveness
+
     def new_consensus_event(self, event):
         """Call C{updaters.run_all()} when a NEWCONSENSUS event is received.
 
-        @param event: The NEWCONSENSUS event. Not used by the function,
-                      but included so that this overrides 
-                      C{TorCtl.EventHandler.new_consensus_event}
+        @param event: The NEWCONSENSUS event. Passed on to L{liveness}, if
+                      there is one.
         """
 
         logging.info('Got a new consensus. Updating router table and ' + \
                      'checking all subscriptions.')
-        updaters.run_all()
+        if self.liveness:
+            self.liveness.consensus(event.nslist, event.arrived_at)
+            updaters.run_all(scheduled = True)
+        else:
+            updaters.run_all()
+
+    def ns_event(self, event):
+        """Pass the changed relay statuses of an NS event to L{liveness}."""
+        if self.liveness:
+            self.liveness.ns_event(event.nslist, event.arrived_at)
+
+    def new_desc_event(self, event):
+        """Pass the relays of a NEWDESC event to L{liveness}."""
+        if self.liveness:
+            self.liveness.new_desc_event(event.idlist, event.arrived_at)
 
-def listen():
+    def timer_event(self, event):
+        """Handle the subscriptions whose deadline has passed."""
+        if self.liveness:
+            self.liveness.timer_event(event)
+
+def wait(thread, interval = 1):
+    """Sleep until C{thread} exits. The main thread polls rather than joining
+    it, since Python 2 only runs signal handlers, such as the one installed
+    by C{profiling.install_signal}, once a join returns.
+
+    @type thread: threading.Thread
+    @param thread: The thread to wait for.
+    @type interval: float
+    @param interval: Seconds between checks.
+    """
+    while thread.isAlive():
+        time.sleep(interval)
+
+def listen(ctrl_host = '127.0.0.1', ctrl_port = config.control_port):
     """Sets up a connection to TorCtl and launches a thread to listen for
-    new consensus events.
+    new consensus events, then waits for the connection to close.
+
+    @type ctrl_host: str
+    @param ctrl_host: The host of the Tor control port.
+    @type ctrl_port: int
+    @param ctrl_port: The Tor control port.
     """
+    #very basic log setup
+    logging.basicConfig(format = '%(asctime) - 15s (%(process)d) %(message)s',
+                        level = logging.DEBUG, filename = 'log/weather.log')
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    ctrl_host = '127.0.0.1'
-    ctrl_port = config.control_port
     sock.connect((ctrl_host, ctrl_port))
     ctrl = TorCtl.Connection(sock)
-    ctrl.launch_thread(daemon=0)
+    thread = ctrl.launch_thread(daemon=0)
     ctrl.authenticate(config.authenticator)
-    ctrl.set_event_handler(MyEventHandler())
-    ctrl.set_events([TorCtl.EVENT_TYPE.NEWCONSENSUS])
+    if config.node_down_events:
+        liveness = LivenessTracker(config.liveness_tick)
+        liveness.load()
+        ctrl.set_event_handler(MyEventHandler(liveness))
+        ctrl.set_events([TorCtl.EVENT_TYPE.NEWCONSENSUS,
+                         TorCtl.EVENT_TYPE.NS, TorCtl.EVENT_TYPE.NEWDESC])
+        liveness.attach(ctrl)
+    else:
+        ctrl.set_event_handler(MyEventHandler())
+        ctrl.set_events([TorCtl.EVENT_TYPE.NEWCONSENSUS])
+    profiling.install_signal()
     print 'Listening for new consensus events.'
     logging.info('Listening for new consensus events.')
+    wait(thread)
 
@@ -0,0 +1,367 @@
+"""A module for event-driven subscription deadlines. L{LivenessTracker}
+follows NS, NEWDESC and NEWCONSENSUS events to keep, in memory, whether each
+relay is up. The L{NodeDownSub} and L{TShirtSub} rows of a relay are only
+touched when the relay goes down or comes back up. Their deadlines (the end
+of a node down grace period, and the uptime needed to earn a t-shirt) are
+kept in a L{Scheduler<scheduler.Scheduler>}, so a subscription is only looked
+at again when its deadline has passed, and an email goes out within one tick
+of it instead of at the next consensus. Subscriptions the web application
+adds are picked up at each consensus; only those added or confirmed since
+the last one are read.
+
+@type _TICK: int
+@var _TICK: Default seconds between deadline checks.
+@type _TSHIRT_RECHECK: int
+@var _TSHIRT_RECHECK: Seconds to wait before checking a t-shirt subscription
+    again when its relay has been up long enough but its average bandwidth
+    is too low.
+"""
+
+import time
+import logging
+from datetime import datetime, timedelta
+from smtplib import SMTPException
+
+from django.db.models import Q
+
+from weatherapp.models import Router, NodeDownSub, TShirtSub, RouterHistory
+from weatherapp.scheduler import Scheduler
+from weatherapp import emails, routerindex
+
+_TICK = 60
+_TSHIRT_RECHECK = 3600
+
+def _timestamp(when):
+    """Convert the local datetime C{when} to seconds since the epoch."""
+    return time.mktime(when.timetuple()) + when.microsecond / 1e6
+
+class LivenessTracker:
+    """Tracks which relays are up and drives L{NodeDownSub} and L{TShirtSub}
+    subscriptions from the transitions.
+
+    @type up: dict {str: bool}
+    @ivar up: Maps relay fingerprints to whether the relay is up.
+    @type watched: set
+    @ivar watched: Fingerprints of relays with confirmed L{NodeDownSub} or
+        unearned L{TShirtSub} subscriptions; only these cause database
+        writes. Relays stay in it until the next L{load}, even if their
+        subscriptions are removed.
+    @type scheduler: L{Scheduler<scheduler.Scheduler>}
+    @ivar scheduler: Subscription deadlines, as C{'node_down'} and
+        C{'tshirt'} items keyed by subscription id.
+    """
+
+    def __init__(self, tick = _TICK, now = None):
+        """Create an empty tracker. Call L{load} before feeding it events.
+
+        @type tick: int
+        @param tick: Seconds between deadline checks.
+        @type now: float
+        @param now: The current time in seconds since the epoch.
+        """
+        self.up = {}
+        self.watched = set()
+        self.scheduler = Scheduler(tick, now = now)
+        self.scheduler.add_kind('node_down', self._node_down_due,
+                                self._node_down_pending)
+        self.scheduler.add_kind('tshirt', self._tshirt_due,
+                                self._tshirt_pending)
+        self._email_list = []
+        self._last_id = {}
+        self._unconfirmed = {}
+
+    def load(self):
+        """Read the last known state of every relay and the pending
+        deadlines from the database."""
+        self.up = dict(Router.objects.values_list('fingerprint', 'up'))
+        self.watched = set()
+        self._last_id = {}
+        self._unconfirmed = {}
+        self.refresh_watched()
+        self.scheduler.load()
+
+    def refresh_watched(self, now = None):
+        """Watch the relays of subscriptions added or confirmed since the
+        last call, since the web application adds them from another process,
+        and start the new subscriptions of relays that are already down (for
+        node down) or up (for t-shirts).
+
+        Pending node down deadlines are also worked out again, so grace
+        periods changed on the preferences page take effect.
+
+        @type now: float
+        @param now: The current time in seconds since the epoch.
+        """
+        if now == None:
+            now = time.time()
+        changed = datetime.fromtimestamp(now)
+        for sub_id, deadline in self._node_down_pending():
+            if self.scheduler.due_time('node_down', sub_id) != deadline:
+                self.scheduler.schedule('node_down', sub_id, deadline)
+        for sub in self._new_subs(NodeDownSub):
+            fingerprint = sub.subscriber.router.fingerprint
+            self.watched.add(fingerprint)
+            if not sub.triggered and \
+               not self.up.get(fingerprint, sub.subscriber.router.up):
+                self._node_down(sub, False, changed)
+        for sub in self._new_subs(TShirtSub):
+            if sub.emailed:
+                continue
+            fingerprint = sub.subscriber.router.fingerprint
+            self.watched.add(fingerprint)
+            if not sub.triggered and \
+               self.up.get(fingerprint, sub.subscriber.router.up):
+                self._tshirt(sub, True, changed)
+
+    def _new_subs(self, model):
+        """Get the confirmed subscriptions of C{model} that were added, or
+        whose subscriber confirmed, since the last call. Unconfirmed ones are
+        remembered and looked at again on the next call.
+
+        @type model: class
+        @param model: L{NodeDownSub} or L{TShirtSub}.
+        @rtype: list
+        @return: The subscriptions, with their subscribers and routers.
+        """
+        last = self._last_id.get(model, 0)
+        unconfirmed = self._unconfirmed.get(model, set())
+        query = Q(id__gt = last)
+        if unconfirmed:
+            query |= Q(id__in = list(unconfirmed))
+        subs = model.objects.filter(query).select_related(
+            'subscriber__router')
+        new = []
+        self._unconfirmed[model] = set()
+        for sub in subs:
+            last = max(last, sub.id)
+            if sub.subscriber.confirmed:
+                new.append(sub)
+            else:
+                self._unconfirmed[model].add(sub.id)
+        self._last_id[model] = last
+        return new
+
+    def _node_down_pending(self):
+        pending = NodeDownSub.objects.filter(triggered = True,
+                                             emailed = False,
+                                             subscriber__confirmed = True)
+        return [(sub.id, self._node_down_deadline(sub)) for sub in pending]
+
+    def _node_down_deadline(self, sub):
+        return _timestamp(sub.last_changed + timedelta(hours = sub.grace_pd))
+
+    def _tshirt_pending(self):
+        pending = TShirtSub.objects.filter(triggered = True, emailed = False,
+                                           subscriber__confirmed = True)
+        return [(sub.id, self._tshirt_deadline(sub)) for sub in pending]
+
+    def _tshirt_deadline(self, sub):
+        return _timestamp(sub.last_changed +
+                          timedelta(hours = TShirtSub._UPTIME_HOURS))
+
+    def _node_down(self, sub, up, changed):
+        """Update the node down subscription C{sub} for its relay going up
+        or down at C{changed}."""
+        if up:
+            self.scheduler.cancel('node_down', sub.id)
+            if sub.triggered:
+                sub.triggered = False
+                sub.emailed = False
+                sub.last_changed = changed
+                sub.save()
+        else:
+            if not sub.triggered:
+                sub.triggered = True
+                sub.last_changed = changed
+                sub.save()
+            if not sub.emailed:
+                self.scheduler.schedule('node_down', sub.id,
+                                        self._node_down_deadline(sub))
+
+    def _tshirt(self, sub, up, changed):
+        """Update the t-shirt subscription C{sub} for its relay going up or
+        down at C{changed}; the uptime count restarts either way."""
+        if up == sub.triggered:
+            return
+        sub.triggered = up
+        sub.avg_bandwidth = 0
+        sub.last_changed = changed
+        sub.save()
+        if up:
+            self.scheduler.schedule('tshirt', sub.id,
+                                    self._tshirt_deadline(sub))
+        else:
+            self.scheduler.cancel('tshirt', sub.id)
+
+    def set_up(self, fingerprint, up, now = None):
+        """Record that the relay C{fingerprint} is up (or down), updating its
+        subscriptions if that is a change.
+
+        @type fingerprint: str
+        @param fingerprint: The relay's fingerprint, without spaces.
+        @type up: bool
+        @param up: Whether the relay is up.
+        @type now: float
+        @param now: When it was seen, in seconds since the epoch.
+        """
+        if self.up.get(fingerprint) == up:
+            return
+        self.up[fingerprint] = up
+        if fingerprint not in self.watched:
+            return
+        if now == None:
+            now = time.time()
+        changed = datetime.fromtimestamp(now)
+
+        logging.debug('Relay %s went %s.' % (fingerprint,
+                                             up and 'up' or 'down'))
+        Router.objects.filter(fingerprint = fingerprint).update(up = up)
+        for sub in NodeDownSub.objects.filter(
+                subscriber__router__fingerprint = fingerprint,
+                subscriber__confirmed = True):
+            self._node_down(sub, up, changed)
+        for sub in TShirtSub.objects.filter(
+                subscriber__router__fingerprint = fingerprint,
+                subscriber__confirmed = True, emailed = False):
+            self._tshirt(sub, up, changed)
+
+    def ns_event(self, nslist, now = None):
+        """Update from the entries of an NS event; a relay is up if it has the
+        Running flag.
+
+        @type nslist: list[TorCtl.NetworkStatus]
+        @param nslist: The changed network status entries.
+        """
+        for ns in nslist:
+            self.set_up(ns.idhex, 'Running' in ns.flags, now)
+
+    def new_desc_event(self, idlist, now = None):
+        """Update from a NEWDESC event; a relay publishing a descriptor is up.
+
+        @type idlist: list[str]
+        @param idlist: The relays, as C{$fingerprint} optionally followed by
+            C{~name} or C{=name}.
+        """
+        for relay in idlist:
+            fingerprint = relay.lstrip('$').split('~')[0].split('=')[0]
+            self.set_up(fingerprint, True, now)
+
+    def consensus(self, nslist, now = None):
+        """Update from a full consensus. Relays with the Running flag are up;
+        every other relay that was up is down.
+
+        @type nslist: list[TorCtl.NetworkStatus]
+        @param nslist: The entries of the consensus.
+        """
+        self.refresh_watched(now)
+        running = set([ns.idhex for ns in nslist if 'Running' in ns.flags])
+        for fingerprint in running:
+            self.set_up(fingerprint, True, now)
+        for fingerprint, up in self.up.items():
+            if up and fingerprint not in running:
+                self.set_up(fingerprint, False, now)
+
+    def _node_down_due(self, sub_id, now):
+        """Queue the node down email of the subscription C{sub_id}, whose
+        grace period has ended. The grace period is read again, since it can
+        be changed on the preferences page; if the new one has not ended, the
+        subscription is rescheduled instead."""
+        try:
+            sub = NodeDownSub.objects.get(id = sub_id)
+        except NodeDownSub.DoesNotExist:
+            return None
+        if not sub.triggered or sub.emailed or not sub.subscriber.confirmed:
+            return None
+        deadline = self._node_down_deadline(sub)
+        if deadline > now:
+            return deadline
+        router = sub.subscriber.router
+        self._email_list.append(emails.node_down_tuple(sub.subscriber.email,
+                                router.fingerprint, router.name, sub.grace_pd,
+                                sub.subscriber.unsubs_auth,
+                                sub.subscriber.pref_auth))
+        sub.emailed = True
+        sub.save()
+        return None
+
+    def _tshirt_due(self, sub_id, now):
+        """Check the t-shirt subscription C{sub_id}, whose relay has been up
+        long enough. The average bandwidth comes from the relay's
+        L{RouterHistory} since it came up. If it is too low, the subscription
+        is checked again after L{_TSHIRT_RECHECK} seconds. A relay with no
+        history in that time, as when history has only just started being
+        kept, is judged on its observed bandwidth in the router index
+        instead."""
+        try:
+            sub = TShirtSub.objects.get(id = sub_id)
+        except TShirtSub.DoesNotExist:
+            return None
+        if not sub.triggered or sub.emailed or not sub.subscriber.confirmed:
+            return None
+        router = sub.subscriber.router
+        up_seconds, bandwidth = RouterHistory.summary(router,
+                sub.last_changed, datetime.fromtimestamp(now))
+        if not up_seconds:
+            index = routerindex.shared()
+            entry = index and index.get(router.fingerprint)
+            if entry:
+                bandwidth = entry[2]
+        sub.avg_bandwidth = int(bandwidth)
+        if not sub.should_email():
+            sub.save()
+            return now + _TSHIRT_RECHECK
+        self._email_list.append(emails.t_shirt_tuple(sub.subscriber.email,
+                                router.fingerprint, router.name,
+                                sub.avg_bandwidth,
+                                sub.get_hours_since_triggered(), router.exit,
+                                sub.subscriber.unsubs_auth,
+                                sub.subscriber.pref_auth))
+        sub.emailed = True
+        sub.save()
+        return None
+
+    def send(self):
+        """Send the emails queued by the deadlines that have passed, as
+        digests where one recipient has several.
+
+        @rtype: list
+        @return: The email tuples sent.
+        """
+        email_list, self._email_list = self._email_list, []
+        if email_list:
+            try:
+                emails.send_mass_mime(emails.digest(email_list),
+                                      fail_silently = False)
+            except SMTPException, e:
+                logging.info(e)
+        return email_list
+
+    def tick(self, now = None):
+        """Handle the subscriptions whose deadline has passed by C{now} and
+        send their emails.
+
+        @type now: float
+        @param now: The current time in seconds since the epoch.
+        @rtype: list
+        @return: The email tuples sent.
+        """
+        self.scheduler.run(now)
+        return self.send()
+
+    def attach(self, conn):
+        """Have C{conn} deliver the timer events for L{timer_event}.
+
+        @type conn: C{TorCtl.Connection}
+        @param conn: An authenticated connection.
+        """
+        self.scheduler.attach(conn, 'liveness')
+
+    def timer_event(self, event):
+        """Handle the deadlines that have passed if C{event} is one of the
+        timer events asked for by L{attach}.
+
+        @type event: C{TorCtl.TimerEvent}
+        @param event: A timer event from the connection.
+        """
+        if self.scheduler.timer_event(event):
+            self.send()
@@ -0,0 +1,379 @@
+"""A module for instrumenting the updater pipeline. Counters and histograms
+are kept in a process-local L{Registry}, L{registry}, and rendered in the
+Prometheus text format by L{Registry.render}. The updater phases, control
+port calls, ORM queries and mail sends are measured into the metrics below,
+and L{start_run} and L{finish_run} collect what one consensus run used into a
+L{RunSummary}.
+
+@type DEFAULT_BUCKETS: tuple
+@var DEFAULT_BUCKETS: Histogram bucket upper bounds in seconds.
+@type registry: L{Registry}
+@var registry: The registry of this process.
+@type phase_seconds: L{Histogram}
+@var phase_seconds: Time spent in each updater phase, by C{phase}.
+@type control_seconds: L{Histogram}
+@var control_seconds: Time spent in control port calls, by C{command}.
+@type query_seconds: L{Histogram}
+@var query_seconds: Time spent in ORM queries.
+@type emails_sent: L{Counter}
+@var emails_sent: Emails handed to the mail backend.
+@type run_seconds: L{Histogram}
+@var run_seconds: Time taken by whole updater runs.
+"""
+
+import time
+from bisect import bisect_left
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60,
+                   120, 300)
+
+def _format_value(value):
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+def _format_labels(names, values, extra = ()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(['%s="%s"' % (name, str(value).replace(
+        '\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs])
+
+class Counter:
+    """A count that only goes up, kept per combination of label values.
+
+    @type name: str
+    @ivar name: The metric name.
+    @type help: str
+    @ivar help: A description of the metric.
+    @type labelnames: tuple
+    @ivar labelnames: The names of the labels.
+    @type values: dict {tuple: float}
+    @ivar values: Maps label values to counts.
+    """
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def inc(self, *labels, **kw):
+        """Add to the count for C{labels}, given in the order of
+        L{labelnames}. The C{amount} keyword argument is what to add, 1 if
+        it is not given."""
+        self.values[labels] = self.values.get(labels, 0) + \
+                              kw.get('amount', 1)
+
+    def total(self):
+        """Get the sum of the counts for all label values."""
+        return sum(self.values.values())
+
+    def render(self):
+        lines = []
+        for labels, value in sorted(self.values.items()):
+            lines.append('%s%s %s' % (self.name,
+                         _format_labels(self.labelnames, labels),
+                         _format_value(value)))
+        return lines
+
+class Histogram:
+    """Observations counted into buckets, kept per combination of label
+    values.
+
+    @type name: str
+    @ivar name: The metric name.
+    @type help: str
+    @ivar help: A description of the metric.
+    @type labelnames: tuple
+    @ivar labelnames: The names of the labels.
+    @type buckets: tuple
+    @ivar buckets: The bucket upper bounds, ascending.
+    @type values: dict {tuple: list}
+    @ivar values: Maps label values to C{[bucket counts, sum, count]}.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames = (),
+                 buckets = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.values = {}
+
+    def observe(self, value, *labels):
+        """Record C{value} for C{labels}, given in the order of
+        L{labelnames}."""
+        try:
+            state = self.values[labels]
+        except KeyError:
+            state = self.values[labels] = [[0] * len(self.buckets), 0.0, 0]
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            state[0][index] += 1
+        state[1] += value
+        state[2] += 1
+
+    def total(self):
+        """Get the number of observations for all label values."""
+        return sum([state[2] for state in self.values.values()])
+
+    def render(self):
+        lines = []
+        for labels, (counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                lines.append('%s_bucket%s %d' % (self.name,
+                             _format_labels(self.labelnames, labels,
+                                            [('le', _format_value(bound))]),
+                             cumulative))
+            lines.append('%s_bucket%s %d' % (self.name,
+                         _format_labels(self.labelnames, labels,
+                                        [('le', '+Inf')]), count))
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append('%s_sum%s %s' % (self.name, label_text,
+                                          _format_value(total)))
+            lines.append('%s_count%s %d' % (self.name, label_text, count))
+        return lines
+
+class Registry:
+    """The metrics of a process.
+
+    @type metrics: list
+    @ivar metrics: The L{Counter}s and L{Histogram}s, in creation order.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help, labelnames = ()):
+        """Create and register a L{Counter}."""
+        metric = Counter(name, help, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labelnames = (),
+                  buckets = DEFAULT_BUCKETS):
+        """Create and register a L{Histogram}."""
+        metric = Histogram(name, help, labelnames, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def reset(self):
+        """Forget every observation."""
+        for metric in self.metrics:
+            metric.values = {}
+
+    def render(self):
+        """Get every metric in the Prometheus text format.
+
+        @rtype: str
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+phase_seconds = registry.histogram('weather_phase_seconds',
+        'Time spent in each updater phase.', ('phase',))
+control_seconds = registry.histogram('weather_control_seconds',
+        'Time spent in Tor control port calls.', ('command',))
+query_seconds = registry.histogram('weather_query_seconds',
+        'Time spent in database queries.')
+emails_sent = registry.counter('weather_emails_sent_total',
+        'Emails handed to the mail backend.')
+run_seconds = registry.histogram('weather_run_seconds',
+        'Time taken by whole updater runs.')
+
+class phase:
+    """Times an updater phase into L{phase_seconds} and the current
+    L{RunSummary}, either as a decorator of the function that is the phase,
+    or as a C{with} block around it.
+
+    @type name: str
+    @ivar name: The name of the phase.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._starts = []
+
+    def __enter__(self):
+        self._starts.append(time.time())
+        return self
+
+    def __exit__(self, type, value, traceback):
+        elapsed = time.time() - self._starts.pop()
+        phase_seconds.observe(elapsed, self.name)
+        if _current_run:
+            _current_run.phases[self.name] = \
+                _current_run.phases.get(self.name, 0) + elapsed
+        return False
+
+    def __call__(self, function):
+        def timed(*args, **kwargs):
+            self.__enter__()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.__exit__(None, None, None)
+        timed.__name__ = function.__name__
+        timed.__doc__ = function.__doc__
+        return timed
+
+class _CountingCursor:
+    """Wraps a database cursor to time its queries into L{query_seconds}."""
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, sql, params = ()):
+        start = time.time()
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            query_seconds.observe(time.time() - start)
+
+    def executemany(self, sql, param_list):
+        start = time.time()
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            query_seconds.observe(time.time() - start)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+def count_queries():
+    """Time every ORM query of this process into L{query_seconds}, by
+    wrapping the cursors Django's database connections hand out. Calling
+    this again does nothing."""
+    from django.db.backends import BaseDatabaseWrapper
+    if getattr(BaseDatabaseWrapper.cursor, 'counts_queries', False):
+        return
+    cursor = BaseDatabaseWrapper.cursor
+    def counting_cursor(self):
+        return _CountingCursor(cursor(self))
+    counting_cursor.counts_queries = True
+    BaseDatabaseWrapper.cursor = counting_cursor
+
+class RunSummary:
+    """What one updater run used.
+
+    @type started: float
+    @ivar started: When the run started, in seconds since the epoch.
+    @type seconds: float
+    @ivar seconds: How long the run took.
+    @type phases: dict {str: float}
+    @ivar phases: Seconds spent in each phase.
+    @type queries: int
+    @ivar queries: Database queries made.
+    @type control_calls: int
+    @ivar control_calls: Control port calls made.
+    @type emails: int
+    @ivar emails: Emails sent.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.seconds = 0
+        self.phases = {}
+        self.queries = 0
+        self.control_calls = 0
+        self.emails = 0
+        self._start_counts = self._counts()
+
+    def _counts(self):
+        return (query_seconds.total(), control_seconds.total(),
+                emails_sent.total())
+
+    def finish(self):
+        self.seconds = time.time() - self.started
+        counts = self._counts()
+        self.queries, self.control_calls, self.emails = \
+            [int(end - start) for start, end in zip(self._start_counts,
+                                                    counts)]
+
+_current_run = None
+
+def start_run():
+    """Start collecting a L{RunSummary} for an updater run.
+
+    @rtype: L{RunSummary}
+    """
+    global _current_run
+    _current_run = RunSummary()
+    return _current_run
+
+def finish_run(run):
+    """Finish collecting C{run} and time it into L{run_seconds}.
+
+    @type run: L{RunSummary}
+    @rtype: L{RunSummary}
+    """
+    global _current_run
+    run.finish()
+    run_seconds.observe(run.seconds)
+    if _current_run is run:
+        _current_run = None
+    return run
+
+def render_gauge(name, help, samples, labelnames = ()):
+    """Get a gauge in the Prometheus text format, for values that are not
+    kept in a L{Registry}, such as those of an updater run in another
+    process.
+
+    @type name: str
+    @param name: The metric name.
+    @type help: str
+    @param help: A description of the metric.
+    @type samples: list
+    @param samples: C{(label values, value)} pairs.
+    @type labelnames: tuple
+    @param labelnames: The names of the labels.
+    @rtype: str
+    """
+    lines = ['# HELP %s %s' % (name, help), '# TYPE %s gauge' % name]
+    for labels, value in samples:
+        lines.append('%s%s %s' % (name, _format_labels(labelnames, labels),
+                                  _format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+def render_run(run):
+    """Get the last updater run as gauges in the Prometheus text format.
+
+    @type run: L{RunSummary} or C{models.UpdaterRun}
+    @param run: A finished run; an C{UpdaterRun} has its phases as JSON.
+    @rtype: str
+    """
+    phases = run.phases
+    if isinstance(phases, basestring):
+        phases = run.get_phases()
+    started = run.started
+    if not isinstance(started, (int, float)):
+        started = time.mktime(started.timetuple())
+    text = render_gauge('weather_last_run_started_seconds',
+                        'When the last updater run started.',
+                        [((), started)])
+    for field, help in [('seconds', 'Time taken by the last updater run.'),
+                        ('queries', 'Database queries of the last run.'),
+                        ('control_calls',
+                         'Control port calls of the last run.'),
+                        ('emails', 'Emails sent by the last run.')]:
+        text += render_gauge('weather_last_run_' + field, help,
+                             [((), getattr(run, field))])
+    text += render_gauge('weather_last_run_phase_seconds',
+                         'Time spent in each phase of the last run.',
+                         sorted([((name,), seconds) for name, seconds
+                                 in phases.items()]), ('phase',))
+    return text
@@ -7,33 +7,46 @@ L{Subscription} for the various subscription types and three classes for forms
 the work of the forms displayed on the sign-up and preferences pages.
 
 @group Helper Functions: insert_fingerprint_spaces, get_rand_string,
-    hours_since
-@group Models: Router, Subscriber, Subscription
+    hours_since, flags_to_mask, mask_to_flags, version_to_id, id_to_version
+@group Models: Router, Subscriber, Subscription, RouterHistory
 @group Subscription Subclasses: NodeDownSub, VersionSub, BandwidthSub, 
     TShirtSub
 @group Forms: GenericForm, SubscribeForm, PreferencesForm
 @group Custom Fields: PrefixedIntegerField
 """
 
-from datetime import datetime
+from datetime import datetime, time, timedelta
+import array
 import base64
 import os
 import re
+import sys
 from copy import copy
 
 from config import url_helper
+from weatherapp.bulk import upsert, update_all
+from weatherapp import pragmas # sets up new SQLite connections
+from weatherapp import routerindex
 
-from django.db import models
+from django.db import models, transaction
 from django import forms
 from django.core import validators
 from django.core.exceptions import ValidationError
+from django.utils import simplejson
 
 
 # HELPER FUNCTIONS ------------------------------------------------------------
 # ----------------------------------------------------------------------------- 
 
+# Fingerprints already spaced by insert_fingerprint_spaces, and how many to
+# keep before starting over.
+_spaced_fingerprints = {}
+_SPACED_FINGERPRINTS_MAX = 20000
+
 def insert_fingerprint_spaces(fingerprint):
-    """Insert a space into C{fingerprint} every four characters.
+    """Insert a space into C{fingerprint} every four characters. Results are
+    remembered, since the same fingerprints are spaced for every email and
+    page about them.
 
     @type fingerprint: str
     @arg fingerprint: A router L{fingerprint<Router.fingerprint>}
@@ -43,7 +56,17 @@ def insert_fingerprint_spaces(fingerprint):
     four characters.
     """
 
-    return ' '.join(re.findall('.{4}', str(fingerprint)))
+    try:
+        return _spaced_fingerprints[fingerprint]
+    except KeyError:
+        pass
+    fingerprint_str = str(fingerprint)
+    spaced = ' '.join([fingerprint_str[i:i + 4] for i in
+                       xrange(0, len(fingerprint_str) - 3, 4)])
+    if len(_spaced_fingerprints) >= _SPACED_FINGERPRINTS_MAX:
+        _spaced_fingerprints.clear()
+    _spaced_fingerprints[fingerprint] = spaced
+    return spaced
 
 def get_rand_string():
     """Returns a random, url-safe string of 24 characters (no '+' or '/'
@@ -74,6 +97,65 @@ def hours_since(time):
     hours = (delta.days * 24) + (delta.seconds / 3600)
     return hours
 
+# Bit order of the flags bitmask stored by RouterHistory.
+RELAY_FLAGS = ('Authority', 'BadExit', 'Exit', 'Fast', 'Guard', 'HSDir',
+               'Named', 'Running', 'Stable', 'Unnamed', 'V2Dir', 'Valid')
+
+def flags_to_mask(flags):
+    """Pack a list of consensus flags into a bitmask. Unknown flags are
+    dropped.
+
+    @type flags: list[str]
+    @arg flags: Flag names, as in the consensus "s" line.
+    @rtype: int
+    @return: The bitmask, with bit i set for C{RELAY_FLAGS[i]}.
+    """
+
+    mask = 0
+    for i, flag in enumerate(RELAY_FLAGS):
+        if flag in flags:
+            mask |= 1 << i
+    return mask
+
+def mask_to_flags(mask):
+    """Unpack a bitmask made by L{flags_to_mask}.
+
+    @type mask: int
+    @arg mask: A flags bitmask.
+    @rtype: list[str]
+    @return: The names of the flags set in C{mask}.
+    """
+
+    return [flag for i, flag in enumerate(RELAY_FLAGS) if mask & (1 << i)]
+
+def version_to_id(version):
+    """Pack a Tor version string such as C{'0.2.2.13-alpha'} into an int,
+    one byte per component, ignoring the status tag.
+
+    @type version: str
+    @arg version: A Tor version string.
+    @rtype: int
+    @return: The packed version, or 0 if C{version} can't be parsed.
+    """
+
+    match = re.match(r'(\d+)\.(\d+)\.(\d+)(?:\.(\d+))?', version)
+    if match == None:
+        return 0
+    parts = [int(p or 0) for p in match.groups()]
+    return (parts[0] << 24) | (parts[1] << 16) | (parts[2] << 8) | parts[3]
+
+def id_to_version(version_id):
+    """Unpack a version made by L{version_to_id}.
+
+    @type version_id: int
+    @arg version_id: A packed version.
+    @rtype: str
+    @return: The dotted version, without a status tag.
+    """
+
+    return '.'.join([str((version_id >> shift) & 0xff)
+                     for shift in (24, 16, 8, 0)])
+
 
 # MODELS ----------------------------------------------------------------------
 # -----------------------------------------------------------------------------
@@ -99,8 +181,8 @@ class Router(models.Model):
         if they are not specified in the model's construction.
 
     @type fingerprint: CharField (str)
-    @ivar fingerprint: The L{Router}'s fingerprint. Required constructor
-        argument.
+    @ivar fingerprint: The L{Router}'s fingerprint, unique among
+        L{Router}s. Required constructor argument.
     @type name: CharField (str)
     @ivar name: The L{Router}'s name. Default value is C{'Unnamed'}.
     @type welcomed: BooleanField (bool)
@@ -114,7 +196,7 @@ class Router(models.Model):
         document was published. Default value is C{True}.
     @type exit: BooleanField (bool)
     @ivar exit: Whether this L{Router} is an exit node (if it accepts exits 
-        to port 80). Default is C{False}.
+        to port 80 or 443). Default is C{False}.
     """
     
     _FINGERPRINT_MAX_LEN = 40
@@ -126,7 +208,7 @@ class Router(models.Model):
                   'exit': False }
 
     fingerprint = models.CharField(max_length=_FINGERPRINT_MAX_LEN,
-            default=None, blank=False)
+            default=None, blank=False, unique=True)
     name = models.CharField(max_length=_NAME_MAX_LEN,
             default=_DEFAULTS['name'])
     welcomed = models.BooleanField(default=_DEFAULTS['welcomed'])
@@ -327,7 +409,28 @@ class Subscriber(models.Model):
         else:
             return 'H'
 
-    def get_preferences(self):
+    def get_subscriptions(self):
+        """Loads all of this L{Subscriber}'s L{Subscription}s, of every type,
+        in one query, by joining the L{Subscription} table to the table of
+        each subclass.
+
+        @rtype: dict {str: L{Subscription}}
+        @return: Dictionary mapping the class names of the L{Subscription}
+            subclasses (as taken by L{_has_sub_type}) to this L{Subscriber}'s
+            L{Subscription} of that type, for each type it has.
+        """
+
+        subscriptions = {}
+        for sub in Subscription.objects.filter(subscriber = self) \
+                .select_related(*Subscription._SUBCLASSES):
+            # select_related caches the subclasses the row isn't as None.
+            for name in Subscription._SUBCLASSES:
+                child = getattr(sub, name)
+                if child != None:
+                    subscriptions[child.__class__.__name__] = child
+        return subscriptions
+
+    def get_preferences(self, subscriptions = None):
         """Compiles a dictionary of preferences for this L{Subscriber}.
         Key names are the names of fields in L{GenericForm}, L{SubscribeForm},
         and L{PreferencesForm}. This is mainly to be used to determine a user's
@@ -340,15 +443,20 @@ class Subscriber(models.Model):
         C{GenericForm.get_band_low}, and C{GenericForm.get_t_shirt}
         fields, which will be C{False} if a L{Subscription} doesn't exist).
 
+        @type subscriptions: dict {str: L{Subscription}}
+        @arg subscriptions: This L{Subscriber}'s L{Subscription}s, as returned
+            by L{get_subscriptions}. Loaded if not given.
         @rtype: Dict {str: various}
         @return: Dictionary of current preferences for this L{Subscriber}.
         """
         
+        if subscriptions == None:
+            subscriptions = self.get_subscriptions()
         data = {}
 
-        data['get_node_down'] = self.has_node_down_sub()
+        data['get_node_down'] = 'NodeDownSub' in subscriptions
         if data['get_node_down']:
-            n = NodeDownSub.objects.get(subscriber = self)
+            n = subscriptions['NodeDownSub']
             unit = self.determine_unit(n.grace_pd)
             data['node_down_grace_pd_unit'] = unit
             if unit == 'M':
@@ -364,22 +472,22 @@ class Subscriber(models.Model):
             data['node_down_grace_pd'] = GenericForm._INIT_PREFIX + \
                     str(GenericForm._NODE_DOWN_GRACE_PD_INIT)
 
-        data['get_version'] = self.has_version_sub()
+        data['get_version'] = 'VersionSub' in subscriptions
         if data['get_version']:
-            v = VersionSub.objects.get(subscriber = self)
+            v = subscriptions['VersionSub']
             data['version_type'] = v.notify_type
         else:
             data['version_type'] = u'UNRECOMMENDED'
 
-        data['get_band_low'] = self.has_bandwidth_sub()
+        data['get_band_low'] = 'BandwidthSub' in subscriptions
         if data['get_band_low']:
-            b = BandwidthSub.objects.get(subscriber = self)
+            b = subscriptions['BandwidthSub']
             data['band_low_threshold'] = b.threshold
         else:
             data['band_low_threshold'] = GenericForm._INIT_PREFIX + \
                     str(GenericForm._BAND_LOW_THRESHOLD_INIT)
 
-        data['get_t_shirt'] = self.has_t_shirt_sub()
+        data['get_t_shirt'] = 'TShirtSub' in subscriptions
 
         return data
 
@@ -399,6 +507,9 @@ class Subscription(models.Model):
     @cvar _DEFAULTS: Dictionary mapping field names to their default
         parameters. These are the values that fields will be instantiated
         with if they are not specified in the model's construction.
+    @type _SUBCLASSES: tuple
+    @cvar _SUBCLASSES: The names of the one-to-one relations from a
+        L{Subscription} to the row of each subclass.
 
     @type subscriber: L{Subscriber}
     @ivar subscriber: The L{Subscriber} who is subscribed to this
@@ -410,6 +521,7 @@ class Subscription(models.Model):
     """
 
     _DEFAULTS = { 'emailed': False }
+    _SUBCLASSES = ('nodedownsub', 'versionsub', 'bandwidthsub', 'tshirtsub')
 
     subscriber = models.ForeignKey(Subscriber, default=None, blank=False)
     emailed = models.BooleanField(default=_DEFAULTS['emailed'])
@@ -463,7 +575,7 @@ class NodeDownSub(Subscription):
         """
 
         if self.triggered \
-                and hours_since(self.last_changed) >= grace_pd:
+                and hours_since(self.last_changed) >= self.grace_pd:
             return True
         else:
             return False
@@ -544,6 +656,8 @@ class TShirtSub(Subscription):
     @cvar _DEFAULTS: Dictionary mapping field names to their default parameters.
         These are the values that fields will be instantiated with if they are
         not specified in the model's construction.
+    @type _UPTIME_HOURS: int
+    @cvar _UPTIME_HOURS: Hours the router must have been up to earn a t-shirt.
 
     @type triggered: BooleanField (bool)
     @ivar triggered: Whether the C{router} is up. Default is C{False}.
@@ -556,6 +670,7 @@ class TShirtSub(Subscription):
         datetime.now.
     """
     
+    _UPTIME_HOURS = 1464
     _DEFAULTS = { 'triggered': False,
                   'avg_bandwidth': 0,
                   'last_changed': datetime.now }
@@ -593,7 +708,8 @@ class TShirtSub(Subscription):
         
         hours_up = self.get_hours_since_triggered()
         
-        if not self.emailed and self.triggered and hours_up >= 1464:
+        if not self.emailed and self.triggered and \
+                hours_up >= TShirtSub._UPTIME_HOURS:
             if self.subscriber.router.exit:
                 if self.avg_bandwidth >= 100:
                     return True
@@ -603,6 +719,402 @@ class TShirtSub(Subscription):
         return False
 
 
+# RELAY HISTORY ---------------------------------------------------------------
+# -----------------------------------------------------------------------------
+
+class RouterHistory(models.Model):
+    """One day of consensus observations of a L{Router}. Each observation has
+    a time, the number of seconds it stands for, a bandwidth, a flags bitmask
+    and a version id. They are stored column-wise, each column as a packed
+    array, so a day is one row however many consensuses it saw. The up time
+    and bandwidth-seconds of the day are kept alongside so that
+    L{summary} only has to unpack the days at the edges of its window.
+
+    Rows are only appended to until the day is over. After
+    L{_DOWNSAMPLE_DAYS} days, L{compact} merges the observations of a day into
+    L{_DOWNSAMPLE_SECONDS} buckets. After L{_RETENTION_DAYS} days, it deletes
+    them.
+
+    @type _COLUMNS: tuple
+    @cvar _COLUMNS: (field name, array typecode) of each column.
+    @type _SAMPLE_SECONDS: int
+    @cvar _SAMPLE_SECONDS: Most seconds an observation stands for, the
+        consensus interval. Observations further apart than this leave a gap.
+    @type _RUNNING: int
+    @cvar _RUNNING: L{flags_to_mask} bit of the Running flag. Observations
+        without it don't count as up.
+    @type _DOWNSAMPLE_DAYS: int
+    @cvar _DOWNSAMPLE_DAYS: Age in days after which a day is downsampled.
+    @type _DOWNSAMPLE_SECONDS: int
+    @cvar _DOWNSAMPLE_SECONDS: Bucket size of downsampled days.
+    @type _RETENTION_DAYS: int
+    @cvar _RETENTION_DAYS: Age in days after which a day is deleted.
+
+    @type router: L{Router}
+    @ivar router: The L{Router} observed.
+    @type day: DateField (date)
+    @ivar day: The day the observations were made on.
+    @type samples: IntegerField (int)
+    @ivar samples: Number of observations, before any downsampling.
+    @type up_seconds: IntegerField (int)
+    @ivar up_seconds: Seconds the L{Router} was seen up on L{day}.
+    @type bw_seconds: FloatField (float)
+    @ivar bw_seconds: Bandwidth in kB/s times the seconds it was seen for.
+    @type downsampled: BooleanField (bool)
+    @ivar downsampled: Whether L{compact} has downsampled this day.
+    @type times: TextField (str)
+    @ivar times: Packed seconds since midnight of each observation.
+    @type durations: TextField (str)
+    @ivar durations: Packed seconds each observation counts as up.
+    @type bandwidths: TextField (str)
+    @ivar bandwidths: Packed observed bandwidths in kB/s.
+    @type flags: TextField (str)
+    @ivar flags: Packed L{flags_to_mask} bitmasks.
+    @type versions: TextField (str)
+    @ivar versions: Packed L{version_to_id} versions.
+    """
+
+    _COLUMNS = (('times', 'i'), ('durations', 'i'), ('bandwidths', 'i'),
+                ('flags', 'H'), ('versions', 'i'))
+    _SAMPLE_SECONDS = 3600
+    _RUNNING = flags_to_mask(['Running'])
+    _DOWNSAMPLE_DAYS = 31
+    _DOWNSAMPLE_SECONDS = 6 * 3600
+    _RETENTION_DAYS = 400
+
+    router = models.ForeignKey(Router)
+    day = models.DateField()
+    samples = models.IntegerField(default=0)
+    up_seconds = models.IntegerField(default=0)
+    bw_seconds = models.FloatField(default=0)
+    downsampled = models.BooleanField(default=False)
+    times = models.TextField(default='')
+    durations = models.TextField(default='')
+    bandwidths = models.TextField(default='')
+    flags = models.TextField(default='')
+    versions = models.TextField(default='')
+
+    class Meta:
+        unique_together = ('router', 'day')
+
+    def __unicode__(self):
+        """Returns the L{Router} and day of this L{RouterHistory}.
+
+        @rtype: str
+        @return: Simple description of L{RouterHistory} object.
+        """
+
+        return unicode(self.router) + " on " + unicode(self.day)
+
+    def get_columns(self):
+        """Unpack the columns of this day.
+
+        @rtype: dict {str: array}
+        @return: Dictionary mapping column names to arrays of values.
+        """
+
+        columns = {}
+        for name, typecode in self._COLUMNS:
+            values = array.array(typecode)
+            values.fromstring(base64.b64decode(getattr(self, name)))
+            if sys.byteorder == 'big':
+                values.byteswap()
+            columns[name] = values
+        return columns
+
+    def set_columns(self, columns):
+        """Pack C{columns} into this day's fields. Values are stored little
+        endian.
+
+        @type columns: dict {str: array}
+        @arg columns: Dictionary mapping column names to arrays of values, as
+            returned by L{get_columns}.
+        """
+
+        for name, typecode in self._COLUMNS:
+            values = columns[name]
+            if sys.byteorder == 'big':
+                values = array.array(typecode, values)
+                values.byteswap()
+            setattr(self, name, base64.b64encode(values.tostring()))
+
+    def add(self, when, bandwidth, flags, version, seconds=None):
+        """Append an observation made at C{when} to this day. It counts as up
+        for C{seconds} if C{flags} has Running, and for none otherwise.
+        Doesn't save.
+
+        @type when: datetime
+        @arg when: The time of the observation, on L{day}.
+        @type bandwidth: int
+        @arg bandwidth: Observed bandwidth in kB/s.
+        @type flags: int
+        @arg flags: A L{flags_to_mask} bitmask.
+        @type version: int
+        @arg version: A L{version_to_id} version.
+        @type seconds: int
+        @arg seconds: Seconds the observation stands for. Default is the time
+            since the previous observation of the day, at most
+            L{_SAMPLE_SECONDS}, or L{_SAMPLE_SECONDS} for the first.
+        """
+
+        columns = self.get_columns()
+        now = when.hour * 3600 + when.minute * 60 + when.second
+        if seconds == None:
+            seconds = self._SAMPLE_SECONDS
+            if len(columns['times']):
+                seconds = max(min(now - columns['times'][-1], seconds), 0)
+        if not flags & self._RUNNING:
+            seconds = 0
+        columns['times'].append(now)
+        columns['durations'].append(seconds)
+        columns['bandwidths'].append(int(bandwidth))
+        columns['flags'].append(flags)
+        columns['versions'].append(version)
+        self.set_columns(columns)
+        self.samples += 1
+        self.up_seconds += seconds
+        self.bw_seconds += bandwidth * seconds
+
+    def downsample(self, bucket=_DOWNSAMPLE_SECONDS):
+        """Merge the observations of this day into C{bucket} second buckets,
+        keeping the time-weighted mean bandwidth and the last flags and
+        version of each. A bucket that was never up keeps its last bandwidth.
+        L{up_seconds} and L{bw_seconds} don't change. Doesn't save.
+
+        @type bucket: int
+        @arg bucket: Bucket size in seconds.
+        """
+
+        columns = self.get_columns()
+        merged = dict([(name, array.array(typecode))
+                       for name, typecode in self._COLUMNS])
+        last = None
+        bw_seconds = 0.0
+        for i in xrange(len(columns['times'])):
+            start = columns['times'][i] - columns['times'][i] % bucket
+            if start != last:
+                if last != None:
+                    merged['bandwidths'].append(self._mean(
+                        bw_seconds, merged['durations'][-1],
+                        columns['bandwidths'][i - 1]))
+                merged['times'].append(start)
+                merged['durations'].append(0)
+                merged['flags'].append(0)
+                merged['versions'].append(0)
+                bw_seconds = 0.0
+                last = start
+            merged['durations'][-1] += columns['durations'][i]
+            merged['flags'][-1] = columns['flags'][i]
+            merged['versions'][-1] = columns['versions'][i]
+            bw_seconds += columns['bandwidths'][i] * columns['durations'][i]
+        if last != None:
+            merged['bandwidths'].append(self._mean(
+                bw_seconds, merged['durations'][-1],
+                columns['bandwidths'][-1]))
+        self.set_columns(merged)
+        self.downsampled = True
+
+    def _mean(bw_seconds, seconds, last):
+        """Get the mean bandwidth of a L{downsample} bucket.
+
+        @type bw_seconds: float
+        @arg bw_seconds: Bandwidth times seconds up in the bucket.
+        @type seconds: int
+        @arg seconds: Seconds up in the bucket.
+        @type last: int
+        @arg last: Bandwidth of the last observation in the bucket.
+        @rtype: int
+        @return: The time-weighted mean bandwidth, or C{last} if the bucket
+            was never up.
+        """
+
+        if seconds == 0:
+            return last
+        return int(round(bw_seconds / seconds))
+    _mean = staticmethod(_mean)
+
+    def record(router, when, bandwidth, flags, version, seconds=None):
+        """Append an observation of C{router} to its history for the day of
+        C{when} and save it.
+
+        @type router: L{Router}
+        @arg router: The observed L{Router}, which must be saved.
+        @rtype: L{RouterHistory}
+        @return: The updated day.
+        """
+
+        try:
+            history = RouterHistory.objects.get(router=router,
+                                                day=when.date())
+        except RouterHistory.DoesNotExist:
+            history = RouterHistory(router=router, day=when.date())
+        history.add(when, bandwidth, flags, version, seconds)
+        history.save()
+        return history
+    record = staticmethod(record)
+
+    def record_many(observations, when, seconds=None):
+        """Like L{record} for many routers at once: the day's rows are read
+        in one query and written back with one L{upsert<bulk.upsert>}.
+
+        @type observations: list
+        @arg observations: C{(router, bandwidth, flags, version)} tuples, at
+            most one per L{Router}, each L{Router} saved.
+        @type when: datetime
+        @arg when: The time of the observations.
+        """
+
+        day = when.date()
+        histories = dict([(history.router_id, history) for history in
+                          RouterHistory.objects.filter(day=day)])
+        changed = []
+        for router, bandwidth, flags, version in observations:
+            history = histories.get(router.id)
+            if history == None:
+                history = RouterHistory(router=router, day=day)
+            history.add(when, bandwidth, flags, version, seconds)
+            changed.append(history)
+        upsert(RouterHistory, changed, ('router', 'day'))
+    record_many = staticmethod(record_many)
+
+    def summary(router, start, end):
+        """Get how long C{router} was up between C{start} and C{end}, and its
+        mean bandwidth over that time. Whole days are summed in the database;
+        only the days C{start} and C{end} fall on are unpacked. Observations
+        count if they were made in the window.
+
+        @type router: L{Router}
+        @arg router: The L{Router} to summarize.
+        @type start: datetime
+        @arg start: Start of the window.
+        @type end: datetime
+        @arg end: End of the window (exclusive).
+        @rtype: (int, float)
+        @return: Seconds up in the window, and time-weighted mean bandwidth in
+            kB/s over them (0 if it was never seen up).
+        """
+
+        up_seconds = 0
+        bw_seconds = 0.0
+        first_day = start.date()
+        last_day = end.date()
+        if start.time() != time():
+            edges = [first_day]
+            first_day += timedelta(days=1)
+        else:
+            edges = []
+        if last_day >= first_day:
+            edges.append(last_day)
+        whole = RouterHistory.objects.filter(router=router,
+                day__gte=first_day, day__lt=last_day).aggregate(
+                models.Sum('up_seconds'), models.Sum('bw_seconds'))
+        up_seconds += whole['up_seconds__sum'] or 0
+        bw_seconds += whole['bw_seconds__sum'] or 0.0
+
+        for history in RouterHistory.objects.filter(router=router,
+                                                    day__in=edges):
+            midnight = datetime.combine(history.day, time())
+            low = max((start - midnight).days * 86400 +
+                      (start - midnight).seconds, 0)
+            high = min((end - midnight).days * 86400 +
+                       (end - midnight).seconds, 86400)
+            columns = history.get_columns()
+            for i in xrange(len(columns['times'])):
+                if low <= columns['times'][i] < high:
+                    up_seconds += columns['durations'][i]
+                    bw_seconds += (columns['bandwidths'][i] *
+                                   columns['durations'][i])
+
+        if up_seconds == 0:
+            return (0, 0.0)
+        return (up_seconds, bw_seconds / up_seconds)
+    summary = staticmethod(summary)
+
+    def compact(now=None):
+        """Apply the retention and downsampling policies: delete days older
+        than L{_RETENTION_DAYS} and downsample days older than
+        L{_DOWNSAMPLE_DAYS}.
+
+        @type now: datetime
+        @arg now: The current time. Default is C{datetime.now()}.
+        """
+
+        if now == None:
+            now = datetime.now()
+        today = now.date()
+        RouterHistory.objects.filter(day__lt=today -
+                timedelta(days=RouterHistory._RETENTION_DAYS)).delete()
+        for history in RouterHistory.objects.filter(downsampled=False,
+                day__lt=today -
+                timedelta(days=RouterHistory._DOWNSAMPLE_DAYS)):
+            history.downsample()
+            history.save()
+    compact = staticmethod(compact)
+
+class UpdaterRun(models.Model):
+    """A summary of one run of C{updaters.run_all}. The updater runs in the
+    listener process, so its summaries are stored here for the metrics view
+    of the web application to read. Only the last L{_KEEP} are kept.
+
+    @type _KEEP: int
+    @cvar _KEEP: Number of summaries kept by L{record}.
+
+    @type started: DateTimeField (datetime)
+    @ivar started: When the run started.
+    @type seconds: FloatField (float)
+    @ivar seconds: How long the run took.
+    @type queries: IntegerField (int)
+    @ivar queries: Database queries the run made.
+    @type control_calls: IntegerField (int)
+    @ivar control_calls: Tor control port calls the run made.
+    @type emails: IntegerField (int)
+    @ivar emails: Emails the run sent.
+    @type phases: TextField (str)
+    @ivar phases: JSON object mapping each phase of the run to the seconds
+        spent in it.
+    """
+    _KEEP = 100
+
+    started = models.DateTimeField()
+    seconds = models.FloatField()
+    queries = models.IntegerField()
+    control_calls = models.IntegerField()
+    emails = models.IntegerField()
+    phases = models.TextField()
+
+    def __unicode__(self):
+        return u'%s (%.1fs)' % (self.started, self.seconds)
+
+    def get_phases(self):
+        """Get the seconds spent in each phase.
+
+        @rtype: dict {str: float}
+        """
+        return simplejson.loads(self.phases)
+
+    def record(summary):
+        """Store C{summary} and delete all but the last L{_KEEP} summaries.
+
+        @type summary: C{metrics.RunSummary}
+        @arg summary: A finished run summary.
+        @rtype: L{UpdaterRun}
+        @return: The stored summary.
+        """
+
+        run = UpdaterRun(started=datetime.fromtimestamp(summary.started),
+                         seconds=summary.seconds, queries=summary.queries,
+                         control_calls=summary.control_calls,
+                         emails=summary.emails,
+                         phases=simplejson.dumps(summary.phases))
+        run.save()
+        old = UpdaterRun.objects.order_by('-id').values_list('id',
+                flat=True)[UpdaterRun._KEEP:UpdaterRun._KEEP + 1]
+        if old:
+            UpdaterRun.objects.filter(id__lte=old[0]).delete()
+        return run
+    record = staticmethod(record)
+
+
 # CUSTOM FIELDS ---------------------------------------------------------------
 # -----------------------------------------------------------------------------
 
@@ -1169,6 +1681,8 @@ class SubscribeForm(GenericForm):
 
     def is_valid_router(self, fingerprint):
         """Helper function to check if a router exists in the database.
+        Routers in the current consensus are found in the router index
+        without a query; others are looked for in the database.
 
         @type fingerprint: str
         @arg fingerprint: String representation of a router's fingerprint.
@@ -1177,6 +1691,10 @@ class SubscribeForm(GenericForm):
             the database; C{True} if it does, C{False} if it doesn't.
         """
 
+        index = routerindex.shared()
+        if index != None and index.get(fingerprint) != None:
+            return True
+
         # The router fingerprint field is unique, so we only need to worry
         # about the router not existing, not there being two routers.
         try:
@@ -1250,6 +1768,11 @@ class PreferencesForm(GenericForm):
     @ivar user: The user/subscriber accessing their preferences.
     @type user_info: str
     @ivar user_info: The email, router name, and router fingerprint of C{user}.
+    @type subscriptions: dict {str: L{Subscription}}
+    @ivar subscriptions: C{user}'s subscriptions, as loaded by
+        L{Subscriber.get_subscriptions}.
+    @type preferences: dict {str: various}
+    @ivar preferences: C{user}'s current preferences.
     """
     
     _USER_INFO_STR = '<p><span>Email:</span> %s</p> \
@@ -1258,18 +1781,21 @@ class PreferencesForm(GenericForm):
 
     def __init__(self, user, data = None):
         """Calls GenericForm __init__ method and saves C{user} and
-        C{user_info} instance variables.
+        C{user_info} instance variables. C{user}'s subscriptions are loaded
+        with one query, so C{user.router} should already be loaded (with
+        C{select_related}) for the form to take two queries in all.
         """
 
+        self.user = user
+        self.subscriptions = user.get_subscriptions()
+        self.preferences = user.get_preferences(self.subscriptions)
+
         # If no data, is provided, then create using preferences as initial
         # form data. Otherwise, use provided data.
         if data == None:
-            GenericForm.__init__(self, initial=user.get_preferences())
+            GenericForm.__init__(self, initial=dict(self.preferences))
         else:
             GenericForm.__init__(self, data)
- 
-        self.user = user
-        self.preferences = self.user.get_preferences()
 
         self.user_info = PreferencesForm._USER_INFO_STR % (self.user.email, \
                 self.user.router.name, user.router.spaced_fingerprint())
@@ -1292,74 +1818,75 @@ class PreferencesForm(GenericForm):
 
         return self.cleaned_data
 
+    @transaction.commit_on_success
     def change_subscriptions(self, new_data):
-        """Change the subscriptions and options if they are specified.
+        """Change the subscriptions and options if they are specified, all
+        in one transaction. The subscriptions loaded with the form are
+        changed in place, so the only queries are the writes: a batch of
+        updates per changed subscription type, one delete for all the
+        subscriptions no longer selected, and an insert per new one.
        
         @type new_data: dict {str: various}
         @arg new_data: New preferences.
         """
 
-        old_data = self.preferences
-
-        # If there already was a subscription, get it and update it or delete
-        # it depending on the current value.
-        if old_data['get_node_down']:
-            n = NodeDownSub.objects.get(subscriber = self.user)
-            if new_data['get_node_down']:
+        subscriptions = self.subscriptions
+        changed = []
+        deleted = []
+        created = []
+
+        # If there already was a subscription, update it or delete it
+        # depending on the current value. If there wasn't a subscription
+        # before and it is checked now, then make one.
+        n = subscriptions.get('NodeDownSub')
+        if n != None:
+            if not new_data['get_node_down']:
+                deleted.append(n)
+            elif n.grace_pd != new_data['node_down_grace_pd']:
                 n.grace_pd = new_data['node_down_grace_pd']
-                n.save()
-            else:
-                n.delete()
-        # If there wasn't a subscription before and it is checked now, then 
-        # make one.
+                changed.append(n)
         elif new_data['get_node_down']:
-            n = NodeDownSub(subscriber=subscriber, 
-                    grace_pd=new_data['node_down_grace_pd'])
-            n.save()
-
-        # If there already was a subscription, get it and update it or delete
-        # it depending on the current value.
-        if old_data['get_version']:
-            v = VersionSub.objects.get(subscriber = self.user)
-            if new_data['get_version']:
+            created.append(NodeDownSub(subscriber=self.user,
+                    grace_pd=new_data['node_down_grace_pd']))
+
+        v = subscriptions.get('VersionSub')
+        if v != None:
+            if not new_data['get_version']:
+                deleted.append(v)
+            elif v.notify_type != new_data['version_type']:
                 v.notify_type = new_data['version_type']
-                v.save()
-            else:
-                v.delete()
-        # If there wasn't a subscription before and it is checked now, then 
-        # make one.
+                changed.append(v)
         elif new_data['get_version']:
-            v = VersionSub(subscriber=self.user, 
-                    notify_type=new_data['version_type'])
-            v.save()
-
-        # If there already was a subscription, get it and update it or delete
-        # it depending on the current value.
-        if old_data['get_band_low']:
-            b = BandwidthSub.objects.get(subscriber = self.user)
-            if new_data['get_band_low']:
+            created.append(VersionSub(subscriber=self.user,
+                    notify_type=new_data['version_type']))
+
+        b = subscriptions.get('BandwidthSub')
+        if b != None:
+            if not new_data['get_band_low']:
+                deleted.append(b)
+            elif b.threshold != new_data['band_low_threshold']:
                 b.threshold = new_data['band_low_threshold']
-                b.save()
-            else:
-                b.delete()
-        # If there wasn't a subscription before and it is checked now, then
-        # make one.
+                changed.append(b)
         elif new_data['get_band_low']:
-            b = BandwidthSub(subscriber=self.user,
-                    threshold=new_data['band_low_threshold'])
-            b.save()
-
-        # If there already was a subscription, get it and delete it if it's no
-        # longer selected.
-        if old_data['get_t_shirt']:
-            t = TShirtSub.objects.get(subscriber = self.user)
+            created.append(BandwidthSub(subscriber=self.user,
+                    threshold=new_data['band_low_threshold']))
+
+        # T-shirt subscriptions have no options, so they are only made or
+        # deleted.
+        t = subscriptions.get('TShirtSub')
+        if t != None:
             if not new_data['get_t_shirt']:
-                t.delete()
-        # If there wasn't a subscription before and it is checked now, then
-        # make one.
+                deleted.append(t)
         elif new_data['get_t_shirt']:
-            t = TShirtSub(subscriber=self.user)
-            t.save()
+            created.append(TShirtSub(subscriber=self.user))
+
+        for sub in changed:
+            update_all(sub.__class__, [sub])
+        if deleted:
+            Subscription.objects.filter(
+                    pk__in=[sub.pk for sub in deleted]).delete()
+        for sub in created:
+            sub.save()
 
 class DeployedDatetime(models.Model):
     """Stores the date and time when this instance of Tor Weather was first
@@ -0,0 +1,45 @@
+"""A module for setting up SQLite connections for use by the web application
+and the updater at once. Every new SQLite connection gets the pragmas from
+C{config}: by default, write-ahead logging, so readers see the last committed
+state of the database instead of waiting for the updater's transactions,
+C{synchronous=NORMAL}, which in WAL mode only syncs at checkpoints rather
+than at every commit, a larger page cache, and a busy timeout for writers
+that wait on each other. Other databases are left alone.
+"""
+
+from django.db.backends.signals import connection_created
+
+from config import config
+
+def sqlite_pragmas():
+    """Get the pragmas set on new SQLite connections, in order.
+
+    @rtype: list[(str, str)]
+    @return: C{(pragma, value)} pairs.
+    """
+    pragmas = []
+    if config.sqlite_journal_mode:
+        pragmas.append(('journal_mode', config.sqlite_journal_mode))
+    if config.sqlite_synchronous:
+        pragmas.append(('synchronous', config.sqlite_synchronous))
+    if config.sqlite_cache_kb:
+        # a negative cache size is in KiB rather than pages
+        pragmas.append(('cache_size', str(-config.sqlite_cache_kb)))
+    if config.sqlite_busy_timeout:
+        pragmas.append(('busy_timeout', str(config.sqlite_busy_timeout)))
+    return pragmas
+
+def configure(sender, connection, **kwargs):
+    """Set L{sqlite_pragmas} on C{connection} if it is an SQLite connection.
+    Connected to Django's C{connection_created} signal.
+
+    @param connection: The Django database wrapper that connected.
+    """
+    if connection.settings_dict['ENGINE'] != 'django.db.backends.sqlite3':
+        return
+    cursor = connection.connection.cursor()
+    for pragma, value in sqlite_pragmas():
+        cursor.execute('PRAGMA %s = %s' % (pragma, value))
+    cursor.close()
+
+connection_created.connect(configure, dispatch_uid = 'weatherapp.pragmas')
@@ -0,0 +1,154 @@
+"""A module for profiling a single run of C{updaters.run_all} in production.
+Nothing is profiled until a run is asked for, by L{request} or by sending the
+listener C{SIGUSR1} (see L{install_signal}), or by setting
+C{config.profile_every_run}. The next run then goes through L{profile}: its
+stats are saved to a timestamped file in C{config.profile_dir} and the top
+functions are logged.
+
+A run can be profiled as a whole, or only while it is in one layer, given by
+L{LAYERS}: C{'control'} profiles the Tor control port calls and C{'orm'} the
+Django ORM calls, leaving out the time between them. Only calls made by the
+thread running the profiled function are profiled.
+
+@type LAYERS: dict {str: list}
+@var LAYERS: Maps each layer to the C{(module, class name, method name)} of
+    its entry points.
+"""
+
+import cProfile
+import logging
+import os
+import pstats
+import signal
+import threading
+import time
+from StringIO import StringIO
+
+from config import config
+
+LAYERS = {
+    'control': [('TorCtl.TorCtl', 'Connection', 'sendAndRecv')],
+    'orm': [('django.db.models.sql.compiler', 'SQLCompiler', 'execute_sql'),
+            ('django.db.models.query', 'QuerySet', '__len__'),
+            ('django.db.models.query', 'QuerySet', 'count'),
+            ('django.db.models.query', 'QuerySet', 'update'),
+            ('django.db.models.query', 'QuerySet', 'delete'),
+            ('django.db.models.base', 'Model', 'save_base'),
+            ('django.db.models.base', 'Model', 'delete')],
+}
+
+_requested = None
+
+def request(layer = 'all'):
+    """Profile the next run.
+
+    @type layer: str
+    @param layer: C{'all'}, or one of L{LAYERS}.
+    """
+    global _requested
+    if layer != 'all' and layer not in LAYERS:
+        raise ValueError('Unknown profiling layer %s' % layer)
+    _requested = layer
+
+def take():
+    """Get the layer to profile the current run in, and forget a request.
+
+    @rtype: str
+    @return: The layer, or None if the run should not be profiled.
+    """
+    global _requested
+    layer, _requested = _requested, None
+    if layer == None and config.profile_every_run:
+        layer = config.profile_layer
+    return layer
+
+def _signal_handler(signum, frame):
+    logging.info('Profiling the next run (%s).' % config.profile_layer)
+    request(config.profile_layer)
+
+def install_signal(signum = signal.SIGUSR1):
+    """Profile the next run, in C{config.profile_layer}, when this process
+    receives the signal C{signum}."""
+    signal.signal(signum, _signal_handler)
+
+class _LayerProfiler:
+    """Enables a profiler only while a call to one of the entry points of a
+    layer is running, counting nested calls so only the outermost one
+    switches it. The entry points are patched for every thread, but only
+    calls from the thread that installed them are profiled, so C{depth} is
+    only ever changed by that thread.
+
+    Entry points must do their work before they return: a generator would
+    return at once, and the work done as it is consumed would be missed."""
+
+    def __init__(self, profiler):
+        self.profiler = profiler
+        self.depth = 0
+        self.thread = None
+        self._originals = []
+
+    def _wrap(self, function):
+        def profiled(*args, **kwargs):
+            if threading.currentThread() is not self.thread:
+                return function(*args, **kwargs)
+            self.depth += 1
+            if self.depth == 1:
+                self.profiler.enable()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.profiler.disable()
+        profiled.__name__ = function.__name__
+        profiled.__doc__ = function.__doc__
+        return profiled
+
+    def install(self, layer):
+        self.thread = threading.currentThread()
+        for module, cls, name in LAYERS[layer]:
+            owner = getattr(__import__(module, {}, {}, [cls]), cls)
+            function = owner.__dict__[name]
+            self._originals.append((owner, name, function))
+            setattr(owner, name, self._wrap(function))
+
+    def uninstall(self):
+        for owner, name, function in self._originals:
+            setattr(owner, name, function)
+        self._originals = []
+
+def profile(layer, function, *args, **kwargs):
+    """Call C{function} under the profiler, save the stats and log the top
+    L{config.profile_top} functions by cumulative time.
+
+    @type layer: str
+    @param layer: C{'all'}, or one of L{LAYERS}.
+    @rtype: tuple
+    @return: What C{function} returned, and the name of the stats file.
+    """
+    profiler = cProfile.Profile()
+    start = time.time()
+    if layer == 'all':
+        try:
+            result = profiler.runcall(function, *args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+    else:
+        layers = _LayerProfiler(profiler)
+        layers.install(layer)
+        try:
+            result = function(*args, **kwargs)
+        finally:
+            layers.uninstall()
+            elapsed = time.time() - start
+
+    filename = os.path.join(config.profile_dir, 'profile-%s-%s.prof' % (
+        time.strftime('%Y%m%d-%H%M%S'), layer))
+    profiler.dump_stats(filename)
+    summary = StringIO()
+    stats = pstats.Stats(profiler, stream = summary)
+    stats.sort_stats('cumulative').print_stats(config.profile_top)
+    logging.info('Profiled %s (%s) in %.1fs, stats saved to %s:\n%s' % (
+                 function.__name__, layer, elapsed, filename,
+                 summary.getvalue()))
+    return result, filename
@@ -0,0 +1,199 @@
+"""A module for the read-only index of the current consensus that the web
+application looks routers up in. The updater writes the index with L{write}
+after each consensus it reads, to a new file that then replaces the old one
+with C{os.rename}, so readers see either the old index or the new one and
+never a partial one. Web processes get it from L{shared}, which maps the file
+into memory once and maps it again only once the file has been replaced.
+Lookups binary search the mapped file and unpack only the records they touch,
+so the pages are shared by every process and a lookup never touches the
+database or the control port.
+
+The file is little-endian: a header (L{MAGIC}, the number of routers and
+when the index was written), the router records sorted by fingerprint, then
+the record numbers sorted by router name, then the names.
+
+@type MAGIC: str
+@var MAGIC: The first bytes of an index file, with the format version.
+"""
+
+import binascii
+import mmap
+import os
+import struct
+import tempfile
+import time
+
+from config import config
+
+MAGIC = 'WTHRIDX1'
+
+_HEADER = struct.Struct('<8sId')
+# fingerprint, flags, bandwidth, name offset, name length, exit
+_RECORD = struct.Struct('<20sIIIHBx')
+_NAME = struct.Struct('<I')
+
+def write(path, routers):
+    """Write an index of C{routers} to C{path}, replacing any index there at
+    once.
+
+    @type path: str
+    @param path: The file to write.
+    @type routers: iterable
+    @param routers: C{(fingerprint, name, flags, bandwidth, exit)} tuples,
+        with the fingerprint in hex, flags as made by
+        C{models.flags_to_mask}, the bandwidth in kB/s and exit a bool.
+    """
+    records = []
+    for fingerprint, name, flags, bandwidth, exit in routers:
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        records.append((binascii.unhexlify(fingerprint), name, flags,
+                        bandwidth, exit))
+    records.sort()
+    by_name = range(len(records))
+    by_name.sort(key = lambda i: (records[i][1], records[i][0]))
+
+    parts = [_HEADER.pack(MAGIC, len(records), time.time())]
+    offset = 0
+    for key, name, flags, bandwidth, exit in records:
+        parts.append(_RECORD.pack(key, flags, min(bandwidth, 0xffffffff),
+                                  offset, len(name), exit and 1 or 0))
+        offset += len(name)
+    parts.extend([_NAME.pack(i) for i in by_name])
+    parts.extend([record[1] for record in records])
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp = tempfile.mkstemp(prefix = '.routerindex-', dir = directory)
+    try:
+        os.write(fd, ''.join(parts))
+        os.close(fd)
+        os.chmod(temp, 0644)
+        os.rename(temp, path)
+    except:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+class RouterIndex:
+    """A router index file, mapped read-only.
+
+    @type written: float
+    @ivar written: When the index was written, in seconds since the epoch.
+    @type identity: tuple
+    @ivar identity: The device and inode of the mapped file.
+    """
+
+    def __init__(self, path):
+        """Map the index at C{path}.
+
+        @raise ValueError: If the file is not an index.
+        """
+        f = open(path, 'rb')
+        try:
+            stat = os.fstat(f.fileno())
+            self.identity = (stat.st_dev, stat.st_ino)
+            if stat.st_size < _HEADER.size:
+                raise ValueError('%s is not a router index' % path)
+            self._map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        finally:
+            f.close()
+        magic, self._count, self.written = _HEADER.unpack_from(self._map, 0)
+        self._names = _HEADER.size + self._count * _RECORD.size
+        self._strings = self._names + self._count * _NAME.size
+        if magic != MAGIC or len(self._map) < self._strings:
+            raise ValueError('%s is not a router index' % path)
+
+    def __len__(self):
+        return self._count
+
+    def _key(self, i):
+        offset = _HEADER.size + i * _RECORD.size
+        return self._map[offset:offset + 20]
+
+    def _name(self, i):
+        record = _RECORD.unpack_from(self._map, _HEADER.size +
+                                     i * _RECORD.size)
+        start = self._strings + record[3]
+        return self._map[start:start + record[4]]
+
+    def _by_name(self, j):
+        return _NAME.unpack_from(self._map, self._names + j * _NAME.size)[0]
+
+    def get(self, fingerprint):
+        """Look a router up by fingerprint.
+
+        @type fingerprint: str
+        @param fingerprint: The fingerprint in upper case hex, without
+            spaces, as it is stored in the database.
+        @rtype: tuple or None
+        @return: The C{(name, flags, bandwidth, exit)} of the router, as
+            given to L{write}, or None if it is not in the index.
+        """
+        if fingerprint != fingerprint.upper():
+            return None
+        try:
+            key = binascii.unhexlify(fingerprint)
+        except (TypeError, UnicodeEncodeError):
+            return None
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low == self._count or self._key(low) != key:
+            return None
+        record = _RECORD.unpack_from(self._map, _HEADER.size +
+                                     low * _RECORD.size)
+        start = self._strings + record[3]
+        return (self._map[start:start + record[4]], record[1], record[2],
+                record[5] == 1)
+
+    def fingerprints(self, name):
+        """Get the fingerprints of the routers named C{name}.
+
+        @type name: str or unicode
+        @param name: The router name, matched exactly.
+        @rtype: list[str]
+        @return: The fingerprints in hex, in order.
+        """
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._name(self._by_name(middle)) < name:
+                low = middle + 1
+            else:
+                high = middle
+        fingerprints = []
+        while low < self._count:
+            i = self._by_name(low)
+            if self._name(i) != name:
+                break
+            fingerprints.append(binascii.hexlify(self._key(i)).upper())
+            low += 1
+        return fingerprints
+
+_shared = None
+
+def shared():
+    """Get the index at C{config.consensus_index_file}, mapped once per
+    process and mapped again when the updater has replaced it.
+
+    @rtype: L{RouterIndex} or None
+    @return: The index, or None if there is no readable index yet.
+    """
+    global _shared
+    path = config.consensus_index_file
+    if not path:
+        return None
+    try:
+        stat = os.stat(path)
+        if _shared == None or \
+           _shared.identity != (stat.st_dev, stat.st_ino):
+            _shared = RouterIndex(path)
+    except (OSError, IOError, ValueError):
+        return None
+    return _shared
@@ -0,0 +1,218 @@
+"""A module for scheduling work at future times without scanning everything
+that is waiting. L{TimerWheel} keeps keys in slots by due time, so only the
+slots whose time has come are looked at when the clock advances. L{Scheduler}
+builds on it to call a handler for each item that comes due.
+"""
+
+import time
+
+
+class TimerWheel:
+    """A hashed timer wheel. Each key is due at one time; scheduling a key
+    again moves it. Keys due more than a full turn of the wheel away stay in
+    their slot until the turn they are due on.
+
+    @type tick: int
+    @ivar tick: Seconds covered by each slot.
+    @type slots: list[dict]
+    @ivar slots: For each slot, a dictionary mapping the keys in it to their
+        due times.
+    @type now: float
+    @ivar now: The time the wheel has been advanced to.
+    """
+
+    def __init__(self, tick = 60, num_slots = 512, now = None):
+        """Create an empty L{TimerWheel} starting at C{now}.
+
+        @type tick: int
+        @param tick: Seconds covered by each slot.
+        @type num_slots: int
+        @param num_slots: Number of slots in the wheel.
+        @type now: float
+        @param now: Start time in seconds since the epoch. Default is the
+            current time.
+        """
+        if now == None:
+            now = time.time()
+        self.tick = tick
+        self.slots = [{} for i in xrange(num_slots)]
+        self.now = now
+        self._where = {}
+
+    def __len__(self):
+        return len(self._where)
+
+    def __contains__(self, key):
+        return key in self._where
+
+    def _slot(self, when):
+        return int(when // self.tick) % len(self.slots)
+
+    def schedule(self, key, when):
+        """Make C{key} due at C{when}, replacing any earlier schedule.
+
+        @param key: Any hashable value.
+        @type when: float
+        @param when: Due time in seconds since the epoch. Keys already due
+            go in the current slot, so the next L{advance} returns them.
+        """
+        self.cancel(key)
+        slot = self._slot(max(when, self.now))
+        self.slots[slot][key] = when
+        self._where[key] = slot
+
+    def cancel(self, key):
+        """Forget C{key} if it is scheduled.
+
+        @param key: A key passed to L{schedule}.
+        """
+        slot = self._where.pop(key, None)
+        if slot != None:
+            del self.slots[slot][key]
+
+    def due_time(self, key):
+        """Get the time C{key} is due at, or None if it isn't scheduled."""
+        slot = self._where.get(key)
+        if slot == None:
+            return None
+        return self.slots[slot][key]
+
+    def advance(self, now = None):
+        """Advance the wheel to C{now} and remove the keys that are due.
+
+        @type now: float
+        @param now: The new time. Default is the current time.
+        @rtype: list
+        @return: The keys due at or before C{now}, in due time order.
+        """
+        if now == None:
+            now = time.time()
+        first = int(self.now // self.tick)
+        last = int(now // self.tick)
+        if last - first >= len(self.slots):
+            slots = range(len(self.slots))
+        else:
+            slots = [i % len(self.slots) for i in xrange(first, last + 1)]
+        due = []
+        for slot in slots:
+            for key, when in self.slots[slot].items():
+                if when <= now:
+                    due.append((when, key))
+                    del self.slots[slot][key]
+                    del self._where[key]
+        self.now = max(self.now, now)
+        due.sort()
+        return [key for when, key in due]
+
+class Scheduler:
+    """Runs handlers for items whose due time has passed. An item is named by
+    a kind, such as C{'node_down'}, and an id. Each kind has a handler, called
+    with the id and the current time when an item comes due, which returns
+    the item's next due time or C{None} if it is done. A kind may also have a
+    loader that lists its pending items and their due times from the
+    database, so L{load} can rebuild the index when the process starts.
+
+    The scheduler can be driven by C{TorCtl} timers: L{attach} asks a
+    C{TorCtl.Connection} for a periodic C{TORCTL_TIMER} event, and
+    L{timer_event} runs the scheduler when one arrives.
+
+    @type wheel: L{TimerWheel}
+    @ivar wheel: The due times, keyed by C{(kind, id)}.
+    @type kinds: dict {str: (function, function)}
+    @ivar kinds: Maps each kind to its handler and loader.
+    @type timer_type: str
+    @ivar timer_type: The type of the C{TORCTL_TIMER} events this scheduler
+        runs on, or C{None} before L{attach}.
+    """
+
+    def __init__(self, tick = 60, now = None):
+        """Create a scheduler with no kinds.
+
+        @type tick: int
+        @param tick: Seconds between runs; due times are looked up at this
+            granularity.
+        @type now: float
+        @param now: Start time in seconds since the epoch.
+        """
+        self.wheel = TimerWheel(tick, now = now)
+        self.kinds = {}
+        self.timer_type = None
+
+    def __len__(self):
+        return len(self.wheel)
+
+    def add_kind(self, kind, handler, loader = None):
+        """Register a kind of item.
+
+        @type kind: str
+        @param kind: The name of the kind.
+        @type handler: function
+        @param handler: Called as C{handler(id, now)} when an item is due;
+            returns the next due time, or C{None}.
+        @type loader: function
+        @param loader: Called with no arguments by L{load}; returns a list of
+            C{(id, due time)} pairs.
+        """
+        self.kinds[kind] = (handler, loader)
+
+    def load(self):
+        """Schedule the pending items listed by every kind's loader."""
+        for kind, (handler, loader) in self.kinds.items():
+            if loader:
+                for id, when in loader():
+                    self.schedule(kind, id, when)
+
+    def schedule(self, kind, id, when):
+        """Make the item C{id} of C{kind} due at C{when}."""
+        self.wheel.schedule((kind, id), when)
+
+    def cancel(self, kind, id):
+        """Forget the item C{id} of C{kind} if it is scheduled."""
+        self.wheel.cancel((kind, id))
+
+    def due_time(self, kind, id):
+        """Get the time the item C{id} of C{kind} is due, or C{None}."""
+        return self.wheel.due_time((kind, id))
+
+    def run(self, now = None):
+        """Call the handlers of the items due by C{now}, rescheduling the
+        ones that return a time.
+
+        @type now: float
+        @param now: The current time. Default is the current time.
+        @rtype: int
+        @return: The number of items handled.
+        """
+        if now == None:
+            now = time.time()
+        due = self.wheel.advance(now)
+        for kind, id in due:
+            handler = self.kinds[kind][0]
+            when = handler(id, now)
+            if when != None:
+                self.schedule(kind, id, when)
+        return len(due)
+
+    def attach(self, conn, type = 'scheduler'):
+        """Have C{conn} deliver a timer event every tick.
+
+        @type conn: C{TorCtl.Connection}
+        @param conn: An authenticated connection.
+        @type type: str
+        @param type: The type to give the timer events.
+        """
+        self.timer_type = type
+        conn.set_periodic_timer(self.wheel.tick, type)
+
+    def timer_event(self, event):
+        """Run the scheduler if C{event} is one of its timer events.
+
+        @type event: C{TorCtl.TimerEvent}
+        @param event: A timer event from the connection.
+        @rtype: bool
+        @return: Whether the event was for this scheduler.
+        """
+        if event.type != self.timer_type:
+            return False
+        self.run()
+        return True
@@ -2,17 +2,42 @@
 The test module. To run tests, cd to weather and run 'python manage.py
 test weatherapp'.
 """
+import os
+import csv
+import json
 import time
+import email
+import pstats
+import shutil
+import signal
+import tempfile
+import threading
 from datetime import datetime, timedelta
 
 from models import Subscriber, Subscription, Router, NodeDownSub, TShirtSub, \
-                   VersionSub, BandwidthSub
+                   VersionSub, BandwidthSub, RouterHistory, flags_to_mask, \
+                   mask_to_flags, version_to_id, id_to_version, UpdaterRun, \
+                   SubscribeForm
 import emails
+import updaters
+import profiling
+import listener
+import bulk
+import routerindex
 from ctlutil import CtlUtil
+from liveness import LivenessTracker
+from scheduler import TimerWheel, Scheduler
+from fakecontrol import FakeControlServer, synthetic_network
+from TorCtl import TorCtl, PathSupport, SQLSupport, StatsSupport, \
+    GeoIPSupport
 
+from django.conf import settings
+from django.db import connection, reset_queries
 from django.test import TestCase
 from django.test.client import Client
 from django.core import mail
+from django.core.mail import EmailMessage
+from django.utils import simplejson
 
 class TestWeb(TestCase):
     """Tests the Tor Weather application via post requests"""
@@ -377,6 +402,47 @@ class TestWeb(TestCase):
         #Test that no messages have been sent
         time.sleep(3)
         self.assertEqual(len(mail.outbox), 0)
+
+    def test_preferences(self):
+        """The preferences page takes two queries, and changes to it are
+        applied to every subscription type"""
+        subscriber = Subscriber(email = 'name@place.com', confirmed = True,
+                                router = Router.objects.get())
+        subscriber.save()
+        NodeDownSub(subscriber = subscriber, grace_pd = 24).save()
+        BandwidthSub(subscriber = subscriber, threshold = 50).save()
+        url = '/preferences/%s/' % subscriber.pref_auth
+
+        settings.DEBUG = True
+        try:
+            reset_queries()
+            response = self.client.get(url)
+            queries = len(connection.queries)
+        finally:
+            settings.DEBUG = False
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(queries, 2)
+        initial = response.context['form'].initial
+        self.assertEqual(initial['node_down_grace_pd'], 1)
+        self.assertEqual(initial['node_down_grace_pd_unit'], 'D')
+        self.assertEqual(initial['band_low_threshold'], 50)
+        self.assertEqual(initial['get_version'], False)
+
+        response = self.client.post(url, {'get_node_down' : True,
+                                          'node_down_grace_pd' : '2',
+                                          'node_down_grace_pd_unit' : 'W',
+                                          'get_version' : True,
+                                          'version_type' : 'OBSOLETE',
+                                          'get_band_low': False,
+                                          'band_low_threshold' : '',
+                                          'get_t_shirt' : True})
+        self.assertEqual(response.status_code, 302)
+        subscriptions = subscriber.get_subscriptions()
+        self.assertEqual(sorted(subscriptions.keys()),
+                         ['NodeDownSub', 'TShirtSub', 'VersionSub'])
+        self.assertEqual(subscriptions['NodeDownSub'].grace_pd, 2 * 24 * 7)
+        self.assertEqual(subscriptions['VersionSub'].notify_type, 'OBSOLETE')
+        self.assertEqual(Subscription.objects.count(), 3)
     
 class TestNotifications(TestCase):
     """Test the notification side of Tor Weather"""
@@ -455,3 +521,1098 @@ class TestNotifications(TestCase):
 
                                
                                    
+
+    def test_digest(self):
+        """Several emails to one recipient become one digest keeping each
+        relay's unsubscribe link; a lone email is sent as it is"""
+        email_list = [emails.node_down_tuple('name@place.com', str(i) * 40,
+                                             'relay%d' % i, 1, 'unsub%d' % i,
+                                             'pref%d' % i) for i in range(5)]
+        lone = emails.node_down_tuple('other@place.com', 'A' * 40, 'other',
+                                      1, 'unsub', 'pref')
+        email_list.insert(1, lone)
+
+        mails = emails.digest(email_list, min_mails = 2, max_mails = 3)
+        self.assertEqual(len(mails), 3)
+        self.assertEqual(mails[0][3], ['name@place.com'])
+        self.assertEqual(mails[2], lone)
+        for i in range(3):
+            self.assert_('unsub%d' % i in mails[0][1])
+        self.assert_('unsub4' in mails[1][1])
+        self.assertEqual(emails.digest(email_list, min_mails = 0),
+                         email_list)
+
+    def test_mime_messages(self):
+        """The fast path writes the same message Django would, with one
+        unsubscribe link per email"""
+        mail_tuple = emails.node_down_tuple('name@place.com', '1234' * 10,
+                                            'myrouter', 2, 'unsub', 'pref')
+        sender, recipients, text = emails.mime_messages([mail_tuple])[0]
+        self.assertEqual((sender, recipients), (mail_tuple[2], mail_tuple[3]))
+        message = email.message_from_string(text)
+        django_message = EmailMessage(*mail_tuple).message()
+        for header in ('Subject', 'From', 'To', 'Content-Type'):
+            self.assertEqual(message[header], django_message[header])
+        self.assertEqual(message.get_payload(), mail_tuple[1])
+        self.assertEqual(mail_tuple[1].count('/unsubscribe/unsub/'), 1)
+
+class TestExitPolicy(TestCase):
+    """Test the compiled exit policy used to set L{Router.exit}"""
+
+    def setUp(self):
+        """Parse a policy with private address rejects and port ranges"""
+        desc = ['router abc 1.2.3.4 9001 0 0',
+                'reject 10.0.0.0/8:*',
+                'reject 192.168.0.0/16:*',
+                'accept 18.0.0.0/8:22',
+                'accept *:20-23',
+                'reject *:25',
+                'accept *:443',
+                'reject *:*']
+        self.policy = TorCtl.ExitPolicy.build_from_desc(desc)
+
+    def test_matches_linear_scan(self):
+        """The compiled policy must give the same first-match answer as
+        checking each line in order."""
+        for ip in ['10.1.2.3', '18.4.5.6', '192.168.1.1', '8.8.8.8']:
+            for port in [0, 21, 22, 23, 24, 25, 443, 444, 65535]:
+                expected = -1
+                for line in self.policy.lines:
+                    expected = line.check(ip, port)
+                    if expected != -1:
+                        break
+                self.assertEqual(self.policy.check(ip, port), expected)
+
+    def test_web_exit(self):
+        """Private address rejects don't hide an accept for port 443"""
+        self.assertEqual(self.policy.will_exit_to_port(443), True)
+        self.assertEqual(self.policy.will_exit_to_port(80), False)
+        self.assertEqual(self.policy.web_exit, True)
+        policy = TorCtl.ExitPolicy.build_from_desc(['reject *:*'])
+        self.assertEqual(policy.web_exit, False)
+
+class TestRestrictionCache(TestCase):
+    """Test the cached NodeRestriction results of PathSupport"""
+
+    def test_prune(self):
+        """Cached results are dropped for routers that leave the list a
+        NodeGenerator is rebuilt from"""
+        class FakeRouter:
+            def __init__(self, i):
+                self.idhex = '%040X' % i
+                self.bw = i
+                self._rstr_gen = i
+        routers = [FakeRouter(i) for i in range(1, 21)]
+        bw = PathSupport.MinBWRestriction(5)
+        rstr_list = PathSupport.NodeRestrictionList([bw])
+        generator = PathSupport.NodeGenerator(routers, rstr_list)
+        self.assertEqual(len(generator.rstr_routers), 16)
+        self.assertEqual(len(bw._r_cache), 20)
+
+        generator.rebuild(routers[10:])
+        self.assertEqual(len(generator.rstr_routers), 10)
+        live = set([r.idhex for r in routers[10:]])
+        self.assertEqual(set(bw._r_cache.keys()), live)
+        self.assertEqual(set(rstr_list._r_cache.keys()), live)
+
+class TestConsensusTracker(TestCase):
+    """Test the sorted router list of TorCtl's ConsensusTracker"""
+
+    class Status:
+        def __init__(self, router):
+            self.idhex = router.idhex
+            self.nickname = router.nickname
+
+    class Connection:
+        def __init__(self, routers):
+            self.routers = routers
+        def set_event_handler(self, handler):
+            handler.c = self
+        def get_network_status(self):
+            return [TestConsensusTracker.Status(r) for r in self.routers]
+        def read_routers(self, nslist):
+            ids = set([ns.idhex for ns in nslist])
+            return [TorCtl.Router(r) for r in self.routers
+                    if r.idhex in ids]
+
+    class Event:
+        def __init__(self, nslist):
+            self.nslist = nslist
+            self.arrived_at = time.time()
+
+    def make_routers(self, count, address = '10.0.0.1'):
+        """Make C{count} running routers, the last one the fastest"""
+        return [TorCtl.Router('%040X' % i, 'r%d' % i, i * 10, False, None,
+                              ['Running'], address, '0.2.1.30', 'Linux',
+                              0, datetime.now(), None, False, str(i), None)
+                for i in range(1, count + 1)]
+
+    def test_snapshot(self):
+        """Earlier sorted_r lists don't change when a new consensus
+        arrives"""
+        routers = self.make_routers(20)
+        connection = self.Connection(routers)
+        tracker = TorCtl.ConsensusTracker(connection)
+        sorted_r = tracker.current_consensus().sorted_r
+        before = list(sorted_r)
+        self.assertEqual([r.nickname for r in before][:2], ['r20', 'r19'])
+
+        connection.routers = routers[:5]
+        tracker.new_consensus_event(self.Event(
+            connection.get_network_status()))
+        self.assertEqual(len(tracker.sorted_r), 5)
+        self.assertEqual(sorted_r, before)
+
+    def test_geoip(self):
+        """GeoIP routers are annotated once per consensus, and only again
+        when their address changes"""
+        ranges = GeoIPSupport.GeoIPRanges([(0x0A000000, 0x0AFFFFFF, 'DE'),
+                                           (0x0B000000, 0x0BFFFFFF, 'JP')])
+        old_geoip = GeoIPSupport.geoip
+        GeoIPSupport.use_database(ranges)
+        lookups = []
+        lookup = ranges.country_code_by_addr
+        def country_code_by_addr(ip):
+            lookups.append(ip)
+            return lookup(ip)
+        ranges.country_code_by_addr = country_code_by_addr
+        try:
+            routers = self.make_routers(5)
+            connection = self.Connection(routers)
+            tracker = TorCtl.ConsensusTracker(connection,
+                                              GeoIPSupport.GeoIPRouter)
+            self.assertEqual(lookups, ['10.0.0.1'])
+            self.assertEqual(set([(r.country_code, r.continent)
+                                  for r in tracker.sorted_r]),
+                             set([('DE', 'EU')]))
+
+            moved = self.make_routers(5, address = '11.0.0.1')[2]
+            connection.routers = routers[:2] + [moved] + routers[3:]
+            tracker.new_consensus_event(self.Event(
+                connection.get_network_status()))
+            self.assertEqual(lookups, ['10.0.0.1', '11.0.0.1'])
+            self.assertEqual(tracker.routers[moved.idhex].country_code, 'JP')
+            self.assertEqual(tracker.routers[routers[0].idhex].country_code,
+                             'DE')
+        finally:
+            GeoIPSupport.use_database(old_geoip)
+
+class TestEventHandler(TestCase):
+    """Test how TorCtl's EventHandler decodes and dispatches events"""
+
+    def test_lazy_decode(self):
+        """Malformed events fail on arrival unless lazy decoding is
+        asked for"""
+        handler = TorCtl.EventHandler()
+        self.assertRaises(TorCtl.ProtocolError, handler._decode1,
+                          'CIRC garbage', None)
+        handler.lazy_decode = True
+        event = handler._decode1('CIRC garbage', None)
+        self.assertEqual(event.event_name, 'CIRC')
+        self.assertRaises(TorCtl.ProtocolError, getattr, event, 'status')
+
+    def test_reroute(self):
+        """A callback set after events have arrived is called once the
+        handler is rerouted"""
+        seen = []
+        def bandwidth_event(event):
+            seen.append(event)
+        handler = TorCtl.EventHandler()
+        lines = [(650, 'BW 10 20', None)]
+        handler._handle1(time.time(), lines)
+        handler._map1['BW'] = bandwidth_event
+        handler._handle1(time.time(), lines)
+        self.assertEqual(seen, [])
+        handler.reroute()
+        handler._handle1(time.time(), lines)
+        self.assertEqual([(e.read, e.written) for e in seen], [(10, 20)])
+
+class TestSQLWriter(TestCase):
+    """Test the queue of TorCtl's SQL writer thread"""
+
+    def test_put_never_blocks(self):
+        """Jobs queued while the writer is busy are dropped and counted
+        once the queue is full"""
+        busy = threading.Event()
+        ran = []
+        writer = SQLSupport.SQLWriter(max_queued = 2)
+        writer.put(busy.wait)
+        while not writer._jobs.empty():
+            time.sleep(0.01)
+        self.assertTrue(writer.put(ran.append, 1))
+        self.assertTrue(writer.put(ran.append, 2))
+        self.assertFalse(writer.put(ran.append, 3))
+        self.assertEqual(writer.dropped, 1)
+        busy.set()
+        self.assertTrue(writer.flush(5))
+        self.assertEqual(ran, [1, 2])
+        writer.close()
+
+    def test_router_totals(self):
+        """RouterTotals counts added while the writer is busy are merged
+        into one job and written once per router"""
+        directory = tempfile.mkdtemp()
+        try:
+            SQLSupport.setup_db('sqlite:///' +
+                                os.path.join(directory, 'totals.sqlite'),
+                                drop = True)
+            listener = SQLSupport.ConsensusTrackerListener()
+            busy = threading.Event()
+            listener.writer.put(busy.wait)
+            while not listener.writer._jobs.empty():
+                time.sleep(0.01)
+            for i in range(3):
+                listener.add_counts('A' * 40, strm_try = 1)
+                listener.add_counts('B' * 40, strm_try = 1, strm_closed = 1)
+            self.assertEqual(listener.writer._jobs.qsize(), 1)
+            busy.set()
+            self.assertTrue(listener.flush(5))
+            listener.writer.close()
+            table = SQLSupport.RouterTotals.table
+            rows = SQLSupport.tc_session.execute(
+                SQLSupport.select([table.c.router_idhex, table.c.strm_try,
+                                   table.c.strm_closed])).fetchall()
+            self.assertEqual(sorted(map(tuple, rows)),
+                             [('A' * 40, 3, 0), ('B' * 40, 3, 3)])
+        finally:
+            SQLSupport.tc_session.remove()
+            shutil.rmtree(directory)
+
+    def make_consensus(self, listener, count, store = True):
+        """Give C{listener} a consensus of C{count} routers, stored in the
+        database unless C{store} is False, and return the routers by
+        idhex"""
+        published = datetime(2010, 8, 1).time()
+        routers = {}
+        for i in range(count):
+            router = TorCtl.Router('%040X' % i, 'r%d' % i, 1024 * (i + 1),
+                                   False, [], ['Valid', 'Running'],
+                                   '10.0.0.1', '0.2.2.13', 'Linux', 0,
+                                   published, None, False, '%027d' % i, None)
+            router.list_rank = i
+            routers[router.idhex] = router
+        listener.consensus = TorCtl.Consensus(routers, routers.values(),
+                                              routers, {})
+        if store:
+            listener._update_db(routers.iterkeys())
+        return routers
+
+    def test_rank_history(self):
+        """Rank history snapshots taken while the writer is full are kept
+        and written by one job once it catches up"""
+        directory = tempfile.mkdtemp()
+        try:
+            SQLSupport.setup_db('sqlite:///' +
+                                os.path.join(directory, 'history.sqlite'),
+                                drop = True)
+            listener = SQLSupport.ConsensusTrackerListener()
+            listener.writer = SQLSupport.SQLWriter(max_queued = 1)
+            routers = self.make_consensus(listener, 3)
+            busy = threading.Event()
+            listener.writer.put(busy.wait)
+            while not listener.writer._jobs.empty():
+                time.sleep(0.01)
+            self.assertTrue(listener.writer.put(busy.wait))
+            for i in range(4):
+                listener._update_rank_history(routers.iterkeys())
+            self.assertTrue(listener.writer.dropped > 0)
+            self.assertEqual(len(listener._history), 4)
+            busy.set()
+            self.assertTrue(listener.flush(5))
+            listener.writer.close()
+            rows = SQLSupport.tc_session.execute(
+                SQLSupport.BwHistory.table.select()).fetchall()
+            self.assertEqual(len(rows), 4 * len(routers))
+        finally:
+            SQLSupport.tc_session.remove()
+            shutil.rmtree(directory)
+
+    def test_update_db(self):
+        """Routers listed more than once are stored once, whether they are
+        new or changed"""
+        directory = tempfile.mkdtemp()
+        try:
+            SQLSupport.setup_db('sqlite:///' +
+                                os.path.join(directory, 'routers.sqlite'),
+                                drop = True)
+            listener = SQLSupport.ConsensusTrackerListener()
+            routers = self.make_consensus(listener, 3, store = False)
+            ids = sorted(routers.keys())
+            listener._update_db(ids + ids[:2])
+            routers[ids[0]].orhash = 'changed'
+            routers[ids[0]].nickname = 'renamed'
+            listener._update_db([ids[0], ids[0]])
+            listener.writer.close()
+            table = SQLSupport.Router.table
+            rows = SQLSupport.tc_session.execute(
+                SQLSupport.select([table.c.idhex, table.c.nickname])).fetchall()
+            self.assertEqual(sorted(map(tuple, rows)),
+                             [(ids[0], 'renamed'), (ids[1], 'r1'),
+                              (ids[2], 'r2')])
+        finally:
+            SQLSupport.tc_session.remove()
+            shutil.rmtree(directory)
+
+    def test_check_totals(self):
+        """RouterTotals kept up by the listeners give the same statistics
+        as a full pass over the history, circuits and streams"""
+        directory = tempfile.mkdtemp()
+        try:
+            SQLSupport.setup_db('sqlite:///' +
+                                os.path.join(directory, 'stats.sqlite'),
+                                drop = True)
+            listener = SQLSupport.ConsensusTrackerListener()
+            routers = self.make_consensus(listener, 4)
+            listener._update_rank_history(routers.iterkeys())
+            for router in routers.itervalues():
+                router.list_rank = 3 - router.list_rank
+            listener._update_rank_history(routers.iterkeys())
+
+            class Handler:
+                post_listeners = [listener]
+            streams = SQLSupport.StreamListener()
+            streams.set_parent(Handler())
+            now = [1000.0]
+            def arrived(event):
+                now[0] += 1.5
+                event.arrived_at = now[0]
+                return event
+            def circ(circ_id, status, path, reason = None):
+                streams.circ_status_event(arrived(TorCtl.CircuitEvent(
+                    'CIRC', circ_id, status, ['$' + r for r in path], None,
+                    reason, None)))
+            def stream(strm_id, status, circ_id, reason = None):
+                streams.stream_status_event(arrived(TorCtl.StreamEvent(
+                    'STREAM', strm_id, status, circ_id, 'example.com', 80,
+                    reason, None, None, None, None)))
+            a, b, c, d = sorted(routers.keys())
+            circ(1, 'LAUNCHED', [])
+            circ(1, 'EXTENDED', [a])
+            circ(1, 'EXTENDED', [a, b])
+            circ(1, 'EXTENDED', [a, b, c])
+            circ(1, 'BUILT', [a, b, c])
+            circ(2, 'LAUNCHED', [])
+            circ(2, 'EXTENDED', [d])
+            circ(2, 'FAILED', [d], 'TIMEOUT')
+            for strm_id, end, reason in ((1, 'CLOSED', 'DONE'),
+                                         (2, 'FAILED', 'TIMEOUT'),
+                                         (3, 'DETACHED', 'TIMEOUT')):
+                stream(strm_id, 'NEW', 0)
+                stream(strm_id, 'SENTCONNECT', 1)
+                stream(strm_id, 'SUCCEEDED', 1)
+                streams.stream_bw_event(arrived(TorCtl.StreamBwEvent(
+                    'STREAM_BW', strm_id, 2048, 4096 * strm_id)))
+                stream(strm_id, end, 1, reason)
+            self.assertEqual(streams.stream_routers, {})
+            self.assertTrue(listener.flush(5))
+            listener.writer.close()
+            self.assertEqual(SQLSupport.RouterStats.check_totals(), [])
+            stats = SQLSupport.RouterStats.query.filter_by(
+                router_idhex = a).one()
+            self.assertEqual((stats.circ_try_to, stats.strm_closed), (1, 1))
+        finally:
+            SQLSupport.tc_session.remove()
+            shutil.rmtree(directory)
+
+class TestBandwidthStats(TestCase):
+    """Test the running moments of StatsSupport's BandwidthStats"""
+
+    def test_one_sample(self):
+        """A single sample has its own bandwidth as the mean and no
+        deviation"""
+        stats = StatsSupport.BandwidthStats()
+        stats.add_bw(3 * 1024, 1.5)
+        self.assertEqual(stats.mean, 2.0)
+        self.assertEqual(stats.dev, 0.0)
+
+    def test_zero_variance(self):
+        """Samples at the same rate never give a negative variance, even
+        when rounding would"""
+        stats = StatsSupport.BandwidthStats()
+        for duration in (2.3, 3.7, 1.2):
+            stats.add_bw(int(round(3960 * duration)) * 1024, duration)
+        self.assertTrue(stats._m2 >= 0.0)
+        self.assertAlmostEqual(stats.dev, 0.0)
+        self.assertAlmostEqual(stats.mean, 3960.0)
+
+class TestStatsTable(TestCase):
+    """Test the CSV and JSON lines export of StatsSupport's StatsHandler"""
+
+    def setUp(self):
+        """Make a StatsHandler over four routers, three of which have been
+        used"""
+        class SelectionManager:
+            def reconfigure(self, consensus):
+                pass
+        routers = [TorCtl.Router('%040X' % i, 'r%d' % i, i * 1024, False,
+                                 None, ['Running'], '10.0.0.1', '0.2.1.30',
+                                 'Linux', 0, datetime.now(), None, False,
+                                 str(i), None)
+                   for i in range(1, 5)]
+        self.handler = StatsSupport.StatsHandler(
+            TestConsensusTracker.Connection(routers), SelectionManager())
+        for i, router in enumerate(self.handler.sorted_r[:3]):
+            router.circ_chosen = i + 1
+            router.circ_failed = i
+            router.strm_chosen = 2 * i
+            router.became_active_at = None
+            router.total_active_uptime = 3600.0
+            router.bwstats.add_bw((i + 1) * 10240, 2.0)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_csv(self):
+        """The CSV header is stat_fields and there is a row of that
+        length for each used router"""
+        filename = os.path.join(self.directory, 'stats.csv')
+        self.handler.write_table(filename)
+        rows = list(csv.reader(open(filename)))
+        self.assertEqual(rows[0], StatsSupport.StatsRouter.stat_fields)
+        self.assertEqual(len(rows), 4)
+        for row in rows[1:]:
+            self.assertEqual(len(row), len(rows[0]))
+        self.assertEqual([row[1] for row in rows[1:]], ['r4', 'r3', 'r2'])
+
+    def test_json(self):
+        """Each line is a JSON object keyed by stat_fields, matching
+        stat_row()"""
+        filename = os.path.join(self.directory, 'stats.json')
+        self.handler.write_table(filename, format = 'json')
+        lines = [json.loads(line) for line in open(filename)]
+        self.assertEqual(len(lines), 3)
+        nrouters = len(self.handler.sorted_r)
+        for line, router in zip(lines, self.handler.sorted_r):
+            self.assertEqual(sorted(line.keys()),
+                             sorted(StatsSupport.StatsRouter.stat_fields))
+            row = router.stat_row(nrouters)
+            self.assertEqual([line[field] for field in
+                              StatsSupport.StatsRouter.stat_fields], row)
+        self.assertEqual(lines[2]['CF'], 2)
+        self.assertEqual(lines[2]['EB'], 15.0)
+
+    def test_format(self):
+        """Unknown formats are refused before anything is written"""
+        filename = os.path.join(self.directory, 'stats.xml')
+        self.assertRaises(ValueError, self.handler.write_table, filename,
+                          'xml')
+        self.assertFalse(os.path.exists(filename))
+
+class TestRouterHistory(TestCase):
+    """Test the per-day relay observation store"""
+
+    def setUp(self):
+        """Record two days of hourly observations of a dummy router, at
+        100 kB/s on the first day and 300 kB/s on the second"""
+        self.router = Router(fingerprint = '1234', name = 'abc')
+        self.router.save()
+        self.start = datetime(2010, 8, 1)
+        for hour in range(48):
+            when = self.start + timedelta(hours = hour)
+            RouterHistory.record(self.router, when, 100 + 200 * (hour / 24),
+                                 flags_to_mask(['Running', 'Valid']),
+                                 version_to_id('0.2.2.13-alpha'))
+
+    def test_columns(self):
+        """A day is one row holding every observation"""
+        self.assertEqual(RouterHistory.objects.count(), 2)
+        history = RouterHistory.objects.get(day = self.start.date())
+        columns = history.get_columns()
+        self.assertEqual(list(columns['times']),
+                         [hour * 3600 for hour in range(24)])
+        self.assertEqual(mask_to_flags(columns['flags'][0]),
+                         ['Running', 'Valid'])
+        self.assertEqual(id_to_version(columns['versions'][0]), '0.2.2.13')
+
+    def test_summary(self):
+        """Whole and partial days add up to the same uptime and mean"""
+        up, bw = RouterHistory.summary(self.router, self.start,
+                                       self.start + timedelta(days = 2))
+        self.assertEqual(up, 48 * 3600)
+        self.assertEqual(bw, 200)
+
+        up, bw = RouterHistory.summary(self.router,
+                                       self.start + timedelta(hours = 18),
+                                       self.start + timedelta(hours = 30))
+        self.assertEqual(up, 12 * 3600)
+        self.assertEqual(bw, 200)
+
+        up, bw = RouterHistory.summary(self.router,
+                                       self.start + timedelta(days = 3),
+                                       self.start + timedelta(days = 4))
+        self.assertEqual((up, bw), (0, 0.0))
+
+    def test_compact(self):
+        """Old days are downsampled without changing their totals, then
+        dropped"""
+        RouterHistory.compact(self.start + timedelta(
+                              days = RouterHistory._DOWNSAMPLE_DAYS + 2))
+        history = RouterHistory.objects.get(day = self.start.date())
+        self.assertEqual(history.downsampled, True)
+        self.assertEqual(len(history.get_columns()['times']),
+                         86400 / RouterHistory._DOWNSAMPLE_SECONDS)
+        up, bw = RouterHistory.summary(self.router, self.start,
+                                       self.start + timedelta(hours = 12))
+        self.assertEqual((up, bw), (12 * 3600, 100))
+
+        RouterHistory.compact(self.start + timedelta(
+                              days = RouterHistory._RETENTION_DAYS + 2))
+        self.assertEqual(RouterHistory.objects.count(), 0)
+
+    def test_gaps(self):
+        """Observations stand for the time since the previous one, at most
+        an hour, and only count as up with the Running flag"""
+        router = Router(fingerprint = '5678', name = 'gappy')
+        router.save()
+        start = datetime(2010, 8, 1)
+        running = flags_to_mask(['Running'])
+        for minutes, flags in ((0, running), (30, running), (300, running),
+                               (360, 0), (420, running)):
+            RouterHistory.record(router, start + timedelta(minutes = minutes),
+                                 100 + minutes, flags, 0)
+        history = RouterHistory.objects.get(router = router)
+        self.assertEqual(list(history.get_columns()['durations']),
+                         [3600, 1800, 3600, 0, 3600])
+        self.assertEqual(history.up_seconds, 12600)
+        self.assertEqual(history.bw_seconds,
+                         100 * 3600 + 130 * 1800 + 400 * 3600 + 520 * 3600)
+        self.assertEqual(RouterHistory.summary(router, start,
+                                               start + timedelta(hours = 5)),
+                         (5400, (100 * 3600 + 130 * 1800) / 5400.0))
+
+        history.downsample(3600)
+        columns = history.get_columns()
+        self.assertEqual(list(columns['durations']), [5400, 3600, 0, 3600])
+        self.assertEqual(list(columns['bandwidths']), [110, 400, 460, 520])
+
+class TestBulk(TestCase):
+    """Test writing many rows at once"""
+
+    def test_upsert(self):
+        """New routers are inserted and known ones updated by fingerprint"""
+        old = Router(fingerprint = 'A' * 40, name = 'old', welcomed = True)
+        old.save()
+        bulk.upsert(Router, [Router(fingerprint = 'A' * 40, name = 'renamed',
+                                    up = False),
+                             Router(fingerprint = 'B' * 40, name = 'new')],
+                    'fingerprint')
+        self.assertEqual(Router.objects.count(), 2)
+        renamed = Router.objects.get(fingerprint = 'A' * 40)
+        self.assertEqual((renamed.id, renamed.name, renamed.welcomed,
+                          renamed.up), (old.id, 'renamed', False, False))
+        self.assertEqual(Router.objects.get(fingerprint = 'B' * 40).name,
+                         'new')
+
+        day = datetime(2010, 8, 1, 12)
+        RouterHistory.record(renamed, day, 100, 0, 0)
+        RouterHistory.record_many([(renamed, 200, 0, 0),
+                                   (Router.objects.get(name = 'new'), 50, 0,
+                                    0)], day + timedelta(hours = 1))
+        self.assertEqual(RouterHistory.objects.get(router = renamed).samples,
+                         2)
+        self.assertEqual(RouterHistory.objects.count(), 2)
+
+    def test_update_all(self):
+        """Subscriptions are updated in both of their tables, and deleted
+        ones stay deleted"""
+        router = Router(fingerprint = 'A' * 40, name = 'abc')
+        router.save()
+        subs = []
+        for i in range(3):
+            subscriber = Subscriber(email = 'sub%d@example.com' % i,
+                                    router = router)
+            subscriber.save()
+            sub = NodeDownSub(subscriber = subscriber, grace_pd = 1)
+            sub.save()
+            sub.emailed = sub.triggered = True
+            subs.append(sub)
+        NodeDownSub.objects.get(id = subs[2].id).delete()
+        bulk.update_all(NodeDownSub, subs)
+        self.assertEqual(NodeDownSub.objects.count(), 2)
+        self.assertEqual(Subscription.objects.count(), 2)
+        for sub in NodeDownSub.objects.all():
+            self.assertEqual((sub.emailed, sub.triggered), (True, True))
+
+class TestRouterIndex(TestCase):
+    """Test the consensus index the web application reads"""
+
+    def setUp(self):
+        """Write indexes to a temporary directory"""
+        self.old_file = routerindex.config.consensus_index_file
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'consensus.idx')
+        routerindex.config.consensus_index_file = self.path
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        routerindex.config.consensus_index_file = self.old_file
+
+    def test_lookups(self):
+        """Routers are found by fingerprint and by name"""
+        routerindex.write(self.path, [
+            ('B' * 40, 'twin', flags_to_mask(['Fast']), 20, False),
+            ('A' * 40, u'twin', flags_to_mask(['Exit']), 10, True),
+            ('C' * 40, 'solo', 0, 0, False)])
+        index = routerindex.RouterIndex(self.path)
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.get('A' * 40),
+                         ('twin', flags_to_mask(['Exit']), 10, True))
+        self.assertEqual(index.get('C' * 40), ('solo', 0, 0, False))
+        self.assertEqual(index.get('D' * 40), None)
+        self.assertEqual(index.get('a' * 40), None)
+        self.assertEqual(index.get('not hex'), None)
+        self.assertEqual(index.fingerprints(u'twin'), ['A' * 40, 'B' * 40])
+        self.assertEqual(index.fingerprints('solo'), ['C' * 40])
+        self.assertEqual(index.fingerprints('twi'), [])
+
+    def test_swap(self):
+        """The shared index is mapped again once it is replaced"""
+        self.assertEqual(routerindex.shared(), None)
+        routerindex.write(self.path, [('A' * 40, 'old', 0, 0, False)])
+        index = routerindex.shared()
+        self.assertTrue(routerindex.shared() is index)
+        routerindex.write(self.path, [('B' * 40, 'new', 0, 0, False)])
+        self.assertEqual(routerindex.shared().fingerprints('new'), ['B' * 40])
+        self.assertEqual(index.fingerprints('old'), ['A' * 40])
+        self.assertEqual(os.listdir(self.dir), ['consensus.idx'])
+
+    def test_web(self):
+        """The subscribe form and the name lookup use the index, and fall
+        back to the database for routers that are not in it"""
+        Router(fingerprint = 'E' * 40, name = 'down').save()
+        routerindex.write(self.path, [('F' * 40, 'up', 0, 0, False)])
+        form = SubscribeForm()
+        self.assertEqual(form.is_valid_router('F' * 40), True)
+        self.assertEqual(form.is_valid_router('E' * 40), True)
+        self.assertEqual(form.is_valid_router('D' * 40), False)
+
+        client = Client()
+        response = client.get('/router_fingerprint_lookup/', {'query': 'up'})
+        self.assertEqual(simplejson.loads(response.content),
+                         ' '.join(['FFFF'] * 10))
+        response = client.get('/router_fingerprint_lookup/',
+                              {'query': 'down'})
+        self.assertEqual(simplejson.loads(response.content),
+                         ' '.join(['EEEE'] * 10))
+
+class TestPragmas(TestCase):
+    """Test the SQLite connection setup"""
+
+    def test_pragmas(self):
+        """New SQLite connections use WAL and the configured settings"""
+        from django.db import connection
+        cursor = connection.cursor()
+        if connection.settings_dict['ENGINE'] != 'django.db.backends.sqlite3':
+            return
+        cursor.execute('PRAGMA journal_mode')
+        self.assertEqual(cursor.fetchone()[0].lower(), 'wal')
+        cursor.execute('PRAGMA synchronous')
+        self.assertEqual(cursor.fetchone()[0], 1)
+        cursor.execute('PRAGMA cache_size')
+        self.assertEqual(cursor.fetchone()[0], -20000)
+
+class TestTimerWheel(TestCase):
+    """Test the timer wheel used for grace periods"""
+
+    def test_advance(self):
+        """Keys come out once, in due order, including ones more than a turn
+        of the wheel away"""
+        wheel = TimerWheel(tick = 10, num_slots = 8, now = 0)
+        wheel.schedule('a', 25)
+        wheel.schedule('b', 15)
+        wheel.schedule('c', 25 + 80)
+        wheel.schedule('d', 500)
+        wheel.cancel('d')
+        self.assertEqual(wheel.advance(10), [])
+        self.assertEqual(wheel.advance(30), ['b', 'a'])
+        self.assertEqual(wheel.advance(100), [])
+        self.assertEqual(wheel.advance(1000), ['c'])
+        self.assertEqual(len(wheel), 0)
+
+    def test_past_due(self):
+        """A key scheduled for a time already past comes out on the next
+        advance, not a turn of the wheel later"""
+        wheel = TimerWheel(tick = 10, num_slots = 8, now = 100)
+        wheel.schedule('late', 50)
+        wheel.schedule('on time', 115)
+        self.assertEqual(wheel.advance(110), ['late'])
+        self.assertEqual(wheel.advance(120), ['on time'])
+        self.assertEqual(len(wheel), 0)
+
+class TestScheduler(TestCase):
+    """Test the scheduler that runs handlers for items as they come due"""
+
+    def test_run(self):
+        """Handlers run for due items only, rescheduling when they return a
+        time, and timer events of other types are ignored"""
+        handled = []
+        def handler(id, now):
+            handled.append(id)
+            if id == 'again':
+                return now + 100
+        scheduler = Scheduler(tick = 10, now = 0)
+        scheduler.add_kind('test', handler, lambda: [('once', 50),
+                                                     ('again', 20)])
+        scheduler.load()
+        scheduler.timer_type = 'test'
+        self.assertEqual(scheduler.timer_event(
+                         TorCtl.TimerEvent('TORCTL_TIMER', 'other')), False)
+        self.assertEqual(scheduler.run(10), 0)
+        self.assertEqual(scheduler.run(60), 2)
+        self.assertEqual(handled, ['again', 'once'])
+        self.assertEqual(scheduler.due_time('test', 'again'), 160)
+        self.assertEqual(len(scheduler), 1)
+
+class TestLiveness(TestCase):
+    """Test event-driven node down notifications"""
+
+    def setUp(self):
+        """Create a running router with a confirmed node down subscription
+        with a one hour grace period"""
+        self.router = Router(fingerprint = 'A' * 40, name = 'abc', up = True)
+        self.router.save()
+        self.subscriber = Subscriber(email = 'name@place.com',
+                                     router = self.router, confirmed = True)
+        self.subscriber.save()
+        self.sub = NodeDownSub(subscriber = self.subscriber, grace_pd = 1)
+        self.sub.save()
+        self.now = time.time()
+        self.tracker = LivenessTracker(now = self.now)
+        self.tracker.load()
+        self.old_file = routerindex.config.consensus_index_file
+        self.dir = tempfile.mkdtemp()
+        routerindex.config.consensus_index_file = os.path.join(self.dir,
+                                                               'consensus.idx')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        routerindex.config.consensus_index_file = self.old_file
+
+    def ns(self, flags):
+        """A network status entry for the router with C{flags}"""
+        return TorCtl.NetworkStatus('abc', 'q' * 27, 'q' * 27,
+                                    '2010-08-01 00:00:00', '1.2.3.4', 9001,
+                                    0, flags)
+
+    def test_down_then_up(self):
+        """The subscription is triggered when the relay loses Running, the
+        email goes out when the grace period ends, and it is reset when the
+        relay publishes a descriptor"""
+        fingerprint = self.ns([]).idhex
+        self.router.fingerprint = fingerprint
+        self.router.save()
+        self.tracker.load()
+
+        self.tracker.ns_event([self.ns(['Valid'])], self.now)
+        sub = NodeDownSub.objects.get(id = self.sub.id)
+        self.assertEqual(sub.triggered, True)
+        self.assertEqual(Router.objects.get(id = self.router.id).up, False)
+
+        self.assertEqual(self.tracker.tick(self.now + 1800), [])
+        self.assertEqual(len(self.tracker.tick(self.now + 3700)), 1)
+        self.assertEqual(NodeDownSub.objects.get(id = self.sub.id).emailed,
+                         True)
+        self.assertEqual(len(mail.outbox), 1)
+
+        self.tracker.new_desc_event(['$' + fingerprint + '~abc'],
+                                    self.now + 4000)
+        sub = NodeDownSub.objects.get(id = self.sub.id)
+        self.assertEqual((sub.triggered, sub.emailed), (False, False))
+
+    def test_consensus(self):
+        """A relay missing from a consensus is down; coming back before the
+        grace period ends cancels the email"""
+        self.tracker.consensus([], self.now)
+        self.assertEqual(NodeDownSub.objects.get(id = self.sub.id).triggered,
+                         True)
+        self.tracker.set_up(self.router.fingerprint, True, self.now + 600)
+        self.assertEqual(self.tracker.tick(self.now + 7200), [])
+        self.assertEqual(NodeDownSub.objects.get(id = self.sub.id).triggered,
+                         False)
+
+    def test_grace_changed(self):
+        """A grace period changed after the relay went down moves the email
+        to the new end of the grace period"""
+        self.tracker.consensus([], self.now)
+        NodeDownSub.objects.filter(id = self.sub.id).update(grace_pd = 3)
+        self.assertEqual(self.tracker.tick(self.now + 3700), [])
+        deadline = self.tracker.scheduler.due_time('node_down', self.sub.id)
+        self.assertAlmostEqual(deadline, self.now + 3 * 3600, 0)
+
+        NodeDownSub.objects.filter(id = self.sub.id).update(grace_pd = 2)
+        self.tracker.refresh_watched(self.now + 3800)
+        self.assertEqual(len(self.tracker.tick(self.now + 2 * 3600 + 100)),
+                         1)
+        self.assertEqual(NodeDownSub.objects.get(id = self.sub.id).emailed,
+                         True)
+
+    def test_tshirt(self):
+        """A t-shirt subscription is checked when its relay has been up long
+        enough, and an hour later if its bandwidth was too low"""
+        start = datetime.fromtimestamp(self.now) - \
+                timedelta(hours = TShirtSub._UPTIME_HOURS, minutes = 30)
+        sub = TShirtSub(subscriber = self.subscriber, triggered = True,
+                        last_changed = start)
+        sub.save()
+        self.tracker.load()
+
+        self.assertEqual(self.tracker.tick(self.now), [])
+        self.assertEqual(self.tracker.scheduler.due_time('tshirt', sub.id),
+                         self.now + 3600)
+        RouterHistory.record(self.router, start + timedelta(hours = 1), 600,
+                             flags_to_mask(['Running']),
+                             version_to_id('0.2.2.13-alpha'))
+        self.assertEqual(len(self.tracker.tick(self.now + 3700)), 1)
+        sub = TShirtSub.objects.get(id = sub.id)
+        self.assertEqual((sub.emailed, sub.avg_bandwidth), (True, 600))
+
+    def test_tshirt_without_history(self):
+        """A relay with no history is judged on the bandwidth in the router
+        index"""
+        start = datetime.fromtimestamp(self.now) - \
+                timedelta(hours = TShirtSub._UPTIME_HOURS, minutes = 30)
+        sub = TShirtSub(subscriber = self.subscriber, triggered = True,
+                        last_changed = start)
+        sub.save()
+        self.tracker.load()
+        routerindex.write(routerindex.config.consensus_index_file,
+                          [(self.router.fingerprint, 'abc', 0, 700, False)])
+        self.assertEqual(len(self.tracker.tick(self.now)), 1)
+        sub = TShirtSub.objects.get(id = sub.id)
+        self.assertEqual((sub.emailed, sub.avg_bandwidth), (True, 700))
+
+    def test_refresh(self):
+        """Subscriptions are picked up once they are confirmed, and start
+        at once if their relay is already down; only new ones are read"""
+        router = Router(fingerprint = 'B' * 40, name = 'def', up = True)
+        router.save()
+        self.tracker.set_up(router.fingerprint, False, self.now)
+        subscriber = Subscriber(email = 'other@place.com', router = router)
+        subscriber.save()
+        sub = NodeDownSub(subscriber = subscriber, grace_pd = 1)
+        sub.save()
+
+        self.tracker.refresh_watched(self.now)
+        self.assertFalse(router.fingerprint in self.tracker.watched)
+        subscriber.confirmed = True
+        subscriber.save()
+        self.tracker.refresh_watched(self.now)
+        self.assertTrue(router.fingerprint in self.tracker.watched)
+        self.assertEqual(NodeDownSub.objects.get(id = sub.id).triggered,
+                         True)
+
+        settings.DEBUG = True
+        reset_queries()
+        try:
+            self.tracker.refresh_watched(self.now)
+            self.assertEqual(len(connection.queries), 3)
+        finally:
+            settings.DEBUG = False
+
+class TestFakeControl(TestCase):
+    """Test CtlUtil and TorCtl events against the fake control port"""
+
+    def setUp(self):
+        """Serve a synthetic network of 20 relays, and write router indexes
+        to a temporary directory"""
+        self.relays = synthetic_network(20)
+        self.server = FakeControlServer(self.relays)
+        self.server.start()
+        self.ctl_util = CtlUtil(control_port = self.server.port)
+        self.old_file = routerindex.config.consensus_index_file
+        self.dir = tempfile.mkdtemp()
+        routerindex.config.consensus_index_file = os.path.join(self.dir,
+                                                               'consensus.idx')
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.dir)
+        routerindex.config.consensus_index_file = self.old_file
+
+    def test_ctlutil(self):
+        """CtlUtil reads the served relays, from synthetic and from recorded
+        documents"""
+        relay = self.relays[0]
+        self.assertEqual(len(self.ctl_util.get_finger_name_list()), 20)
+        self.assertEqual(self.ctl_util.get_version(relay.fingerprint),
+                         relay.version)
+        self.assertEqual(self.ctl_util.get_bandwidth(relay.fingerprint),
+                         relay.bandwidth)
+        self.assertEqual(self.ctl_util.is_up(relay.fingerprint), True)
+        self.assertEqual(self.ctl_util.is_up('0' * 40), False)
+        observations = self.ctl_util.get_observations()
+
+        info = self.ctl_util.control.get_info(['ns/all', 'desc/all-recent'])
+        self.server.load(info['ns/all'], info['desc/all-recent'])
+        self.assertEqual(self.ctl_util.get_observations(), observations)
+
+    def test_is_exit(self):
+        """is_exit uses a descriptor from the descriptor list instead of
+        fetching it again"""
+        descriptors = self.ctl_util.get_descriptor_map()
+        self.assertEqual(sorted(descriptors.keys()),
+                         sorted([relay.fingerprint for relay in self.relays]))
+        commands = len(self.server.commands)
+        exits = [self.ctl_util.is_exit(relay.fingerprint,
+                                       descriptors[relay.fingerprint])
+                 for relay in self.relays]
+        self.assertEqual(len(self.server.commands), commands)
+        self.assertEqual(exits, [self.ctl_util.is_exit(relay.fingerprint)
+                                 for relay in self.relays])
+        self.assertEqual(len(self.server.commands), commands + 20)
+
+    def test_trace(self):
+        """A CallTracer records the command, keys, sizes and latency of each
+        control port call"""
+        tracer = self.ctl_util.control.trace(TorCtl.CallTracer(size = 2))
+        consensus = self.ctl_util.get_full_consensus()
+        self.ctl_util.control.get_info(['ns/all', 'desc/all-recent'])
+        self.ctl_util.get_single_consensus('0' * 40)
+
+        self.assertEqual([call.keys for call in tracer.recent()], [2, 1])
+        self.assertEqual(len(tracer.slowest(10)), 3)
+        self.assertEqual(tracer.slowest(1)[0].latency,
+                         max([call.latency for call in tracer.slowest(10)]))
+        call = tracer.recent()[0]
+        self.assertEqual(call.command, 'GETINFO')
+        self.assertEqual(call.sent,
+                         len('GETINFO ns/all desc/all-recent\r\n'))
+        self.assertTrue(call.received > len(consensus))
+        command, calls, seconds, buckets = tracer.summary()[0]
+        self.assertEqual((command, calls), ('GETINFO', 3))
+        self.assertEqual(buckets[-1], (None, 3))
+
+    def test_events(self):
+        """NS, NEWDESC and NEWCONSENSUS events reach a TorCtl handler"""
+        received = []
+        arrived = threading.Event()
+        class Handler(TorCtl.EventHandler):
+            def ns_event(self, event):
+                received.append(len(event.nslist))
+            def new_desc_event(self, event):
+                received.append(event.idlist)
+            def new_consensus_event(self, event):
+                received.append(len(event.nslist))
+                arrived.set()
+        self.ctl_util.control.set_event_handler(Handler())
+        self.ctl_util.control.set_events(['NS', 'NEWDESC', 'NEWCONSENSUS'])
+
+        self.server.ns_event(self.relays[:3])
+        self.server.new_desc_event(self.relays[:1])
+        self.server.new_consensus_event(self.relays[:5])
+        arrived.wait(5)
+        self.assertEqual(received, [3, [self.relays[0].fingerprint], 5])
+
+    def test_metrics(self):
+        """run_all records a summary, and the metrics page shows it along with
+        the phase and control port timings"""
+        updaters.run_all(ctl_util = self.ctl_util)
+        self.assertTrue(os.path.exists(
+            routerindex.config.consensus_index_file))
+        run = UpdaterRun.objects.get()
+        self.assertEqual(run.emails, 0)
+        self.assertTrue(run.queries > 0)
+        self.assertTrue(run.control_calls > 0)
+        self.assertTrue('update_all_routers' in run.get_phases())
+
+        response = Client().get('/metrics/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        lines = response.content.split('\n')
+        self.assertTrue('# TYPE weather_phase_seconds histogram' in lines)
+        self.assertTrue('weather_last_run_queries %d' % run.queries in lines)
+        self.assertTrue([line for line in lines if line.startswith(
+            'weather_phase_seconds_bucket{phase="check_version",le="+Inf"}')])
+        self.assertTrue([line for line in lines if line.startswith(
+            'weather_control_seconds_count{command="GETINFO desc/all-recent"}')])
+        response = Client(REMOTE_ADDR = '192.0.2.1').get('/metrics/')
+        self.assertEqual(response.status_code, 403)
+
+class TestProfiling(TestCase):
+    """Test profiling a run"""
+
+    def setUp(self):
+        """Save stats files to a temporary directory"""
+        self.old_dir = profiling.config.profile_dir
+        profiling.config.profile_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(profiling.config.profile_dir)
+        profiling.config.profile_dir = self.old_dir
+
+    def test_layers(self):
+        """A request profiles one run, and an ORM profile only sees the time
+        spent in the ORM"""
+        self.assertEqual(profiling.take(), None)
+        profiling.request('orm')
+        self.assertEqual(profiling.take(), 'orm')
+        self.assertEqual(profiling.take(), None)
+
+        def work():
+            sorted(range(10000), reverse = True)
+            return Router.objects.count()
+        result, filename = profiling.profile('orm', work)
+        self.assertEqual(result, 0)
+        self.assertEqual(os.path.dirname(filename),
+                         profiling.config.profile_dir)
+        names = [name for path, line, name in pstats.Stats(filename).stats]
+        self.assertTrue('count' in names)
+        self.assertFalse('work' in names)
+        self.assertFalse('sorted' in str(pstats.Stats(filename).stats))
+
+        def select():
+            thread = threading.Thread(target = lambda:
+                                      list(Router.objects.filter(id__in = [])))
+            thread.start()
+            thread.join()
+            return list(Router.objects.all())
+        result, filename = profiling.profile('orm', select)
+        self.assertEqual(result, [])
+        names = [name for path, line, name in pstats.Stats(filename).stats]
+        self.assertTrue('execute_sql' in names)
+        self.assertFalse('empty_iter' in names)
+
+        result, filename = profiling.profile('all', work)
+        self.assertTrue('work' in [name for path, line, name
+                                   in pstats.Stats(filename).stats])
+
+    def test_signal(self):
+        """SIGUSR1 is handled while the listener waits for its event thread,
+        and profiles the next run"""
+        profiler = updaters.profiling
+        old_handler = signal.getsignal(signal.SIGUSR1)
+        profiler.install_signal()
+        done = threading.Event()
+        handled = []
+        def send():
+            os.kill(os.getpid(), signal.SIGUSR1)
+            for i in range(500):
+                if profiler._requested:
+                    handled.append(True)
+                    break
+                time.sleep(0.01)
+            done.set()
+        thread = threading.Thread(target = done.wait, args = (10,))
+        thread.start()
+        threading.Thread(target = send).start()
+        try:
+            listener.wait(thread, 0.01)
+        finally:
+            signal.signal(signal.SIGUSR1, old_handler)
+        self.assertEqual(handled, [True])
+
+        server = FakeControlServer(synthetic_network(5))
+        server.start()
+        old_file = routerindex.config.consensus_index_file
+        routerindex.config.consensus_index_file = None
+        try:
+            updaters.run_all(ctl_util = CtlUtil(control_port = server.port))
+        finally:
+            server.stop()
+            routerindex.config.consensus_index_file = old_file
+        self.assertEqual(profiler._requested, None)
+        files = os.listdir(profiling.config.profile_dir)
+        self.assertEqual(len(files), 1)
+        self.assertTrue(files[0].startswith('profile-'))
+
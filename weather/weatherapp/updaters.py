@@ -5,8 +5,8 @@ updating info relating to routers already stored. Next, each subscription is
 checked to determine if the Subscriber should be emailed. When an email 
 notification is indicated, a tuple with the email subject, message, sender, and 
 recipient is added to the list of email tuples. Once all updates are complete, 
-Django's send_mass_mail method is called, passing in the emails tuple as a 
-parameter.
+the tuples are combined into digests per recipient and sent with
+emails.send_mass_mime.
 
 @type ctl_util: CtlUtil
 @var ctl_util: A CtlUtil object for the module to handle the connection to and
@@ -15,21 +15,27 @@ parameter.
 """
 import socket, sys, os
 import threading
-from datetime import datetime
+from datetime import datetime, timedelta
 import time
 import logging
 from smtplib import SMTPException
 
+from django.db import transaction
+
 from config import config
 from weatherapp.ctlutil import CtlUtil
 from weatherapp.models import Subscriber, Router, NodeDownSub, BandwidthSub, \
-                              TShirtSub, VersionSub, DeployedDatetime
-from weatherapp import emails
+                              TShirtSub, VersionSub, DeployedDatetime, \
+                              RouterHistory, UpdaterRun, flags_to_mask, \
+                              version_to_id
+from weatherapp import emails, metrics, ctlutil, profiling, bulk, \
+                       routerindex
 
-from django.core.mail import send_mass_mail
 
 failed_email_file = 'log/failed_emails.txt'
 
+@metrics.phase('check_node_down')
+@transaction.commit_on_success
 def check_node_down(email_list):
     """Check if all nodes with L{NodeDownSub} subs are up or down,
     and send emails and update sub data as necessary.
@@ -39,8 +45,9 @@ def check_node_down(email_list):
     @rtype: list
     @return: The updated list of tuples representing emails to send.
     """
-    #All node down subs
-    subs = NodeDownSub.objects.all()
+    #All node down subs, saved together at the end
+    subs = NodeDownSub.objects.select_related('subscriber__router')
+    saved = []
 
     for sub in subs:
         #only check subscriptions of confirmed subscribers
@@ -70,9 +77,12 @@ def check_node_down(email_list):
                     email_list.append(email)
                     sub.emailed = True 
 
-            sub.save()
+            saved.append(sub)
+    bulk.update_all(NodeDownSub, saved)
     return email_list
 
+@metrics.phase('check_low_bandwidth')
+@transaction.commit_on_success
 def check_low_bandwidth(ctl_util, email_list):
     """Checks all L{BandwidthSub} subscriptions, updates the information,
     determines if an email should be sent, and updates email_list.
@@ -84,7 +94,8 @@ def check_low_bandwidth(ctl_util, email_list):
     @rtype: list
     @return: The updated list of tuples representing emails to send.
     """
-    subs = BandwidthSub.objects.all()
+    subs = BandwidthSub.objects.select_related('subscriber__router')
+    saved = []
 
     for sub in subs:
 
@@ -107,10 +118,13 @@ def check_low_bandwidth(ctl_util, email_list):
                     sub.emailed = True
             else:
                 sub.emailed = False
-            sub.save()
+            saved.append(sub)
 
+    bulk.update_all(BandwidthSub, saved)
     return email_list
 
+@metrics.phase('check_earn_tshirt')
+@transaction.commit_on_success
 def check_earn_tshirt(ctl_util, email_list):
     """Check all L{TShirtSub} subscriptions and send an email if necessary. 
     If the node is down, the trigger flag set to False. The average 
@@ -125,7 +139,9 @@ def check_earn_tshirt(ctl_util, email_list):
     @return: The updated list of tuples representing emails to send.
     """
    
-    subs = TShirtSub.objects.filter(emailed = False)
+    subs = TShirtSub.objects.filter(emailed = False).select_related(
+                                    'subscriber__router')
+    saved = []
 
     for sub in subs:
         if sub.subscriber.confirmed:
@@ -173,9 +189,12 @@ def check_earn_tshirt(ctl_util, email_list):
                         email_list.append(email)
                         sub.emailed = True
 
-            sub.save()
+            saved.append(sub)
+    bulk.update_all(TShirtSub, saved)
     return email_list
 
+@metrics.phase('check_version')
+@transaction.commit_on_success
 def check_version(ctl_util, email_list):
     """Check/update all C{VersionSub} subscriptions and send emails as
     necessary.
@@ -187,7 +206,8 @@ def check_version(ctl_util, email_list):
     @rtype: list
     @return: The updated list of tuples representing emails to send."""
 
-    subs = VersionSub.objects.all()
+    subs = VersionSub.objects.select_related('subscriber__router')
+    saved = []
 
     for sub in subs:
         if sub.subscriber.confirmed:
@@ -218,37 +238,49 @@ def check_version(ctl_util, email_list):
                     sub.emailed = False
             else:
                 logging.info("Couldn't parse the version relay %s is running" \
-                              % fingerprint)
+                              % sub.subscriber.router.fingerprint)
 
-            sub.save()
+            saved.append(sub)
 
+    bulk.update_all(VersionSub, saved)
     return email_list
         
                 
-def check_all_subs(ctl_util, email_list):
+def check_all_subs(ctl_util, email_list, scheduled = False):
     """Check/update all subscriptions
    
     @type ctl_util: CtlUtil
     @param ctl_util: A valid CtlUtil instance.
     @type email_list: list
     @param email_list: The list of tuples representing emails to send.
+    @type scheduled: bool
+    @param scheduled: Whether L{NodeDownSub} and L{TShirtSub} subscriptions
+        are left out. The listener sets this when a L{LivenessTracker
+        <liveness.LivenessTracker>} schedules their deadlines.
     @rtype: list
     @return: The updated list of tuples representing emails to send.
     """
-    logging.debug('Checking node down subscriptions.')
-    email_list = check_node_down(email_list)
+    if not scheduled:
+        logging.debug('Checking node down subscriptions.')
+        email_list = check_node_down(email_list)
     logging.debug('Checking version subscriptions.')
-    check_version(email_list)
+    email_list = check_version(ctl_util, email_list)
     logging.debug('Checking bandwidth subscriptions.')
-    check_low_bandwidth(email_list)
-    logging.debug('Checking shirt subscriptions.')
-    email_list = check_earn_tshirt(email_list)
+    email_list = check_low_bandwidth(ctl_util, email_list)
+    if not scheduled:
+        logging.debug('Checking shirt subscriptions.')
+        email_list = check_earn_tshirt(ctl_util, email_list)
     return email_list
 
+@metrics.phase('update_all_routers')
+@transaction.commit_on_success
 def update_all_routers(ctl_util, email_list):
     """Add ORs we haven't seen before to the database and update the
-    information of ORs that are already in the database. Check if a welcome
-    email should be sent and add the email tuples to the list.
+    information of ORs that are already in the database. Record each OR in
+    the consensus in its L{RouterHistory}. Check if a welcome email should be
+    sent and add the email tuples to the list. Once the routers are
+    committed, write the index of them that the web application reads, see
+    C{routerindex}.
 
     @type ctl_util: CtlUtil
     @param ctl_util: A valid CtlUtil instance.
@@ -273,74 +305,140 @@ def update_all_routers(ctl_util, email_list):
     else:
         fully_deployed = True
     
-    router_set = Router.objects.all()
-    for router in router_set:
-        #remove routers from the db that we haven't seen for more than a year 
-        if (datetime.now() - router.last_seen).days > 365:
-            router.delete()
-        #Set the 'up' flag to False for every router
-        else:
-            router.up = False
-            router.save()
+    #remove routers from the db that we haven't seen for more than a year,
+    #and set the 'up' flag to False for every other router
+    now = datetime.now()
+    Router.objects.filter(last_seen__lt = now - timedelta(days = 366)).delete()
+    Router.objects.update(up = False)
+    known = dict([(router[0], router[1:]) for router in
+                  Router.objects.values_list('fingerprint', 'id', 'welcomed')])
     
     #Get a list of fingerprint/name tuples in the current descriptor file
-    finger_name = ctl_util.get_finger_name_list()
+    desc_list = ctl_util.get_descriptor_list()
+    finger_name = ctl_util.get_finger_name_list(desc_list)
+    observations = ctl_util.get_observations(desc_list)
+    descriptors = ctl_util.get_descriptor_map(desc_list)
 
+    routers = {}
     for router in finger_name:
         finger = router[0]
         name = router[1]
 
-        if ctl_util.is_up_or_hibernating(finger):
+        if finger not in routers and ctl_util.is_up_or_hibernating(finger):
 
-            router_data = None
-            try:
-                router_data = Router.objects.get(fingerprint = finger)
-            except:
-                if fully_deployed:
-                    router_data = Router(name = name, fingerprint = finger,
-                                         welcomed = False)
-                else:
-                    #We don't ever want to welcome relays that were running 
-                    #when  Weather was deployed, so set welcomed to True
-                    router_data = Router(name = name, fingerprint = finger,
-                                         welcomed = True)           
-            
-            router_data.last_seen = datetime.now()
-            router_data.name = name
-            router_data.up = True
-            router_data.exit = ctl_util.is_exit(finger)
+            router_data = Router(name = name, fingerprint = finger,
+                                 last_seen = now, up = True,
+                                 exit = ctl_util.is_exit(finger,
+                                            descriptors.get(finger)))
+            if finger in known:
+                router_data.id, router_data.welcomed = known[finger]
+            else:
+                #We don't ever want to welcome relays that were running 
+                #when  Weather was deployed, so set welcomed to True
+                router_data.welcomed = not fully_deployed
 
             #send a welcome email if indicated
             if router_data.welcomed == False and ctl_util.is_stable(finger):
                 address = ctl_util.get_email(finger)
                 if not address == "":
-                    email = emails.welcome_tuple(address, finger, name, is_exit)
+                    email = emails.welcome_tuple(address, finger, name,
+                                                 router_data.exit)
                     email_list.append(email)
                 router_data.welcomed = True
 
-            router_data.save()
+            routers[finger] = router_data
+
+    #write all routers at once, then look up the ids of the new ones
+    bulk.upsert(Router, routers.values(), 'fingerprint')
+    if [finger for finger in routers if finger not in known]:
+        for finger, id in Router.objects.values_list('fingerprint', 'id'):
+            if finger in routers:
+                routers[finger].id = id
+
+    history = []
+    for finger, router_data in routers.items():
+        if finger in observations:
+            bandwidth, flags, version = observations[finger]
+            history.append((router_data, bandwidth, flags_to_mask(flags),
+                            version_to_id(version)))
+    RouterHistory.record_many(history, now)
+
+    #commit the routers before the web application can find them in the index
+    transaction.commit()
+    if config.consensus_index_file:
+        index = []
+        for finger, router_data in routers.items():
+            bandwidth, flags, version = observations.get(finger, (0, [], ''))
+            index.append((finger, router_data.name, flags_to_mask(flags),
+                          bandwidth, router_data.exit))
+        try:
+            routerindex.write(config.consensus_index_file, index)
+        except (IOError, OSError), e:
+            logging.error('Could not write the router index: %s' % e)
 
     return email_list
 
-def run_all():
-    """Run all updaters/checkers in proper sequence, then send emails."""
+def run_all(scheduled = False, ctl_util = None):
+    """Run all updaters/checkers in proper sequence, then send emails, with
+    several emails to one recipient combined by C{emails.digest}. Each phase
+    that writes to the database runs in one transaction, so the web
+    application never sees a phase half done. Each phase is timed into
+    C{metrics}, and a summary of the run is logged and stored as an
+    L{UpdaterRun}. The control port calls of the run, as traced by
+    C{ctlutil.tracer}, are logged at debug level. If a profile of this run
+    was asked for, see C{profiling}, the run is profiled.
+
+    @type scheduled: bool
+    @param scheduled: Whether L{NodeDownSub} and L{TShirtSub} subscriptions
+        are left to the listener's scheduler, see L{check_all_subs}.
+    @type ctl_util: CtlUtil
+    @param ctl_util: The CtlUtil to use. Default is a new one connected to
+        the configured control port.
+    """
+
+    layer = profiling.take()
+    if layer:
+        return profiling.profile(layer, _run_all, scheduled, ctl_util)[0]
+    return _run_all(scheduled, ctl_util)
 
+def _run_all(scheduled, ctl_util):
     #The CtlUtil for all methods to use
-    ctl_util = CtlUtil()
+    if ctl_util == None:
+        ctl_util = CtlUtil()
+    emails.clear_cache()
+    metrics.count_queries()
+    run = metrics.start_run()
+    if ctlutil.tracer:
+        ctlutil.tracer.reset()
 
     # the list of tuples of email info, gets updated w/ each call
     email_list = []
     email_list = update_all_routers(ctl_util, email_list)
+    with metrics.phase('compact'):
+        transaction.commit_on_success(RouterHistory.compact)()
     logging.info('Finished updating routers. About to check all subscriptions.')
-    email_list = check_all_subs(ctl_util, email_list)
+    email_list = check_all_subs(ctl_util, email_list, scheduled)
     logging.info('Finished checking subscriptions. About to send emails.')
-    mails = tuple(email_list)
-
-    try:
-        send_mass_mail(mails, fail_silently = False)
-    except SMTPException, e:
-        logging.info(e)
-        failed = open(failed_email_file, 'w')
-        failed.write(e + '\n')
-        failed.close()
+
+    with metrics.phase('send_emails'):
+        mails = emails.digest(email_list)
+        try:
+            emails.send_mass_mime(mails, fail_silently = False)
+        except SMTPException, e:
+            logging.info(e)
+            failed = open(failed_email_file, 'w')
+            failed.write(str(e) + '\n')
+            failed.close()
     logging.info('Finished sending emails.')
+
+    metrics.finish_run(run)
+    UpdaterRun.record(run)
+    logging.info('Run took %.1fs: %d queries, %d control port calls, '
+                 '%d emails.' % (run.seconds, run.queries, run.control_calls,
+                                 run.emails))
+    if ctlutil.tracer:
+        for command, calls, seconds, buckets in ctlutil.tracer.summary():
+            logging.debug('Control port %s: %d calls, %.3fs.' % (command,
+                          calls, seconds))
+        for call in ctlutil.tracer.slowest(10):
+            logging.debug('Slow control port call: %s' % call)
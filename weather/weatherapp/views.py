@@ -8,9 +8,10 @@ page rendering/redirection.
 import threading
 
 from weatherapp.models import Subscriber, Router, GenericForm, \
-        SubscribeForm, PreferencesForm, insert_fingerprint_spaces
-from weatherapp import emails
-from config import url_helper, templates
+        SubscribeForm, PreferencesForm, UpdaterRun, insert_fingerprint_spaces
+from weatherapp import emails, routerindex
+from weatherapp.metrics import registry, render_run
+from config import config, url_helper, templates
 from weatherapp import error_messages
 
 import django.views.static
@@ -18,7 +19,7 @@ from django.db import models
 from django.core.context_processors import csrf
 from django.shortcuts import render_to_response, get_object_or_404
 from django.http import HttpResponseRedirect, HttpRequest, Http404
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseForbidden
 from django.utils import simplejson
 
 def home(request):
@@ -81,7 +82,10 @@ def preferences(request, pref_auth):
     @param pref_auth: The user's preferences authorization key.
     """
 
-    user = get_object_or_404(Subscriber, pref_auth = pref_auth)                
+    # The subscriber and its router take one query, and PreferencesForm
+    # loads all of the subscriptions in another.
+    user = get_object_or_404(Subscriber.objects.select_related('router'),
+                             pref_auth = pref_auth)
 
     if not user.confirmed:
         # the user hasn't confirmed, send them to an error page
@@ -331,7 +335,8 @@ def router_fingerprint_lookup(request):
     entered name by looking at GET data, and then returns an HTTP response 
     with json data for the L{Router}'s fingerprint. Using json is probably
     over the top, but this was the method used by the autocomplete library, 
-    which is what I based this on.
+    which is what I based this on. Names of routers in the current consensus
+    are looked up in the router index, others in the database.
 
     @type request: HttpRequest
     @param request: an HTTP request object.
@@ -343,6 +348,15 @@ def router_fingerprint_lookup(request):
     if request.method == 'GET':
         if u'query' in request.GET:
             router_name = request.GET[u'query']
+            index = routerindex.shared()
+            fingerprints = index and index.fingerprints(router_name)
+            if fingerprints:
+                if len(fingerprints) > 1:
+                    json = simplejson.dumps('nonunique_name')
+                else:
+                    json = simplejson.dumps(
+                        insert_fingerprint_spaces(fingerprints[0]))
+                return HttpResponse(json, mimetype='application/json')
             try:
                 router = Router.objects.get(name = router_name)
             except Router.MultipleObjectsReturned:
@@ -352,3 +366,23 @@ def router_fingerprint_lookup(request):
             else:
                 json = simplejson.dumps(router.spaced_fingerprint())
             return HttpResponse(json, mimetype='application/json')
+
+def metrics(request):
+    """Exposes the metrics of this process, and those of the last updater
+    run recorded by the listener, in the Prometheus text format. Only
+    clients in C{config.metrics_allowed_ips} may read them.
+
+    @type request: HttpRequest
+    @param request: an HTTP request object.
+    @rtype: HttpResponse
+    @return: An HTTP response object with the metrics as plain text, or a
+        403 response for other clients.
+    """
+
+    if request.META.get('REMOTE_ADDR') not in config.metrics_allowed_ips:
+        return HttpResponseForbidden()
+    text = registry.render()
+    runs = UpdaterRun.objects.order_by('-id')[:1]
+    if runs:
+        text += render_run(runs[0])
+    return HttpResponse(text, mimetype='text/plain; version=0.0.4')